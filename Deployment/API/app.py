@@ -1,151 +1,345 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 import os
-import torch
-import nibabel as nib
-import numpy as np
-from monai.networks.nets import UNet
-from monai.transforms import (
-    Compose,
-    LoadImage,
-    EnsureChannelFirst,
-    ScaleIntensityRange,
-    CropForeground,
-    Resize,
-    EnsureType
-)
+import threading
+import time
+import traceback
+import uuid
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from backends import configure_threads
+from batcher import QueueFull
+from encoding import ENCODINGS, encode_mask, load_mask, mask_filename, output_options
+from engine import InferenceEngine, EngineNotReady
+from jobs import JobManager
+from metrics import ERRORS, REGISTRY, REQUEST_SECONDS, REQUESTS, bind_engine, observe_stages
+from profiling import ProfilerBusy, profile_request
+from render import Renderer
+from stats import batch_statistics
+from segmentation import get_brats_scan_paths
+from segmentation import BrainTumorSegmentation  # re-exported for existing imports
+from upload import UploadTooLarge, receive_study, upload_options
 
 app = Flask(__name__)
 
-class BrainTumorSegmentation:
-    def __init__(self, model_path):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        print(f"Using device: {self.device}")
-        
-        # Initialize model
-        self.model = UNet(
-            spatial_dims=3,
-            in_channels=4,
-            out_channels=4,
-            channels=(32, 64, 128, 256, 512),
-            strides=(2, 2, 2, 2),
-            num_res_units=2
-        ).to(self.device)
-        
-        self.model.load_state_dict(torch.load(model_path, map_location=self.device , weights_only=True))
-        self.model.eval()
-        
-        self.transforms = Compose([
-            LoadImage(image_only=True),
-            EnsureChannelFirst(),
-            ScaleIntensityRange(
-                a_min=-200,
-                a_max=200,
-                b_min=0.0,
-                b_max=1.0,
-                clip=True
-            ),
-            CropForeground(source_key="image"),
-            Resize(spatial_size=(128, 128, 128)),
-            EnsureType()
-        ])
-
-    def get_brats_scan_paths(self, patient_folder):
-        """
-        Get paths for all modalities from BraTS patient folder
-        """
-        modality_paths = {
-            't1': None,
-            't1ce': None,
-            't2': None,
-            'flair': None
-        }
-        
-        for file in os.listdir(patient_folder):
-            if file.endswith('.nii.gz'):
-                print(file)
-                if 't1.' in file.lower():
-                    modality_paths['t1'] = os.path.join(patient_folder, file)
-                elif 't1ce.' in file.lower():
-                    modality_paths['t1ce'] = os.path.join(patient_folder, file)
-                elif 't2.' in file.lower():
-                    modality_paths['t2'] = os.path.join(patient_folder, file)
-                elif 'flair.' in file.lower():
-                    modality_paths['flair'] = os.path.join(patient_folder, file)
-        
-
-        missing = [k for k, v in modality_paths.items() if v is None]
-        if missing:
-            raise ValueError(f"Missing modalities: {missing}")
-            
-        return [modality_paths['t1'], modality_paths['t1ce'], 
-                modality_paths['t2'], modality_paths['flair']]
-
-    def preprocess_scan(self, file_paths):
-        """
-        Preprocess the 4 modality scans (T1, T1ce, T2, FLAIR)
-        """
-        processed_scans = []
-        for path in file_paths:
-            scan = self.transforms(path)
-            processed_scans.append(scan)
-        
-        # Concatenate all modalities
-        input_data = torch.cat(processed_scans, dim=0)
-        return input_data.unsqueeze(0)  
-
-    @torch.no_grad()
-    def predict(self, patient_folder):
-        """
-        Make prediction on new scans
-        patient_folder: Path to patient folder containing all modalities
-        """
-        # Get paths for all modalities
-        file_paths = self.get_brats_scan_paths(patient_folder)
-        print("Found all modalities:", file_paths)
-        
-
-        input_data = self.preprocess_scan(file_paths).to(self.device)
-        
-        # Make prediction
-        output = self.model(input_data)
-        
-        # Get segmentation mask
-        mask = torch.argmax(output, dim=1)
-        return mask.cpu().numpy()[0]  
-
-    def save_prediction(self, mask, output_path, reference_scan):
-        """
-        Save the prediction mask as a NIfTI file
-        """
-        # Load reference scan to get affine and header information
-        ref_nifti = nib.load(reference_scan)
-        
-        # Create new NIfTI image with the prediction mask
-        pred_nifti = nib.Nifti1Image(mask, ref_nifti.affine, ref_nifti.header)
-        nib.save(pred_nifti, output_path)
-        print(f"Saved prediction to: {output_path}")
+config = yaml.safe_load(open(os.environ.get("NEUROVISION_CONFIG", "config.yaml")))
+configure_threads(config.get("runtime"))
+output = output_options(config.get("output"))
+upload = upload_options(config.get("upload"))
+
+# One warm model per worker process, loaded once at startup
+engine = InferenceEngine(
+    config["model"]["path"],
+    warmup=config["model"]["warmup"],
+    reload_interval=config["model"]["reload_interval"],
+    batching=config.get("batching"),
+    inference=config.get("inference"),
+    cache=config.get("cache"),
+    runtime=config.get("runtime"),
+    tta=config.get("tta")
+)
+# Under serve.py the master loads the weights before forking and each
+# worker starts its own engine threads after the fork
+if not os.environ.get("NEUROVISION_DEFER_START"):
+    engine.start()
+
+jobs = JobManager(
+    engine,
+    config["jobs"]["output_dir"],
+    executor=config["jobs"]["executor"],
+    max_workers=config["jobs"]["max_workers"],
+    output=output
+)
+
+bind_engine(engine, jobs)
+
+# Offscreen render windows are created on first use, not at import
+renderer = None
+renderer_lock = threading.Lock()
+
+def get_renderer():
+    global renderer
+    with renderer_lock:
+        if renderer is None:
+            options = {k: v for k, v in config["render"].items() if k != "allowed_dirs"}
+            renderer = Renderer(**options)
+    return renderer
+
+def render_path(path):
+    """
+    `path` resolved, if it lies inside one of render.allowed_dirs or the jobs
+    output directory; PermissionError otherwise
+    """
+    resolved = os.path.realpath(path)
+    roots = list(config["render"].get("allowed_dirs", [])) + [config["jobs"]["output_dir"]]
+    for root in roots:
+        root = os.path.realpath(root)
+        if os.path.commonpath([root, resolved]) == root:
+            return resolved
+    raise PermissionError(f"{path} is outside the directories /render may read")
+
+# Statistics run in their own processes so a large batch does not hold the GIL
+stats_pool = None
+stats_pool_lock = threading.Lock()
+
+def get_stats_pool():
+    global stats_pool
+    with stats_pool_lock:
+        if stats_pool is None:
+            stats_pool = ProcessPoolExecutor(max_workers=config["stats"]["workers"])
+    return stats_pool
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = engine.status()
+    return jsonify(status), (200 if status["ready"] else 503)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    if "request_start" in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, route=route)
+    return response
+
+def error_response(route, error, status):
+    ERRORS.inc(route=route, type=type(error).__name__)
+    if status >= 500:
+        traceback.print_exc()
+    return jsonify({"error": str(error), "type": type(error).__name__}), status
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus text format; ?format=json for the JSON view
+    """
+    if request.args.get('format') == 'json':
+        return jsonify(dict(engine.metrics(), registry=REGISTRY.snapshot()))
+    return Response(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+def mask_options(options):
+    """
+    (mask_encoding, save) from a request's options: the mask in the response
+    ("rle" or "bbox") and "save": false to skip writing it to disk
+    """
+    mask_encoding = options.get('mask_encoding', output["response_encoding"])
+    if mask_encoding not in ENCODINGS:
+        raise ValueError(f"Unknown mask_encoding: {mask_encoding}, expected one of {list(ENCODINGS)}")
+    save = options.get('save', True)
+    if isinstance(save, str):
+        save = save.lower() not in ('0', 'false', 'no')
+    return mask_encoding, save
+
+def write_outputs(prediction_mask, segmenter, output_dir, reference_scan, mask_encoding, save, timings):
+    """
+    Save the mask under output_dir and/or encode it for the response;
+    returns (output_path or None, encoded mask or None)
+    """
+    output_path = None
+    if save:
+        os.makedirs(output_dir, exist_ok=True)
+        start = time.perf_counter()
+        output_path = os.path.join(output_dir, mask_filename(output))
+        segmenter.save_prediction(prediction_mask, output_path, reference_scan,
+                                  output["compression_level"], output["compression_threads"])
+        timings["save"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mask = encode_mask(prediction_mask, mask_encoding)
+    if mask is not None:
+        timings["encode"] = time.perf_counter() - start
+    return output_path, mask
 
 @app.route('/predict', methods=['POST'])
 def predict():
     try:
         data = request.json
+        if not isinstance(data, dict) or 'patient_folder' not in data:
+            raise ValueError("Expected a JSON body with 'patient_folder'")
         patient_folder = data['patient_folder']
-        model_path = "Brain_30.pt"
-        
-        segmenter = BrainTumorSegmentation(model_path)
+        if not os.path.isdir(patient_folder):
+            raise FileNotFoundError(f"Patient folder not found: {patient_folder}")
+
+        profiler = data.get('profile')
+        if profiler and not config["profiling"]["enabled"]:
+            raise PermissionError("Profiling is disabled in config.yaml")
+        mask_encoding, save = mask_options(data)
+        file_paths = get_brats_scan_paths(patient_folder)
+
+        segmenter = engine.get()
         print(f"Processing patient folder: {patient_folder}")
-        prediction_mask = segmenter.predict(patient_folder)
-        
-        output_dir = os.path.join("current_predictions")
-        os.makedirs(output_dir, exist_ok=True)
-        
-        output_path = os.path.join(output_dir, "seg.nii.gz")
-        reference_scan = segmenter.get_brats_scan_paths(patient_folder)[0] 
-        segmenter.save_prediction(prediction_mask, output_path, reference_scan)
-        
-        return jsonify({"message": "Prediction completed successfully!", "output_path": output_path})
+        timings = {}
+        profiling = profile_request(profiler, config["profiling"]["directory"]) if profiler else nullcontext()
+        with profiling as profile:
+            # Optional: "quality" preset (fast, tta, ensemble) and "tta" overrides.
+            # A profiled request runs its forward pass in this thread
+            prediction_mask = engine.predict(patient_folder, timings, quality=data.get('quality'),
+                                             tta=data.get('tta'), batched=not profiler, file_paths=file_paths)
+            output_path, mask = write_outputs(prediction_mask, segmenter, "current_predictions", file_paths[0],
+                                              mask_encoding, save, timings)
+        observe_stages(timings)
+
+        return jsonify({"message": "Prediction completed successfully!", "output_path": output_path,
+                        "mask": mask, "timings": timings, "profile": profile["path"] if profile else None})
+    except EngineNotReady as e:
+        return error_response("/predict", e, 503)
+    except QueueFull as e:
+        return error_response("/predict", e, 429)
+    except ProfilerBusy as e:
+        return error_response("/predict", e, 409)
+    except PermissionError as e:
+        return error_response("/predict", e, 403)
+    except FileNotFoundError as e:
+        return error_response("/predict", e, 404)
+    except ValueError as e:
+        return error_response("/predict", e, 400)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response("/predict", e, 500)
+
+@app.route('/predict/upload', methods=['POST'])
+def predict_upload():
+    """
+    Segment a study sent in the request body instead of read from the host:
+    multipart/form-data with one file per modality (named t1, t1ce, t2 and
+    flair by field or file name), or a tar archive, optionally gzipped, of
+    the four files. The body is decoded as it streams in; see upload.py.
+    Options go in the query string or as multipart fields: quality,
+    mask_encoding and save. A saved mask goes to
+    current_predictions/uploads/<upload_id>/.
+    """
+    try:
+        # Options in the query string are checked before the body is read
+        engine.tta_options(request.args.get('quality'))
+        mask_options(request.args)
+        segmenter = engine.get()
+        timings = {}
+        digests, prepare, reference, fields = receive_study(
+            request.stream, request.mimetype, request.mimetype_params, request.content_length,
+            segmenter, upload, timings
+        )
+        options = dict(fields, **request.args.to_dict())
+        mask_encoding, save = mask_options(options)
+        prediction_mask = engine.predict_input(lambda: digests, prepare, timings, quality=options.get('quality'))
+
+        upload_id = uuid.uuid4().hex
+        output_dir = os.path.join("current_predictions", "uploads", upload_id)
+        output_path, mask = write_outputs(prediction_mask, segmenter, output_dir, reference,
+                                          mask_encoding, save, timings)
+        observe_stages(timings, source="upload")
+        return jsonify({"message": "Prediction completed successfully!", "upload_id": upload_id,
+                        "output_path": output_path, "mask": mask, "timings": timings})
+    except EngineNotReady as e:
+        return error_response("/predict/upload", e, 503)
+    except QueueFull as e:
+        return error_response("/predict/upload", e, 429)
+    except UploadTooLarge as e:
+        return error_response("/predict/upload", e, 413)
+    except ValueError as e:
+        return error_response("/predict/upload", e, 400)
+    except Exception as e:
+        return error_response("/predict/upload", e, 500)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    data = request.json or {}
+    patient_folder = data.get('patient_folder')
+    if not patient_folder or not os.path.isdir(patient_folder):
+        return jsonify({"error": f"Patient folder not found: {patient_folder}"}), 400
+
+    try:
+        job_id = jobs.submit(patient_folder, quality=data.get('quality'), tta=data.get('tta'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Job status; ?mask_encoding=rle|bbox adds the mask of a finished job
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    mask_encoding = request.args.get('mask_encoding')
+    if mask_encoding and job["status"] == "succeeded":
+        try:
+            job = dict(job, mask=encode_mask(load_mask(job["output_path"]), mask_encoding))
+        except ValueError as e:
+            return error_response("/jobs/<job_id>", e, 400)
+    return jsonify(job)
+
+@app.route('/render', methods=['POST'])
+def render():
+    """
+    Render a prediction offscreen. Body: either {"job_id"} or
+    {"output_path", "patient_folder"} inside render.allowed_dirs, plus optional view (3d, axial,
+    sagittal, coronal), azimuth, elevation, zoom, position, width, height
+    and format (png, webp, gltf).
+    """
+    try:
+        data = request.json or {}
+        if 'job_id' in data:
+            job = jobs.get(data['job_id'])
+            if job is None or job["status"] != "succeeded":
+                return jsonify({"error": f"No finished job: {data['job_id']}"}), 404
+            output_path, patient_folder = job["output_path"], job["patient_folder"]
+        else:
+            # Paths from the client are confined to render.allowed_dirs
+            output_path, patient_folder = render_path(data['output_path']), render_path(data['patient_folder'])
+
+        t1_path = engine.get().get_brats_scan_paths(patient_folder)[0]
+        fmt = data.get('format', 'png')
+        body, mimetype = get_renderer().render(
+            output_path, t1_path,
+            view=data.get('view', '3d'),
+            azimuth=data.get('azimuth', 0.0),
+            elevation=data.get('elevation', 0.0),
+            zoom=data.get('zoom', 1.0),
+            position=data.get('position'),
+            width=data.get('width'),
+            height=data.get('height'),
+            fmt=fmt
+        )
+        response = Response(body, mimetype=mimetype)
+        if fmt == 'gltf':
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+    except EngineNotReady as e:
+        return error_response("/render", e, 503)
+    except PermissionError as e:
+        return error_response("/render", e, 403)
+    except (KeyError, ValueError) as e:
+        return error_response("/render", e, 400)
+    except Exception as e:
+        return error_response("/render", e, 500)
+
+@app.route('/stats', methods=['POST'])
+def stats():
+    """
+    Label statistics for a batch of stored predictions. Body: {"paths": [...]}
+    and/or {"job_ids": [...]}. Results come back in request order; a file that
+    cannot be read gets an "error" entry instead of failing the batch.
+    """
+    data = request.json or {}
+    paths = list(data.get('paths', []))
+    for job_id in data.get('job_ids', []):
+        job = jobs.get(job_id)
+        if job is None or job["status"] != "succeeded":
+            return jsonify({"error": f"No finished job: {job_id}"}), 404
+        paths.append(job["output_path"])
+    if not paths:
+        return jsonify({"error": "Expected a non-empty 'paths' or 'job_ids' list"}), 400
+    if len(paths) > config["stats"]["max_paths"]:
+        return jsonify({"error": f"At most {config['stats']['max_paths']} files per request"}), 400
+
+    start = time.perf_counter()
+    results = batch_statistics(paths, get_stats_pool())
+    return jsonify({"results": results, "seconds": time.perf_counter() - start})
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # The reloader would start a second process with its own copy of the model
+    app.run(debug=True, use_reloader=False)
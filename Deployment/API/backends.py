@@ -0,0 +1,161 @@
+import json
+import os
+
+import torch
+from monai.networks.nets import UNet
+
+# Exported artifact suffix per backend; "eager" runs the checkpoint directly
+ARTIFACTS = {
+    "torchscript": ".ts",
+    "onnx": ".onnx",
+    "onnx_int8_dynamic": ".int8-dynamic.onnx",
+    "onnx_int8_static": ".int8-static.onnx",
+}
+BACKENDS = ("eager",) + tuple(ARTIFACTS)
+
+DEFAULT_RUNTIME = {
+    "backend": "eager",
+    # NDHWC activations; helps the oneDNN 3D convolutions on most CPUs
+    "channels_last": False,
+    # 0 keeps the library default (one thread per physical core)
+    "intra_op_threads": 0,
+    "inter_op_threads": 0,
+    "export_dir": "exports",
+}
+
+
+def build_model():
+    """
+    3D UNet over the four stacked modalities (T1, T1ce, T2, FLAIR),
+    same architecture as src/model.py
+    """
+    return UNet(
+        spatial_dims=3,
+        in_channels=4,
+        out_channels=4,
+        channels=(32, 64, 128, 256, 512),
+        strides=(2, 2, 2, 2),
+        num_res_units=2
+    )
+
+
+def load_eager_model(model_path, device="cpu"):
+    model = build_model().to(device)
+    model.load_state_dict(torch.load(model_path, map_location=device, weights_only=True))
+    model.eval()
+    return model
+
+
+def artifact_path(model_path, backend, export_dir, channels_last=False):
+    """
+    exports/Brain_30.int8-static.onnx and the like. Memory format is baked
+    into a traced TorchScript graph, so channels-last gets its own file.
+    """
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    suffix = ARTIFACTS[backend]
+    if backend == "torchscript" and channels_last:
+        suffix = ".channels-last" + suffix
+    return os.path.join(export_dir, stem + suffix)
+
+
+def write_export_info(path, weights_digest, **info):
+    with open(path + ".json", "w") as f:
+        json.dump(dict(info, weights_digest=weights_digest), f, indent=2)
+
+
+def check_export(path, weights_digest, model_path, backend):
+    """
+    Raise if an artifact is missing or was exported from other weights, so a
+    hot-reloaded checkpoint never runs against a stale export
+    """
+    try:
+        with open(path + ".json") as f:
+            exported_from = json.load(f)["weights_digest"]
+    except (OSError, ValueError, KeyError):
+        exported_from = None
+    if not os.path.exists(path) or exported_from != weights_digest:
+        raise ValueError(
+            f"{path} is missing or was exported from other weights; "
+            f"run: python export.py --model {model_path} --backends {backend}"
+        )
+
+
+def configure_threads(runtime):
+    """
+    Apply intra-/inter-op thread counts to torch. Call once per process,
+    before the first forward pass: torch only accepts the inter-op count
+    before any parallel work has run.
+    """
+    runtime = dict(DEFAULT_RUNTIME, **(runtime or {}))
+    if runtime["intra_op_threads"]:
+        torch.set_num_threads(runtime["intra_op_threads"])
+    if runtime["inter_op_threads"]:
+        try:
+            torch.set_num_interop_threads(runtime["inter_op_threads"])
+        except RuntimeError as e:
+            print(f"Could not set inter-op threads: {e}")
+
+
+class TorchBackend:
+    """
+    Eager or TorchScript module; inputs are converted to channels-last-3D
+    when the module was prepared for it
+    """
+    def __init__(self, name, module, channels_last=False):
+        self.name = name
+        self.module = module
+        self.channels_last = channels_last
+
+    def __call__(self, input_data):
+        if self.channels_last:
+            input_data = input_data.contiguous(memory_format=torch.channels_last_3d)
+        return self.module(input_data).contiguous()
+
+
+class OnnxBackend:
+    """
+    ONNX Runtime session on the CPU. Takes and returns torch tensors, so it
+    can be used anywhere the torch model is, including as the predictor of
+    sliding_window_inference.
+    """
+    def __init__(self, name, path, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.name = name
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input_data):
+        array = input_data.detach().to("cpu", torch.float32).contiguous().numpy()
+        output = self.session.run(None, {self.input_name: array})[0]
+        return torch.from_numpy(output).to(input_data.device)
+
+
+def load_backend(model_path, runtime, device, weights_digest):
+    """
+    The callable that maps a (N, 4, 128, 128, 128) batch to logits for the
+    configured backend
+    """
+    runtime = dict(DEFAULT_RUNTIME, **(runtime or {}))
+    backend = runtime["backend"]
+    channels_last = runtime["channels_last"]
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}, expected one of {list(BACKENDS)}")
+
+    if backend == "eager":
+        model = load_eager_model(model_path, device)
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last_3d)
+        return TorchBackend(backend, model, channels_last)
+
+    path = artifact_path(model_path, backend, runtime["export_dir"], channels_last)
+    check_export(path, weights_digest, model_path, backend)
+    if backend == "torchscript":
+        return TorchBackend(backend, torch.jit.load(path, map_location=device), channels_last)
+    return OnnxBackend(backend, path, runtime["intra_op_threads"], runtime["inter_op_threads"])
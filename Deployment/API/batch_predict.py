@@ -0,0 +1,198 @@
+"""
+Offline segmentation of a whole directory tree of BraTS cases.
+
+Every folder under --input that holds the four modalities is a case. Cases
+are split into chunks and run on a pool of worker processes; each worker
+loads the model once, uses cores // workers intra-op threads and prefetches
+the next case's decoding while it runs inference on the current one, so
+the run scales with the number of cores on a CPU-only node.
+
+Masks go to <output>/<case path relative to input>/seg.nii.gz (seg.nii
+with output.compression_level 0 in config.yaml). Masks are written under a
+temporary name and renamed when complete, so an existing mask means the
+case is finished. Re-running the same command skips those cases, which
+makes runs resumable.
+One row per processed case (timings and label statistics) is appended to
+<output>/summary.csv as chunks complete.
+
+Usage: python batch_predict.py --input /data/brats --output predictions --workers 4
+"""
+import argparse
+import csv
+import multiprocessing as mp
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import nibabel as nib
+import yaml
+
+from backends import configure_threads
+from encoding import mask_filename, output_options
+from segmentation import BrainTumorSegmentation, get_brats_scan_paths
+from stats import LABEL_NAMES, segmentation_statistics
+
+STAGES = ["decode", "transform", "preprocess", "inference", "save", "stats", "total"]
+COLUMNS = (["case", "status", "error", "output_path"] + [f"{stage}_seconds" for stage in STAGES]
+           + ["tumor_volume_mm3"]
+           + [f"{name}_{field}" for name in LABEL_NAMES.values() for field in ("voxels", "volume_mm3", "components")])
+
+
+def discover_cases(input_root):
+    """
+    Folders under input_root (sorted) in which get_brats_scan_paths() finds
+    all four modalities
+    """
+    cases = []
+    for folder, _, files in os.walk(input_root):
+        if not any(file.endswith(".nii.gz") for file in files):
+            continue
+        try:
+            get_brats_scan_paths(folder)
+        except ValueError:
+            continue
+        cases.append(folder)
+    return sorted(cases)
+
+
+def mask_path(case, input_root, output_root, name="seg.nii.gz"):
+    return os.path.join(output_root, os.path.relpath(case, input_root), name)
+
+
+# One model per worker process, built by init_worker
+_segmenter = None
+_components = False
+_output = None
+
+def init_worker(model_path, inference, runtime, threads, components, output=None):
+    global _segmenter, _components, _output
+    # This worker's share of the cores, for torch and ONNX Runtime alike
+    runtime = dict(runtime or {}, intra_op_threads=threads)
+    configure_threads(runtime)
+    _segmenter = BrainTumorSegmentation(model_path, inference=inference, runtime=runtime)
+    _segmenter.warmup()
+    _components = components
+    # Compression threads come out of this worker's share as well
+    _output = output_options(output)
+    _output["compression_threads"] = min(threads, _output["compression_threads"])
+
+
+def save_mask(mask, output_path, reference_scan):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(output_path), f".partial-{os.getpid()}-{os.path.basename(output_path)}")
+    _segmenter.save_prediction(mask, tmp_path, reference_scan,
+                               _output["compression_level"], _output["compression_threads"])
+    os.replace(tmp_path, output_path)
+
+
+def run_chunk(cases, output_paths):
+    """
+    Segment a chunk of cases in this worker, decoding case i + 1 while case
+    i is inferred. Returns one summary row per case; failures are recorded
+    instead of raised so one bad case does not lose the rest of the chunk.
+    """
+    rows = []
+    outputs = dict(zip(cases, output_paths))
+    for case, future in _segmenter.prefetch(cases):
+        start = time.perf_counter()
+        row = {"case": case, "output_path": outputs[case]}
+        try:
+            file_paths, input_data, geometry, timings = future.result()
+            inferred = time.perf_counter()
+            mask = _segmenter.infer_batch([input_data], [geometry])[0]
+            timings["inference"] = time.perf_counter() - inferred
+
+            saved = time.perf_counter()
+            save_mask(mask, outputs[case], file_paths[0])
+            timings["save"] = time.perf_counter() - saved
+
+            counted = time.perf_counter()
+            header = nib.load(file_paths[0]).header
+            stats = segmentation_statistics(mask, header.get_zooms()[:3], components=_components)
+            timings["stats"] = time.perf_counter() - counted
+            # Wall time this case held the worker; decoding that overlapped
+            # the previous case's inference is not counted again
+            timings["total"] = time.perf_counter() - start
+
+            row["status"] = "done"
+            row.update({f"{stage}_seconds": round(timings[stage], 4) for stage in STAGES})
+            row["tumor_volume_mm3"] = stats["tumor_volume_mm3"]
+            for label, name in LABEL_NAMES.items():
+                entry = stats["labels"][str(label)]
+                row[f"{name}_voxels"] = entry["voxels"]
+                row[f"{name}_volume_mm3"] = entry["volume_mm3"]
+                row[f"{name}_components"] = entry["components"] if _components else ""
+        except Exception as e:
+            traceback.print_exc()
+            row["status"] = "failed"
+            row["error"] = str(e)
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment every BraTS case under a directory")
+    parser.add_argument("--input", required=True, help="Root folder searched for BraTS cases")
+    parser.add_argument("--output", required=True, help="Root folder for masks and summary.csv")
+    parser.add_argument("--model", default=None, help="Checkpoint (default: model.path in config.yaml)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: cores // 4)")
+    parser.add_argument("--chunk_size", type=int, default=8, help="Cases per task")
+    parser.add_argument("--components", action="store_true", help="Also count connected components")
+    parser.add_argument("--limit", type=int, default=None, help="Only the first N pending cases")
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open("config.yaml"))
+    model_path = args.model or config["model"]["path"]
+    cores = os.cpu_count() or 1
+    workers = args.workers or max(1, cores // 4)
+    threads = max(1, cores // workers)
+    name = mask_filename(config.get("output"))
+
+    cases = discover_cases(args.input)
+    pending = [case for case in cases if not os.path.exists(mask_path(case, args.input, args.output, name))]
+    if args.limit is not None:
+        pending = pending[:args.limit]
+    print(f"Found {len(cases)} cases, {len(cases) - len(pending)} already done, {len(pending)} to run "
+          f"on {workers} workers x {threads} threads")
+    if not pending:
+        return
+
+    os.makedirs(args.output, exist_ok=True)
+    summary_path = os.path.join(args.output, "summary.csv")
+    write_header = not os.path.exists(summary_path)
+
+    start = time.perf_counter()
+    done = failed = 0
+    with open(summary_path, "a", newline="") as f, ProcessPoolExecutor(
+        max_workers=workers,
+        # Spawned workers do not inherit this process's torch thread pools
+        mp_context=mp.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(model_path, config.get("inference"), config.get("runtime"), threads, args.components,
+                  config.get("output"))
+    ) as pool:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, restval="")
+        if write_header:
+            writer.writeheader()
+
+        chunks = [pending[i:i + args.chunk_size] for i in range(0, len(pending), args.chunk_size)]
+        futures = [
+            pool.submit(run_chunk, chunk, [mask_path(case, args.input, args.output, name) for case in chunk])
+            for chunk in chunks
+        ]
+        for future in as_completed(futures):
+            rows = future.result()
+            writer.writerows(rows)
+            f.flush()
+            done += sum(1 for row in rows if row["status"] == "done")
+            failed += sum(1 for row in rows if row["status"] == "failed")
+            elapsed = time.perf_counter() - start
+            print(f"{done + failed}/{len(pending)} cases ({failed} failed), "
+                  f"{(done + failed) / elapsed:.2f} cases/s")
+
+    print(f"Finished in {time.perf_counter() - start:.1f}s: {done} done, {failed} failed. Summary: {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
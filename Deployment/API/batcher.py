@@ -0,0 +1,153 @@
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+class BatchScheduler:
+    """
+    Gathers concurrent inference requests into batches.
+
+    A batch is closed when it reaches max_batch_size or when the oldest request
+    in it has waited max_wait_ms, then forward_fn is called once with the list
+    of inputs and must return one result per input. The queue holds at most
+    max_queue requests; submit() raises QueueFull beyond that so callers can
+    shed load instead of piling up.
+    """
+    def __init__(self, forward_fn, max_batch_size=4, max_wait_ms=50, max_queue=16):
+        self.forward_fn = forward_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue = max_queue
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        # Held while checking _stop and queueing, so nothing is queued after stop()
+        self._submit_lock = threading.Lock()
+        self._drain = False
+        self._thread = None
+
+        self._stats_lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batch_sizes = Counter()
+        self.queue_waits = deque(maxlen=1000)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, drain=False, timeout=None):
+        """
+        Stop the scheduler thread. With drain=True, requests that are already
+        queued still run and this waits (up to timeout) for them; new
+        requests are rejected either way. Requests still queued after that
+        (all of them without drain) fail with QueueFull, so no caller waits
+        on a future that will never complete.
+        """
+        with self._submit_lock:
+            self._drain = drain
+            self._stop.set()
+        if drain and self._thread is not None:
+            self._thread.join(timeout)
+        # Past the timeout the thread finishes its current batch and exits
+        self._drain = False
+        self._fail_pending()
+
+    def submit(self, item):
+        """
+        Queue one input and return a Future that resolves to its result
+        """
+        future = Future()
+        with self._submit_lock:
+            if self._stop.is_set():
+                raise QueueFull("Inference queue is shutting down")
+            try:
+                self._queue.put_nowait((item, future, time.perf_counter()))
+            except queue.Full:
+                with self._stats_lock:
+                    self.rejected += 1
+                raise QueueFull(f"Inference queue is full ({self.max_queue} requests waiting)")
+        with self._stats_lock:
+            self.submitted += 1
+        return future
+
+    def _next_batch(self):
+        try:
+            first = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set() or (self._drain and not self._queue.empty()):
+            batch = self._next_batch()
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            with self._stats_lock:
+                self.batches += 1
+                self.batch_sizes[len(batch)] += 1
+                self.queue_waits.extend(started - enqueued for _, _, enqueued in batch)
+
+            items = [item for item, _, _ in batch]
+            try:
+                results = list(self.forward_fn(items))
+                if len(results) != len(batch):
+                    raise RuntimeError(f"forward_fn returned {len(results)} results for a batch of {len(batch)}")
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+        self._fail_pending()
+
+    def _fail_pending(self):
+        while True:
+            try:
+                _, future, _ = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            future.set_exception(QueueFull("Inference queue is shutting down"))
+
+    def stats(self):
+        with self._stats_lock:
+            waits = np.array(self.queue_waits) * 1000.0
+            items = sum(size * count for size, count in self.batch_sizes.items())
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue": self.max_queue,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "mean_batch_size": items / self.batches if self.batches else None,
+                "batch_size_counts": dict(sorted(self.batch_sizes.items())),
+                "queue_wait_ms": {
+                    "p50": float(np.percentile(waits, 50)) if len(waits) else None,
+                    "p95": float(np.percentile(waits, 95)) if len(waits) else None,
+                    "max": float(waits.max()) if len(waits) else None,
+                },
+            }
@@ -0,0 +1,92 @@
+"""
+Latency and peak RSS of each inference backend on CPU.
+
+Each backend runs in its own process so that ru_maxrss and the thread
+settings are not shared. Exports are built first for the checkpoint
+(random weights if it does not exist, which is fine for timing).
+
+Usage: python bench_backends.py --repeats 5 --intra_op_threads 8 [--channels_last]
+"""
+import os
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import multiprocessing as mp
+import resource
+import statistics
+import tempfile
+import time
+
+from backends import BACKENDS
+from bench_engine import random_checkpoint
+
+
+def run_backend(model_path, patient_folder, inference, runtime, repeats, queue):
+    from backends import configure_threads
+    from segmentation import BrainTumorSegmentation
+
+    configure_threads(runtime)
+    segmenter = BrainTumorSegmentation(model_path, inference, runtime)
+    segmenter.warmup()
+    input_data, geometry = segmenter.preprocess_scan(segmenter.get_brats_scan_paths(patient_folder))
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        segmenter.infer_batch([input_data], [geometry])
+        latencies.append(time.perf_counter() - start)
+    queue.put({
+        "mean": statistics.mean(latencies),
+        "median": statistics.median(latencies),
+        "min": min(latencies),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="Brain_30.pt")
+    parser.add_argument("--patient_folder", default="BraTS2021_00000/Paitent 1")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument("--mode", default="resize", choices=["resize", "sliding_window"])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--intra_op_threads", type=int, default=0)
+    parser.add_argument("--inter_op_threads", type=int, default=0)
+    parser.add_argument("--channels_last", action="store_true")
+    parser.add_argument("--calibration", nargs="*", default=None,
+                        help="Folders for static int8 calibration (default: --patient_folder)")
+    args = parser.parse_args()
+
+    model_path = args.model
+    if not os.path.exists(model_path):
+        model_path = random_checkpoint(os.path.join(tempfile.mkdtemp(), "random.pt"))
+        print(f"{args.model} not found, using random weights from {model_path}")
+
+    export_dir = tempfile.mkdtemp(prefix="exports-")
+    exported = [backend for backend in args.backends if backend != "eager"]
+    if exported:
+        from export import export
+        export(model_path, exported, export_dir, args.channels_last,
+               args.calibration if args.calibration is not None else [args.patient_folder])
+
+    ctx = mp.get_context("spawn")
+    for backend in args.backends:
+        runtime = {
+            "backend": backend,
+            "channels_last": args.channels_last,
+            "intra_op_threads": args.intra_op_threads,
+            "inter_op_threads": args.inter_op_threads,
+            "export_dir": export_dir,
+        }
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_backend, args=(model_path, args.patient_folder, {"mode": args.mode},
+                                                        runtime, args.repeats, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        print(f"{backend:>17}: mean {result['mean']:.3f}s  median {result['median']:.3f}s  "
+              f"min {result['min']:.3f}s  peak RSS {result['peak_rss_mb']:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Size and time of each way a mask can leave the server, with a round-trip
+check of every one.
+
+Files: int64 NIfTI through nib.save (how masks used to be written), uint8
+NIfTI uncompressed, gzip at several levels and multi-threaded gzip.
+Responses: the rle and bbox encodings as JSON. Every output is read back
+(files with nibabel, responses with decode_mask) and compared with the
+original mask; the script exits with status 1 if any differ.
+
+The mask is --mask if given, otherwise a synthetic 240x240x155 volume with
+a nested three-label tumor. --reference supplies the header and affine;
+without it a blank reference scan is written to a temporary folder.
+
+Usage: python bench_encoding.py --mask current_predictions/seg.nii.gz --reference "BraTS2021_00000/Paitent 1/t1.nii.gz"
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+from encoding import decode_mask, encode_mask, load_mask, save_mask
+
+
+def synthetic_mask(shape=(240, 240, 155)):
+    """
+    Ellipsoidal tumor around 1% of the volume: edema around a necrotic
+    core with an enhancing rim
+    """
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij"))
+    radius = np.sqrt(((grid - np.array([0.2, -0.1, 0.0])[:, None, None, None]) ** 2
+                      / np.array([0.25, 0.2, 0.3])[:, None, None, None] ** 2).sum(axis=0))
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[radius < 1.0] = 2
+    mask[radius < 0.6] = 3
+    mask[radius < 0.45] = 1
+    return mask
+
+
+def timed(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return result, float(np.median(times)) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mask", default=None)
+    parser.add_argument("--reference", default=None)
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    mask = load_mask(args.mask) if args.mask else synthetic_mask()
+    print(f"Mask {mask.shape}, {np.count_nonzero(mask) / mask.size:.2%} foreground")
+
+    failures = []
+    with tempfile.TemporaryDirectory() as folder:
+        reference = args.reference
+        if reference is None:
+            reference = os.path.join(folder, "reference.nii.gz")
+            nib.save(nib.Nifti1Image(np.zeros(mask.shape, dtype=np.float32), np.eye(4)), reference)
+
+        def legacy(path):
+            # The previous save_prediction with an int64 mask and the reference
+            # header; nibabel >= 5 refuses int64 data without a header or dtype
+            scan = nib.load(reference)
+            image = nib.Nifti1Image(mask.astype(np.int64), scan.affine, scan.header)
+            image.set_data_dtype(np.int64)
+            nib.save(image, path)
+
+        files = {
+            "int64 nib.save .nii.gz": ("legacy.nii.gz", legacy),
+            "uint8 .nii": ("plain.nii", lambda path: save_mask(mask, path, reference, 0)),
+        }
+        for level in (1, 6, 9):
+            files[f"uint8 gzip {level}"] = (f"level{level}.nii.gz",
+                                            lambda path, level=level: save_mask(mask, path, reference, level))
+        files[f"uint8 gzip 1 x{args.threads} threads"] = (
+            "threaded.nii.gz", lambda path: save_mask(mask, path, reference, 1, args.threads))
+
+        print(f"{'output':32s} {'size KB':>10s} {'write ms':>10s} {'read ms':>10s}  round trip")
+        for name, (filename, write) in files.items():
+            path = os.path.join(folder, filename)
+            _, write_ms = timed(lambda: write(path), args.repeats)
+            restored, read_ms = timed(lambda: load_mask(path), args.repeats)
+            ok = np.array_equal(restored, mask)
+            if not ok:
+                failures.append(name)
+            print(f"{name:32s} {os.path.getsize(path) / 1024:10.1f} {write_ms:10.1f} {read_ms:10.1f}  "
+                  f"{'ok' if ok else 'MISMATCH'}")
+
+        for encoding in ("rle", "bbox"):
+            body, encode_ms = timed(lambda: json.dumps(encode_mask(mask, encoding)), args.repeats)
+            restored, decode_ms = timed(lambda: decode_mask(json.loads(body)), args.repeats)
+            ok = np.array_equal(restored, mask)
+            if not ok:
+                failures.append(encoding)
+            print(f"{'response ' + encoding:32s} {len(body) / 1024:10.1f} {encode_ms:10.1f} {decode_ms:10.1f}  "
+                  f"{'ok' if ok else 'MISMATCH'}")
+
+    # An empty mask must survive both encodings as well
+    empty = np.zeros((8, 8, 8), dtype=np.uint8)
+    for encoding in ("rle", "bbox"):
+        if not np.array_equal(decode_mask(json.loads(json.dumps(encode_mask(empty, encoding)))), empty):
+            failures.append(f"empty {encoding}")
+
+    if failures:
+        print(f"Round trip failed for: {failures}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Cold vs warm per-request latency of the /predict pipeline on CPU.
+
+cold: build BrainTumorSegmentation for every request (the old behaviour)
+warm: one InferenceEngine, loaded and warmed up once
+
+Usage: python bench_engine.py --requests 5 [--model Brain_30.pt]
+If the checkpoint does not exist a randomly initialised one is used,
+which is fine for timing.
+"""
+import os
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import torch
+
+from backends import build_model
+from engine import InferenceEngine
+from segmentation import BrainTumorSegmentation
+
+
+def random_checkpoint(path):
+    torch.save(build_model().state_dict(), path)
+    return path
+
+
+def summarize(name, timings):
+    print(f"{name:>5}: mean {statistics.mean(timings):.3f}s  "
+          f"median {statistics.median(timings):.3f}s  "
+          f"min {min(timings):.3f}s  max {max(timings):.3f}s  (n={len(timings)})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="Brain_30.pt")
+    parser.add_argument("--patient_folder", default="BraTS2021_00000/Paitent 1")
+    parser.add_argument("--requests", type=int, default=5)
+    args = parser.parse_args()
+
+    model_path = args.model
+    if not os.path.exists(model_path):
+        model_path = random_checkpoint(os.path.join(tempfile.mkdtemp(), "random.pt"))
+        print(f"{args.model} not found, using random weights from {model_path}")
+
+    cold = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        segmenter = BrainTumorSegmentation(model_path)
+        segmenter.predict(args.patient_folder)
+        cold.append(time.perf_counter() - start)
+
+    engine = InferenceEngine(model_path, warmup=True, reload_interval=0)
+    start = time.perf_counter()
+    engine.load()
+    print(f"engine startup (load + warmup): {time.perf_counter() - start:.3f}s")
+
+    warm = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        engine.get().predict(args.patient_folder)
+        warm.append(time.perf_counter() - start)
+
+    summarize("cold", cold)
+    summarize("warm", warm)
+    print(f"speedup (median): {statistics.median(cold) / statistics.median(warm):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Offscreen frame-time benchmark for the modality surfaces at each level
+of detail, rendered the way visual.py draws them (four surfaces at 0.3
+opacity, depth-sorted transparency).
+
+Usage: python bench_lod.py --patient_folder "BraTS2021_00000/Paitent 1" --frames 60
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pyvista as pv
+
+from lod import LOD_TARGETS, lod_levels
+from meshing import modality_mesh
+
+MODALITY_FILES = ("t1.nii.gz", "t1ce.nii.gz", "t2.nii.gz", "flair.nii.gz")
+
+
+def frame_times(meshes, frames, window_size):
+    plotter = pv.Plotter(off_screen=True, window_size=window_size)
+    plotter.set_background("black")
+    for mesh in meshes:
+        plotter.add_mesh(mesh, color="#8B4513", opacity=0.3)
+    plotter.show(auto_close=False)
+
+    times = []
+    for _ in range(frames):
+        plotter.camera.azimuth += 360.0 / frames
+        start = time.perf_counter()
+        plotter.render()
+        times.append(time.perf_counter() - start)
+    plotter.close()
+    return np.array(times) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patient_folder", default="BraTS2021_00000/Paitent 1")
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    args = parser.parse_args()
+
+    paths = [os.path.join(args.patient_folder, name) for name in MODALITY_FILES]
+    levels = {}
+    for path in paths:
+        for target, mesh in lod_levels(path):
+            levels.setdefault(target, []).append(mesh)
+    levels["full"] = [modality_mesh(path) for path in paths]
+
+    for target in list(LOD_TARGETS) + ["full"]:
+        meshes = levels[target]
+        triangles = sum(mesh.n_cells for mesh in meshes)
+        times = frame_times(meshes, args.frames, (args.width, args.height))
+        print(f"{str(target):>8}: {triangles:>10,} triangles  "
+              f"mean {times.mean():.1f} ms  p95 {np.percentile(times, 95):.1f} ms  "
+              f"({1000.0 / times.mean():.1f} fps)")
+
+
+if __name__ == "__main__":
+    main()
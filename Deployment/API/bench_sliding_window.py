@@ -0,0 +1,79 @@
+"""
+Throughput and peak RSS of the resize path vs native-resolution
+sliding-window inference on CPU.
+
+Each mode runs in its own process so that ru_maxrss is not shared.
+
+Usage: python bench_sliding_window.py --repeats 3 --overlap 0.25 --memory_budget_mb 2048
+"""
+import os
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import multiprocessing as mp
+import resource
+import tempfile
+import time
+
+from bench_engine import random_checkpoint
+
+
+def run_mode(model_path, patient_folder, inference, repeats, queue):
+    from segmentation import BrainTumorSegmentation
+
+    segmenter = BrainTumorSegmentation(model_path, inference)
+    segmenter.warmup()
+    # Decode once, only the inference path differs between modes
+    file_paths = segmenter.get_brats_scan_paths(patient_folder)
+    input_data, geometry = segmenter.preprocess_scan(file_paths)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        mask = segmenter.infer_batch([input_data], [geometry])[0]
+    elapsed = time.perf_counter() - start
+    queue.put({
+        "seconds_per_case": elapsed / repeats,
+        "cases_per_minute": 60.0 * repeats / elapsed,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "input_shape": tuple(input_data.shape),
+        "mask_shape": mask.shape,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="Brain_30.pt")
+    parser.add_argument("--patient_folder", default="BraTS2021_00000/Paitent 1")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--overlap", type=float, default=0.25)
+    parser.add_argument("--memory_budget_mb", type=int, default=2048)
+    args = parser.parse_args()
+
+    model_path = args.model
+    if not os.path.exists(model_path):
+        model_path = random_checkpoint(os.path.join(tempfile.mkdtemp(), "random.pt"))
+        print(f"{args.model} not found, using random weights from {model_path}")
+
+    modes = {
+        "resize": {"mode": "resize"},
+        "sliding_window": {
+            "mode": "sliding_window",
+            "overlap": args.overlap,
+            "memory_budget_mb": args.memory_budget_mb,
+        },
+    }
+    ctx = mp.get_context("spawn")
+    for name, inference in modes.items():
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_mode, args=(model_path, args.patient_folder, inference, args.repeats, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        print(f"{name:>14}: {result['seconds_per_case']:.2f}s/case  "
+              f"{result['cases_per_minute']:.2f} cases/min  "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB  "
+              f"input {result['input_shape']} -> mask {result['mask_shape']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_fingerprint(path):
+    """
+    Cheap identity of a file's current version: (absolute path, size, mtime)
+    """
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def file_digest(path):
+    """
+    Content hash of a file, memoised on (path, size, mtime) so an unchanged
+    file is only read once per process
+    """
+    fingerprint = file_fingerprint(path)
+    with _digests_lock:
+        digest = _digests.get(fingerprint)
+    if digest is not None:
+        return digest
+
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _digests_lock:
+        _digests[fingerprint] = digest
+    return digest
+
+
+def make_key(*parts):
+    """
+    Stable cache key from JSON-serialisable parts (digests, transform parameters, ...)
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(payload, digest_size=20).hexdigest()
+
+
+class VolumeCache:
+    """
+    Content-addressed cache of numpy arrays with a small JSON metadata dict.
+
+    Tier 1 is an in-memory LRU bounded by memory_budget_mb. Tier 2 is a
+    directory of uncompressed .npy files that are opened memory-mapped, so a
+    hit never goes through gzip. The disk tier is not size-limited; clear the
+    directory to reclaim space.
+
+    Disk hits are kept in the LRU as well, but their pages belong to the OS
+    page cache rather than this process, so they do not count against
+    memory_budget_mb; at most max_mapped_entries of them are kept.
+    """
+    def __init__(self, directory, memory_budget_mb=2048, max_mapped_entries=256):
+        self.directory = directory
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.max_mapped_entries = max_mapped_entries
+        os.makedirs(directory, exist_ok=True)
+
+        # key -> (array, meta, bytes counted against the budget, memory-mapped)
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._mapped_entries = 0
+        self._mapped_bytes = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _paths(self, key):
+        folder = os.path.join(self.directory, key[:2])
+        return os.path.join(folder, f"{key}.npy"), os.path.join(folder, f"{key}.json")
+
+    def get(self, key):
+        """
+        Return (array, meta) or None. Disk hits are memory-mapped read-only.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0], entry[1]
+
+        array_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            array = np.load(array_path, mmap_mode="r")
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+        self._remember(key, array, meta)
+        return array, meta
+
+    def put(self, key, array, meta=None):
+        meta = meta or {}
+        array = np.ascontiguousarray(array)
+        array_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(array_path), exist_ok=True)
+
+        # Write to a temp file and rename so readers never see a partial file;
+        # the metadata goes last because get() treats it as the commit marker
+        for path, write in (
+            (array_path, lambda f: np.save(f, array)),
+            (meta_path, lambda f: f.write(json.dumps(meta).encode())),
+        ):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    write(f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+        self._remember(key, array, meta)
+
+    def _remember(self, key, array, meta):
+        mapped = isinstance(array, np.memmap)
+        nbytes = 0 if mapped else array.nbytes
+        if nbytes > self.memory_budget:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._forget(self._memory.pop(key))
+            self._memory[key] = (array, meta, nbytes, mapped)
+            self._memory_bytes += nbytes
+            if mapped:
+                self._mapped_entries += 1
+                self._mapped_bytes += array.nbytes
+            # Each limit only evicts the entries it counts
+            while self._memory_bytes > self.memory_budget:
+                self._evict_oldest(mapped=False)
+            while self._mapped_entries > self.max_mapped_entries:
+                self._evict_oldest(mapped=True)
+
+    def _evict_oldest(self, mapped):
+        key = next(key for key, entry in self._memory.items() if entry[3] == mapped)
+        self._forget(self._memory.pop(key))
+        self.evictions += 1
+
+    def _forget(self, entry):
+        array, _, nbytes, mapped = entry
+        self._memory_bytes -= nbytes
+        if mapped:
+            self._mapped_entries -= 1
+            self._mapped_bytes -= array.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "mapped_entries": self._mapped_entries,
+                "mapped_bytes": self._mapped_bytes,
+                "memory_budget_bytes": self.memory_budget,
+            }
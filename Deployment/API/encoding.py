@@ -0,0 +1,165 @@
+"""
+Writing masks to disk and encoding them for API responses.
+
+A mask is a uint8 volume of labels 0-3 that is almost all background.
+Stored as uint8 it is an eighth of the int64 NIfTI nibabel writes by
+default, and gzip compresses it in one fast pass at level 1. Large files
+are split into blocks that are compressed on several threads (zlib
+releases the GIL) and written as concatenated gzip members, which every
+gzip reader, nibabel included, reads back as a single stream.
+
+In a response the mask is sent as either:
+    rle   runs of non-zero voxels in C order: starts, lengths, values
+    bbox  the bounding box of the tumor and the zlib-compressed uint8
+          voxels inside it (base64)
+decode_mask() turns both back into the full volume.
+"""
+import base64
+import gzip
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+DEFAULT_OUTPUT = {
+    # gzip level 1-9 for seg.nii.gz; 0 or null writes an uncompressed seg.nii
+    "compression_level": 1,
+    # Threads compressing independent gzip members; 1 writes a single member
+    "compression_threads": 1,
+    # Mask included in the /predict response: none, rle or bbox
+    "response_encoding": "none",
+}
+ENCODINGS = ("none", "rle", "bbox")
+# Data below this size is compressed on the calling thread
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def output_options(output=None):
+    return dict(DEFAULT_OUTPUT, **(output or {}))
+
+
+def mask_filename(output=None):
+    return "seg.nii.gz" if output_options(output)["compression_level"] else "seg.nii"
+
+
+def gzip_bytes(data, level=1, threads=1, block_size=GZIP_BLOCK_SIZE):
+    """
+    gzip `data`, splitting it into block_size members compressed in parallel
+    when threads > 1. mtime is fixed so the same mask gives the same file.
+    """
+    view = memoryview(data)
+    if threads <= 1 or len(view) <= block_size:
+        return gzip.compress(view, compresslevel=level, mtime=0)
+    blocks = [view[i:i + block_size] for i in range(0, len(view), block_size)]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        members = pool.map(lambda block: gzip.compress(block, compresslevel=level, mtime=0), blocks)
+        return b"".join(members)
+
+
+def nifti_bytes(mask, reference_scan):
+    """
+    Single-file NIfTI of `mask` as uint8, with the reference scan's affine
+    and header (minus any intensity scaling). reference_scan is a path, or
+    the header of a scan that was never written to disk (see upload.py).
+    """
+    if isinstance(reference_scan, nib.Nifti1Header):
+        header = reference_scan
+        affine = header.get_best_affine()
+    else:
+        reference = nib.load(reference_scan)
+        header, affine = reference.header, reference.affine
+    image = nib.Nifti1Image(np.asarray(mask, dtype=np.uint8), affine, header)
+    image.set_data_dtype(np.uint8)
+    image.header.set_slope_inter(1, 0)
+    return image.to_bytes()
+
+
+def save_mask(mask, output_path, reference_scan, compression_level=1, compression_threads=1):
+    """
+    Write `mask` as uint8 NIfTI; gzip-compressed if output_path ends in .gz
+    """
+    data = nifti_bytes(mask, reference_scan)
+    if output_path.endswith(".gz"):
+        data = gzip_bytes(data, level=compression_level or 0, threads=compression_threads)
+    with open(output_path, "wb") as f:
+        f.write(data)
+    return len(data)
+
+
+def load_mask(path):
+    return np.asanyarray(nib.load(path).dataobj).astype(np.uint8, copy=False)
+
+
+def encode_rle(mask):
+    flat = np.ascontiguousarray(mask).reshape(-1)
+    # Run boundaries: every index where the label changes
+    edges = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], edges))
+    lengths = np.diff(np.concatenate((starts, [flat.size])))
+    values = flat[starts]
+    foreground = values != 0
+    return {
+        "encoding": "rle",
+        "shape": list(mask.shape),
+        "order": "C",
+        "starts": starts[foreground].tolist(),
+        "lengths": lengths[foreground].tolist(),
+        "values": values[foreground].tolist(),
+    }
+
+
+def encode_bbox(mask, level=6):
+    foreground = mask != 0
+    bbox = None
+    data = b""
+    if foreground.any():
+        bbox = []
+        for axis in range(mask.ndim):
+            other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+            nonzero = np.flatnonzero(foreground.any(axis=other_axes))
+            bbox.append([int(nonzero[0]), int(nonzero[-1]) + 1])
+        crop = mask[tuple(slice(start, end) for start, end in bbox)]
+        data = zlib.compress(np.ascontiguousarray(crop, dtype=np.uint8).tobytes(), level)
+    return {
+        "encoding": "bbox",
+        "shape": list(mask.shape),
+        "bbox": bbox,
+        "dtype": "uint8",
+        "order": "C",
+        "compression": "zlib",
+        "data": base64.b64encode(data).decode("ascii"),
+    }
+
+
+def encode_mask(mask, encoding):
+    """
+    JSON-serialisable form of `mask`, or None for encoding "none"
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown mask encoding: {encoding}, expected one of {list(ENCODINGS)}")
+    if encoding == "rle":
+        return encode_rle(mask)
+    if encoding == "bbox":
+        return encode_bbox(mask)
+    return None
+
+
+def decode_mask(payload):
+    """
+    Full uint8 volume from an encode_mask() payload
+    """
+    mask = np.zeros(payload["shape"], dtype=np.uint8)
+    if payload["encoding"] == "rle":
+        flat = mask.reshape(-1)
+        for start, length, value in zip(payload["starts"], payload["lengths"], payload["values"]):
+            flat[start:start + length] = value
+    elif payload["encoding"] == "bbox":
+        if payload["bbox"] is not None:
+            box = tuple(slice(start, end) for start, end in payload["bbox"])
+            crop_shape = tuple(end - start for start, end in payload["bbox"])
+            data = zlib.decompress(base64.b64decode(payload["data"]))
+            mask[box] = np.frombuffer(data, dtype=np.uint8).reshape(crop_shape)
+    else:
+        raise ValueError(f"Unknown mask encoding: {payload['encoding']}")
+    return mask
@@ -0,0 +1,288 @@
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+from batcher import BatchScheduler
+from cache import VolumeCache, file_digest, make_key
+from segmentation import BrainTumorSegmentation, get_brats_scan_paths
+from tta import DEFAULT_TTA, TTAEnsemble
+
+
+class EngineNotReady(RuntimeError):
+    pass
+
+
+class InferenceEngine:
+    """
+    Holds one warm BrainTumorSegmentation per worker process.
+
+    The model is loaded (and warmed up) once in a background thread, and the
+    checkpoint file is polled so a new set of weights is picked up without a
+    restart. Requests keep the segmenter they started with, so a reload never
+    swaps the model out from under an in-flight prediction.
+
+    With a batching config, forward passes go through a BatchScheduler so that
+    concurrent requests share one batched call to the UNet. With a cache config,
+    preprocessed inputs and masks are cached by content, so a repeat request
+    skips decoding and, if the weights are unchanged, inference as well.
+
+    Requests can ask for a slower, more accurate "quality" preset (flip TTA,
+    optionally over an ensemble of checkpoints). Those bypass the batcher and
+    run one at a time, so fast requests keep going through the batched path.
+    """
+    def __init__(self, model_path, warmup=True, reload_interval=5.0, batching=None, inference=None,
+                 cache=None, runtime=None, tta=None):
+        self.model_path = model_path
+        self.inference = inference
+        self.runtime = runtime
+        self.tta = tta or {}
+        self.cache_config = cache
+
+        self.cache = None
+        if cache and cache.get("enabled", True):
+            self.cache = VolumeCache(cache["directory"], memory_budget_mb=cache.get("memory_budget_mb", 2048))
+        self.warmup = warmup
+        self.reload_interval = reload_interval
+
+        self.batcher = None
+        if batching and batching.get("enabled", True):
+            self.batcher = BatchScheduler(
+                self._forward_batch,
+                max_batch_size=batching.get("max_batch_size", 4),
+                max_wait_ms=batching.get("max_wait_ms", 50),
+                max_queue=batching.get("max_queue", 16)
+            )
+
+        self.segmenter = None
+        self.loaded_mtime = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.reloads = 0
+        self.error = None
+
+        self._lock = threading.Lock()
+        self._infer_lock = threading.Lock()
+        self._tta_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.segmenter is not None
+
+    def load(self, warmup=None):
+        """
+        Build a new segmenter from the checkpoint and swap it in. warmup
+        overrides the engine's setting, e.g. to load weights in a pre-fork
+        master without starting torch's thread pool there.
+        """
+        warmup = self.warmup if warmup is None else warmup
+        mtime = os.path.getmtime(self.model_path)
+        start = time.perf_counter()
+        segmenter = BrainTumorSegmentation(self.model_path, self.inference, self.runtime)
+        load_seconds = time.perf_counter() - start
+
+        warmup_seconds = None
+        if warmup:
+            start = time.perf_counter()
+            segmenter.warmup()
+            warmup_seconds = time.perf_counter() - start
+        # Loaded with the segmenter so a reload swaps both together
+        segmenter.ensemble = TTAEnsemble(segmenter, self.tta.get("checkpoints", []))
+
+        with self._lock:
+            if self.segmenter is not None:
+                self.reloads += 1
+            self.segmenter = segmenter
+            self.loaded_mtime = mtime
+            self.load_seconds = load_seconds
+            self.warmup_seconds = warmup_seconds
+            self.error = None
+        print(f"Loaded {self.model_path} in {load_seconds:.2f}s (warmup: {warmup_seconds})")
+
+    def start(self):
+        """
+        Load the model and watch the checkpoint in a background thread.
+        Safe to call again, e.g. in a forked worker where the threads are gone.
+        """
+        if self.batcher is not None:
+            self.batcher.start()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="inference-engine", daemon=True)
+        self._thread.start()
+
+    def stop(self, drain=False, timeout=None):
+        """
+        Stop watching the checkpoint and stop the batcher; with drain=True,
+        requests already queued for the batcher are finished first
+        """
+        self._stop.set()
+        if self.batcher is not None:
+            self.batcher.stop(drain=drain, timeout=timeout)
+
+    def _run(self):
+        if self.segmenter is None:
+            self._try_load()
+        while not self._stop.wait(self.reload_interval if self.reload_interval else None):
+            if self._checkpoint_changed():
+                print(f"Checkpoint {self.model_path} changed, reloading")
+                self._try_load()
+
+    def _try_load(self):
+        try:
+            self.load()
+        except Exception as e:
+            # Keep serving the previous weights (if any) and retry on the next poll
+            self.error = str(e)
+            print(f"Failed to load {self.model_path}: {e}")
+
+    def _checkpoint_changed(self):
+        try:
+            mtime = os.path.getmtime(self.model_path)
+        except OSError:
+            return False
+        return mtime != self.loaded_mtime
+
+    def get(self):
+        """
+        Return the current segmenter, or raise EngineNotReady if it is still loading
+        """
+        segmenter = self.segmenter
+        if segmenter is None:
+            raise EngineNotReady(self.error or "Model is still loading")
+        return segmenter
+
+    def _forward_batch(self, items):
+        inputs, geometries = zip(*items)
+        return self.get().infer_batch(list(inputs), list(geometries))
+
+    def infer(self, input_data, geometry, batched=True):
+        """
+        Run one preprocessed input through the model, batched with other
+        requests when batching is enabled. Raises QueueFull under backpressure.
+        With batched=False the forward pass runs in the calling thread, which
+        is what a per-request profiler needs to see it.
+        """
+        if self.batcher is None or not batched:
+            # One forward pass at a time; other requests keep decoding meanwhile
+            with self._infer_lock:
+                return self.get().infer_batch([input_data], [geometry])[0]
+        return self.batcher.submit((input_data, geometry)).result()
+
+    def tta_options(self, quality=None, overrides=None):
+        """
+        Resolve a quality preset (and per-request overrides) into TTA options,
+        or None for the single forward pass
+        """
+        quality = quality or self.tta.get("default_quality", "fast")
+        presets = self.tta.get("presets", {"fast": {"max_views": 1}})
+        if quality not in presets:
+            raise ValueError(f"Unknown quality: {quality}, expected one of {list(presets)}")
+        options = dict(DEFAULT_TTA, **presets[quality])
+        options.update(overrides or {})
+        unknown = set(options) - set(DEFAULT_TTA)
+        if unknown:
+            raise ValueError(f"Unknown TTA options: {sorted(unknown)}")
+        return options if options["max_views"] > 1 else None
+
+    def predict(self, patient_folder, timings=None, quality=None, tta=None, batched=True, file_paths=None):
+        """
+        Preprocess in the calling thread, then infer. With several callers
+        (HTTP threads or job workers) the next patient's decoding overlaps
+        with the current patient's forward pass. file_paths skips listing
+        the folder again when the caller already has them.
+        """
+        if file_paths is None:
+            file_paths = get_brats_scan_paths(patient_folder)
+        print("Found all modalities:", file_paths)
+        return self.predict_input(
+            lambda: [file_digest(path) for path in file_paths],
+            lambda segmenter, timings: segmenter.preprocess_scan(file_paths, timings),
+            timings, quality, tta, batched
+        )
+
+    def predict_input(self, content_digests, prepare, timings=None, quality=None, tta=None, batched=True):
+        """
+        Cached inference for one study, wherever its data comes from.
+        content_digests() returns the digests of the four modality files
+        (only called with the cache enabled); prepare(segmenter, timings)
+        returns the (input, geometry) pair and is only called on a cache miss.
+        """
+        options = self.tta_options(quality, tta)
+        segmenter = self.get()
+        if timings is None:
+            timings = {}
+
+        input_key = mask_key = None
+        if self.cache is not None:
+            start = time.perf_counter()
+            input_key = make_key(content_digests(), segmenter.preprocess_params)
+            # Exported and quantized backends can give slightly different masks
+            mask_parts = [input_key, segmenter.weights_digest, segmenter.inference,
+                          segmenter.runtime["backend"], segmenter.runtime["channels_last"]]
+            if options is not None:
+                mask_parts.append(segmenter.ensemble.cache_params(options))
+            mask_key = make_key(*mask_parts)
+            cached = self.cache.get(mask_key)
+            timings["cache_lookup"] = time.perf_counter() - start
+            if cached is not None:
+                timings["cache"] = "mask"
+                return np.asarray(cached[0])
+            cached = self.cache.get(input_key)
+            if cached is not None:
+                timings["cache"] = "input"
+                input_data = torch.from_numpy(np.array(cached[0]))
+                geometry = cached[1]
+            else:
+                timings["cache"] = "miss"
+
+        if self.cache is None or timings["cache"] == "miss":
+            input_data, geometry = prepare(segmenter, timings)
+            if self.cache is not None:
+                self.cache.put(input_key, input_data.numpy(), geometry)
+
+        start = time.perf_counter()
+        if options is None:
+            mask = self.infer(input_data, geometry, batched)
+        else:
+            with self._tta_lock:
+                mask = segmenter.ensemble.infer(input_data, geometry, options, timings)
+        timings["inference"] = time.perf_counter() - start
+        if self.cache is not None:
+            self.cache.put(mask_key, mask)
+        return mask
+
+    def worker_options(self):
+        """
+        Settings for building an equivalent engine in another process
+        """
+        return {
+            "model_path": self.model_path,
+            "warmup": self.warmup,
+            "inference": self.inference,
+            "cache": self.cache_config,
+            "runtime": self.runtime,
+            "tta": self.tta,
+        }
+
+    def metrics(self):
+        return {
+            "batching": self.batcher.stats() if self.batcher is not None else None,
+            "cache": self.cache.stats() if self.cache is not None else None,
+        }
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "model_path": self.model_path,
+            "backend": self.segmenter.model.name if self.segmenter is not None else None,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "reloads": self.reloads,
+            "error": self.error,
+        }
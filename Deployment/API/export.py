@@ -0,0 +1,171 @@
+"""
+Export the UNet checkpoint for the non-eager backends in backends.py.
+
+torchscript        traced, frozen and optimized for inference (optionally channels-last-3D)
+onnx               float32 ONNX graph with a dynamic batch axis
+onnx_int8_dynamic  int8 weights, activations quantized on the fly
+onnx_int8_static   int8 weights and activations, calibrated on real cases
+
+Every artifact gets a .json sidecar with the digest of the weights it was
+built from; the API refuses to load an export that does not match the
+checkpoint it is serving.
+
+Usage: python export.py --model Brain_30.pt --backends torchscript onnx onnx_int8_static \
+           --calibration "BraTS2021_00000/Paitent 1" [--channels_last]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import yaml
+
+from backends import ARTIFACTS, DEFAULT_RUNTIME, artifact_path, load_eager_model, write_export_info
+from cache import file_digest
+from segmentation import ROI_SIZE
+
+ONNX_OPSET = 17
+
+
+def example_input(batch_size=1):
+    return torch.zeros((batch_size, 4) + ROI_SIZE)
+
+
+@torch.no_grad()
+def export_torchscript(model, path, channels_last=False):
+    example = example_input()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last_3d)
+        example = example.contiguous(memory_format=torch.channels_last_3d)
+    traced = torch.jit.trace(model, example, check_trace=False)
+    # Folds the eval-mode parameters into the graph and fuses what oneDNN can
+    traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    traced.save(path)
+
+
+@torch.no_grad()
+def export_onnx(model, path):
+    torch.onnx.export(
+        model,
+        example_input(),
+        path,
+        input_names=["input"],
+        output_names=["logits"],
+        # Sliding-window batches shrink at the end of a volume
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=ONNX_OPSET,
+    )
+
+
+def quantize_onnx_dynamic(onnx_path, path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    # ConvInteger only has CPU kernels for uint8 weights
+    quantize_dynamic(onnx_path, path, op_types_to_quantize=["Conv"], weight_type=QuantType.QUInt8)
+
+
+def calibration_inputs(model_path, patient_folders, limit=None):
+    """
+    (1, 4, 128, 128, 128) float32 inputs preprocessed exactly as at serving
+    time; random ones (smoke tests only) when no folders are given
+    """
+    if not patient_folders:
+        print("No calibration folders given, calibrating on random inputs")
+        generator = np.random.default_rng(0)
+        return [generator.random((1, 4) + ROI_SIZE, dtype=np.float32) for _ in range(limit or 4)]
+
+    from segmentation import BrainTumorSegmentation
+
+    segmenter = BrainTumorSegmentation(model_path, {"mode": "resize"})
+    inputs = []
+    for patient_folder in patient_folders[:limit]:
+        input_data, _ = segmenter.preprocess_scan(segmenter.get_brats_scan_paths(patient_folder))
+        inputs.append(input_data.numpy().astype(np.float32))
+    return inputs
+
+
+def quantize_onnx_static(onnx_path, path, inputs):
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.inputs = iter(inputs)
+
+        def get_next(self):
+            array = next(self.inputs, None)
+            return None if array is None else {"input": array}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        prepared = os.path.join(tmp, "prepared.onnx")
+        quant_pre_process(onnx_path, prepared)
+        quantize_static(
+            prepared, path, Reader(),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+        )
+
+
+def export(model_path, backends, export_dir, channels_last=False, calibration=None, calibration_limit=None):
+    """
+    Build the requested artifacts and return {backend: path}. The float32
+    ONNX graph is (re)built whenever a quantized one is requested.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    weights_digest = file_digest(model_path)
+    model = load_eager_model(model_path)
+    paths = {}
+
+    onnx_path = artifact_path(model_path, "onnx", export_dir)
+    if any(backend.startswith("onnx") for backend in backends):
+        start = time.perf_counter()
+        export_onnx(model, onnx_path)
+        write_export_info(onnx_path, weights_digest, backend="onnx", opset=ONNX_OPSET)
+        print(f"onnx: {onnx_path} ({time.perf_counter() - start:.1f}s)")
+        if "onnx" in backends:
+            paths["onnx"] = onnx_path
+
+    for backend in backends:
+        if backend == "onnx":
+            continue
+        path = artifact_path(model_path, backend, export_dir, channels_last)
+        start = time.perf_counter()
+        if backend == "torchscript":
+            export_torchscript(model, path, channels_last)
+            write_export_info(path, weights_digest, backend=backend, channels_last=channels_last)
+        elif backend == "onnx_int8_dynamic":
+            quantize_onnx_dynamic(onnx_path, path)
+            write_export_info(path, weights_digest, backend=backend)
+        elif backend == "onnx_int8_static":
+            inputs = calibration_inputs(model_path, calibration, calibration_limit)
+            quantize_onnx_static(onnx_path, path, inputs)
+            write_export_info(path, weights_digest, backend=backend, calibration_cases=len(inputs))
+        else:
+            raise ValueError(f"Unknown backend: {backend}, expected one of {list(ARTIFACTS)}")
+        print(f"{backend}: {path} ({time.perf_counter() - start:.1f}s)")
+        paths[backend] = path
+    return paths
+
+
+def main():
+    config = yaml.safe_load(open("config.yaml"))
+    runtime = dict(DEFAULT_RUNTIME, **(config.get("runtime") or {}))
+
+    parser = argparse.ArgumentParser(description="Export the checkpoint for the TorchScript/ONNX backends")
+    parser.add_argument("--model", default=config["model"]["path"])
+    parser.add_argument("--backends", nargs="+", default=list(ARTIFACTS), choices=list(ARTIFACTS))
+    parser.add_argument("--export_dir", default=runtime["export_dir"])
+    parser.add_argument("--channels_last", action="store_true", help="Trace TorchScript in channels-last-3D")
+    parser.add_argument("--calibration", nargs="*", default=[], help="Patient folders for static int8 calibration")
+    parser.add_argument("--calibration_limit", type=int, default=None)
+    args = parser.parse_args()
+
+    export(args.model, args.backends, args.export_dir, args.channels_last, args.calibration, args.calibration_limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as wait_futures
+from functools import partial
+
+from backends import configure_threads
+from encoding import mask_filename, output_options
+from engine import InferenceEngine
+from metrics import ERRORS, observe_stages
+from segmentation import get_brats_scan_paths
+
+
+def run_segmentation(engine, patient_folder, output_path, quality=None, tta=None, output=None):
+    """
+    Segment one patient folder and write the mask to output_path, encoded
+    as set in `output` (see encoding.DEFAULT_OUTPUT)
+    """
+    output = output_options(output)
+    started_at = time.time()
+    timings = {}
+    segmenter = engine.get()
+    file_paths = get_brats_scan_paths(patient_folder)
+    prediction_mask = engine.predict(patient_folder, timings, quality=quality, tta=tta, file_paths=file_paths)
+
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    reference_scan = file_paths[0]
+    segmenter.save_prediction(prediction_mask, output_path, reference_scan,
+                              output["compression_level"], output["compression_threads"])
+    timings["save"] = time.perf_counter() - start
+    return {"started_at": started_at, "finished_at": time.time(), "stages": timings}
+
+
+# Each process-pool worker loads its own copy of the model once
+_worker_engine = None
+
+def init_worker(engine_options):
+    global _worker_engine
+    configure_threads(engine_options.get("runtime"))
+    _worker_engine = InferenceEngine(reload_interval=0, **engine_options)
+    _worker_engine.load()
+
+def run_in_worker(patient_folder, output_path, quality=None, tta=None, output=None):
+    return run_segmentation(_worker_engine, patient_folder, output_path, quality, tta, output)
+
+
+class JobManager:
+    """
+    Runs segmentations in the background and keeps track of their state.
+
+    Every job gets its own output file under output_dir/<job_id>/, so
+    concurrent jobs never overwrite each other's results. Only the most
+    recent max_jobs_kept finished jobs are remembered in memory; the state of
+    every job is also written to output_dir/<job_id>/job.json, so any server
+    process sharing output_dir (e.g. another gunicorn worker) can report it.
+    """
+    def __init__(self, engine, output_dir, executor="thread", max_workers=2, max_jobs_kept=1000, output=None):
+        self.engine = engine
+        self.output_dir = output_dir
+        self.output = output_options(output)
+        self.max_jobs_kept = max_jobs_kept
+        if executor == "process":
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=init_worker,
+                initargs=(engine.worker_options(),)
+            )
+            self._run_fn = run_in_worker
+        elif executor == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+            self._run_fn = partial(run_segmentation, engine)
+        else:
+            raise ValueError(f"Unknown executor: {executor}")
+
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, patient_folder, quality=None, tta=None):
+        # Reject bad options now rather than as a failed job later
+        self.engine.tta_options(quality, tta)
+        job_id = uuid.uuid4().hex
+        output_path = os.path.join(self.output_dir, job_id, mask_filename(self.output))
+        submitted_at = time.time()
+        self._write_status(job_id, {
+            "job_id": job_id,
+            "status": "queued",
+            "patient_folder": patient_folder,
+            "quality": quality,
+            "output_path": None,
+            "submitted_at": submitted_at,
+        })
+        future = self._executor.submit(self._run_fn, patient_folder, output_path, quality, tta, self.output)
+        with self._lock:
+            self._jobs[job_id] = {
+                "patient_folder": patient_folder,
+                "output_path": output_path,
+                "submitted_at": submitted_at,
+                "quality": quality,
+                "future": future,
+            }
+            self._forget_old_jobs()
+        # Runs in this process for both executors, so process workers are counted too
+        future.add_done_callback(partial(self._finished, job_id))
+        return job_id
+
+    def _status_path(self, job_id):
+        return os.path.join(self.output_dir, job_id, "job.json")
+
+    def _write_status(self, job_id, status):
+        path = self._status_path(job_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, path)
+
+    def _finished(self, job_id, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            ERRORS.inc(route="jobs", type=type(future.exception()).__name__)
+        else:
+            observe_stages(future.result()["stages"], source="job")
+        status = self.get(job_id)
+        if status is not None:
+            self._write_status(job_id, status)
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["future"].done()]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_jobs_kept)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """
+        Return the status of a job, or None if it is unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return self._read_status(job_id)
+
+        future = job["future"]
+        result = None
+        error = None
+        if future.done():
+            if future.exception() is not None:
+                status = "failed"
+                error = str(future.exception())
+            else:
+                status = "succeeded"
+                result = future.result()
+        elif future.running():
+            status = "running"
+        else:
+            status = "queued"
+
+        timings = {}
+        if result is not None:
+            timings = {
+                "queued_seconds": result["started_at"] - job["submitted_at"],
+                "run_seconds": result["finished_at"] - result["started_at"],
+                "total_seconds": result["finished_at"] - job["submitted_at"],
+                "stages": result["stages"],
+            }
+        return {
+            "job_id": job_id,
+            "status": status,
+            "patient_folder": job["patient_folder"],
+            "quality": job["quality"],
+            "output_path": job["output_path"] if status == "succeeded" else None,
+            "error": error,
+            "submitted_at": job["submitted_at"],
+            "started_at": result["started_at"] if result else None,
+            "finished_at": result["finished_at"] if result else None,
+            "timings": timings,
+        }
+
+    def _read_status(self, job_id):
+        # Job ids are uuid4 hex; anything else must not become a path
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            return None
+        try:
+            with open(self._status_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def queue_depth(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job["future"].done())
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stop taking jobs. Queued jobs are cancelled and, with wait=True,
+        running ones get up to `timeout` seconds to finish. Every job that did
+        not finish is recorded in its job.json as "cancelled" or "failed", so
+        no status is left at "queued" or "running" by a stopped server.
+        """
+        with self._lock:
+            jobs = {job_id: job for job_id, job in self._jobs.items() if not job["future"].done()}
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if wait:
+            wait_futures([job["future"] for job in jobs.values()], timeout=timeout)
+        for job_id, job in jobs.items():
+            future = job["future"]
+            if future.done() and not future.cancelled():
+                continue
+            status = self.get(job_id)
+            if future.cancelled():
+                status.update(status="cancelled", error="Server shut down before the job started")
+            else:
+                status.update(status="failed", error="Server shut down before the job finished")
+            self._write_status(job_id, status)
@@ -0,0 +1,134 @@
+"""
+Throughput of serve.py against the number of worker processes.
+
+For each worker count a server is started with the result cache disabled
+(otherwise every repeat would be a cache hit). The script waits until every
+worker reports ready, then sends --requests /predict calls from
+--concurrency client threads. It reports throughput, latency percentiles
+and the server's total proportional set size (PSS). PSS counts pages shared
+copy-on-write only once, so it shows how much of the weights the workers
+really share.
+
+Usage: python load_test.py --workers 1 2 4 --requests 32 --concurrency 8
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+import yaml
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/task/{child}/children") as f:
+                pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def pss_mb(pid):
+    total = 0
+    for child in process_tree(pid):
+        try:
+            with open(f"/proc/{child}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024.0
+
+
+def wait_ready(url, workers, timeout):
+    """
+    /ready is answered by whichever worker accepts the connection, so wait
+    for a run of successes long enough to have reached every worker
+    """
+    deadline = time.time() + timeout
+    streak = 0
+    while time.time() < deadline:
+        try:
+            streak = streak + 1 if requests.get(f"{url}/ready", timeout=5).status_code == 200 else 0
+        except requests.ConnectionError:
+            streak = 0
+        if streak >= 4 * workers:
+            return
+        time.sleep(0.25)
+    raise TimeoutError(f"Server at {url} not ready after {timeout}s")
+
+
+def run(url, patient_folder, total, concurrency):
+    def one(_):
+        start = time.perf_counter()
+        response = requests.post(f"{url}/predict", json={"patient_folder": patient_folder}, timeout=600)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array([latency for latency, status in results if status == 200])
+    return {
+        "ok": len(latencies),
+        "errors": total - len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+        "p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--patient_folder", default="BraTS2021_00000/Paitent 1")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--ready_timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open("config.yaml"))
+    config["cache"]["enabled"] = False
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+    yaml.safe_dump(config, config_file)
+    config_file.close()
+    env = dict(os.environ, NEUROVISION_CONFIG=config_file.name)
+    url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        for workers in args.workers:
+            server = subprocess.Popen(
+                [sys.executable, "serve.py", "--workers", str(workers), "--threads", str(args.threads),
+                 "--bind", f"127.0.0.1:{args.port}"],
+                env=env
+            )
+            try:
+                wait_ready(url, workers, args.ready_timeout)
+                idle_pss = pss_mb(server.pid)
+                result = run(url, args.patient_folder, args.requests, args.concurrency)
+                loaded_pss = pss_mb(server.pid)
+            finally:
+                # SIGTERM is the graceful path: in-flight work is drained
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=300)
+            latency = (f"p50 {result['p50']:.2f}s  p95 {result['p95']:.2f}s" if result["ok"]
+                       else "no successful requests")
+            print(f"{workers} workers: {result['throughput']:.2f} req/s  {latency}  "
+                  f"errors {result['errors']}  PSS idle {idle_pss:.0f} MB / loaded {loaded_pss:.0f} MB")
+    finally:
+        os.remove(config_file.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import os
+import queue
+import threading
+
+import pyvista as pv
+
+from meshing import mesh_cache_path, save_mesh, modality_mesh
+
+# Triangle budgets per level, coarse to fine
+LOD_TARGETS = (25_000, 100_000, 400_000)
+
+
+def simplify(mesh, target_triangles, smooth_iterations=20):
+    """Decimate a surface down to about target_triangles and Taubin-smooth it."""
+    mesh = mesh.triangulate()
+    if mesh.n_cells > target_triangles:
+        mesh = mesh.decimate(1.0 - target_triangles / mesh.n_cells)
+    if smooth_iterations and mesh.n_points:
+        mesh = mesh.smooth_taubin(n_iter=smooth_iterations, pass_band=0.1)
+    return mesh
+
+
+def lod_levels(file_path, threshold=0.2, targets=LOD_TARGETS):
+    """
+    Yield (target, mesh) from coarse to fine for a modality surface. Levels
+    are cached next to the full mesh, so after the first run every level is
+    a small .vtp read and the coarse one is available almost immediately.
+    """
+    full_mesh = None
+    for target in targets:
+        path = mesh_cache_path(file_path, "modality", threshold, "lod", target)
+        if os.path.exists(path):
+            yield target, pv.read(path)
+            continue
+        if full_mesh is None:
+            full_mesh = modality_mesh(file_path, threshold=threshold)
+        mesh = simplify(full_mesh, target)
+        save_mesh(mesh, path)
+        yield target, mesh
+
+
+class LODActor:
+    """
+    One actor whose mesh is switched between loaded levels: the coarsest
+    while the camera is being moved, the finest loaded one when it stops.
+    """
+    def __init__(self, plotter, **mesh_kwargs):
+        self.plotter = plotter
+        self.mesh_kwargs = mesh_kwargs
+        self.levels = []
+        self.actor = None
+        self.interacting = False
+
+    def add_level(self, mesh):
+        self.levels.append(mesh)
+        if self.actor is None:
+            self.actor = self.plotter.add_mesh(mesh, **self.mesh_kwargs)
+        elif not self.interacting:
+            self.show(mesh)
+
+    def show(self, mesh):
+        if self.actor is not None:
+            self.actor.mapper.SetInputData(mesh)
+
+    def start_interaction(self):
+        self.interacting = True
+        if self.levels:
+            self.show(self.levels[0])
+
+    def end_interaction(self):
+        self.interacting = False
+        if self.levels:
+            self.show(self.levels[-1])
+
+
+class LODScene:
+    """
+    Loads the levels of several surfaces in a background thread and adds
+    them to the plotter as they arrive, coarse first. Rendering switches to
+    the coarse levels during camera interaction.
+    """
+    def __init__(self, plotter, targets=LOD_TARGETS, poll_ms=100):
+        self.plotter = plotter
+        self.targets = targets
+        self.poll_ms = poll_ms
+        self.sources = []
+        self.actors = []
+        self._loaded = queue.Queue()
+
+    def add(self, file_path, threshold=0.2, **mesh_kwargs):
+        self.sources.append((file_path, threshold))
+        self.actors.append(LODActor(self.plotter, **mesh_kwargs))
+
+    def _load(self):
+        # Coarsest level of every surface first, then the finer ones
+        generators = [lod_levels(path, threshold, self.targets) for path, threshold in self.sources]
+        for _ in self.targets:
+            for index, levels in enumerate(generators):
+                _, mesh = next(levels)
+                self._loaded.put((index, mesh))
+
+    def _poll(self, *args):
+        changed = False
+        while True:
+            try:
+                index, mesh = self._loaded.get_nowait()
+            except queue.Empty:
+                break
+            self.actors[index].add_level(mesh)
+            changed = True
+        if changed:
+            self.plotter.render()
+
+    def _start_interaction(self, *args):
+        for actor in self.actors:
+            actor.start_interaction()
+
+    def _end_interaction(self, *args):
+        for actor in self.actors:
+            actor.end_interaction()
+        self.plotter.render()
+
+    def start(self):
+        threading.Thread(target=self._load, name="lod-loader", daemon=True).start()
+        # The interactor style, not the interactor, fires the interaction events
+        style = self.plotter.iren.interactor.GetInteractorStyle()
+        style.AddObserver("StartInteractionEvent", self._start_interaction)
+        style.AddObserver("EndInteractionEvent", self._end_interaction)
+        # Levels are handed to VTK on the render thread only
+        max_steps = 10 * 60 * 1000 // self.poll_ms
+        self.plotter.add_timer_event(max_steps=max_steps, duration=self.poll_ms, callback=self._poll)
@@ -0,0 +1,116 @@
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+import pyvista as pv
+from vtkmodules.vtkFiltersGeneral import vtkDiscreteMarchingCubes
+
+from cache import file_fingerprint, make_key
+
+MESH_CACHE_DIR = "mesh_cache"
+# Bump when the way meshes are built changes, so stale .vtp files are ignored
+MESH_VERSION = 1
+TUMOR_LABELS = (1, 2, 3)
+
+
+def load_nifti(file_path):
+    """Load a NIfTI file in its stored dtype (no float64 copy) and return its data and affine."""
+    nifti = nib.load(file_path)
+    data = np.asanyarray(nifti.dataobj)
+    affine = nifti.affine
+    return data, affine
+
+
+def bounding_box(mask, pad=1):
+    """Slices covering the True voxels of mask, grown by `pad` voxels; None if empty."""
+    box = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(mask.any(axis=other_axes))
+        if len(nonzero) == 0:
+            return None
+        box.append(slice(max(int(nonzero[0]) - pad, 0), min(int(nonzero[-1]) + 1 + pad, mask.shape[axis])))
+    return tuple(box)
+
+
+def image_grid(data, box, spacing=(1, 1, 1)):
+    """ImageData over data[box] only, placed at the box's position in the full volume."""
+    crop = data[box]
+    grid = pv.ImageData()
+    grid.dimensions = crop.shape
+    grid.spacing = spacing
+    grid.origin = tuple(s.start * sp for s, sp in zip(box, spacing))
+    grid.point_data["values"] = crop.ravel(order="F")
+    return grid
+
+
+def create_3d_mesh(data, threshold=0.5, spacing=(1, 1, 1)):
+    """Create a 3D mesh from the data using a threshold, contouring only its bounding box."""
+    box = bounding_box(data > threshold)
+    if box is None:
+        return pv.PolyData()
+    return image_grid(data, box, spacing).contour([threshold])
+
+
+def create_label_meshes(seg_data, labels=TUMOR_LABELS, spacing=(1, 1, 1)):
+    """
+    Surfaces for all labels from one discrete marching cubes pass over the
+    tumor bounding box; shared boundaries between labels stay watertight.
+    """
+    box = bounding_box(seg_data > 0)
+    if box is None:
+        return {label: pv.PolyData() for label in labels}
+
+    grid = image_grid(seg_data, box, spacing)
+    contour = vtkDiscreteMarchingCubes()
+    contour.SetInputData(grid)
+    for i, label in enumerate(labels):
+        contour.SetValue(i, label)
+    contour.ComputeScalarsOn()
+    contour.Update()
+    surface = pv.wrap(contour.GetOutput())
+    if surface.n_points == 0:
+        return {label: pv.PolyData() for label in labels}
+
+    scalars = surface.active_scalars_name
+    return {
+        label: surface.threshold([label - 0.5, label + 0.5], scalars=scalars).extract_surface()
+        for label in labels
+    }
+
+
+def mesh_cache_path(file_path, *params):
+    key = make_key(file_fingerprint(file_path), MESH_VERSION, *params)
+    return os.path.join(MESH_CACHE_DIR, f"{key}.vtp")
+
+
+def save_mesh(mesh, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".vtp")
+    os.close(fd)
+    mesh.save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def modality_mesh(file_path, threshold=0.2):
+    """Cached surface of a modality volume at `threshold`, keyed on the input file."""
+    path = mesh_cache_path(file_path, "modality", threshold)
+    if os.path.exists(path):
+        return pv.read(path)
+    data, _ = load_nifti(file_path)
+    mesh = create_3d_mesh(data, threshold=threshold)
+    save_mesh(mesh, path)
+    return mesh
+
+
+def label_meshes(segmentation_path, labels=TUMOR_LABELS):
+    """Cached per-label surfaces of a segmentation, keyed on the input file."""
+    paths = {label: mesh_cache_path(segmentation_path, "label", label) for label in labels}
+    if all(os.path.exists(path) for path in paths.values()):
+        return {label: pv.read(path) for label, path in paths.items()}
+    seg_data, _ = load_nifti(segmentation_path)
+    meshes = create_label_meshes(seg_data, labels)
+    for label, mesh in meshes.items():
+        save_mesh(mesh, paths[label])
+    return meshes
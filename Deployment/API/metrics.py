@@ -0,0 +1,282 @@
+import math
+import os
+import resource
+import threading
+
+# Seconds; covers a cache hit (ms) up to a sliding-window TTA run (minutes)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Timing keys filled along the /predict path (upload, preprocess_scan, InferenceEngine.predict, save, encode)
+STAGES = ("decode", "transform", "preprocess", "cache_lookup", "inference", "tta_seconds", "save", "encode", "upload")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    A named family of samples, one per combination of label values
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        return self.header() + [f"{name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                                for name, key, value in self.samples()]
+
+
+class Gauge(Metric):
+    """
+    Set directly, or computed at scrape time with set_function(fn), where fn
+    returns a value or a {label values tuple: value} dict
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            value = self._function()
+            if isinstance(value, dict):
+                return [(self.name, tuple(str(v) for v in key), v) for key, v in value.items() if v is not None]
+            return [] if value is None else [(self.name, (), value)]
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        return self.header() + [f"{name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                                for name, key, value in self.samples()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total) in self.samples().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def summary(self):
+        """
+        {label values: {"count", "sum", "mean"}} for the JSON view
+        """
+        return {
+            ",".join(key) or "all": {"count": sum(counts), "sum": total,
+                                     "mean": total / sum(counts) if sum(counts) else None}
+            for key, (counts, total) in self.samples().items()
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Prometheus text exposition format (version 0.0.4)
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        snapshot = {}
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                snapshot[metric.name] = metric.summary()
+            else:
+                snapshot[metric.name] = {",".join(key) or "all": value for _, key, value in metric.samples()}
+        return snapshot
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    "neurovision_http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status")))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "neurovision_http_request_seconds", "HTTP request latency by route", ("route",)))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "neurovision_stage_seconds", "Seconds spent per segmentation stage", ("stage", "source")))
+CACHE_RESULTS = REGISTRY.register(Counter(
+    "neurovision_cache_results_total", "Segmentation cache outcome per request (mask, input, miss)", ("result",)))
+ERRORS = REGISTRY.register(Counter(
+    "neurovision_errors_total", "Failed requests and jobs by exception type", ("route", "type")))
+RSS_BYTES = REGISTRY.register(Gauge(
+    "neurovision_process_resident_memory_bytes", "Current resident set size"))
+PEAK_RSS_BYTES = REGISTRY.register(Gauge(
+    "neurovision_process_peak_resident_memory_bytes", "High-water mark of the resident set size"))
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+RSS_BYTES.set_function(_rss_bytes)
+PEAK_RSS_BYTES.set_function(_peak_rss_bytes)
+
+
+def observe_stages(timings, source="predict"):
+    """
+    Feed a timings dict from the /predict path into the stage histograms
+    """
+    for stage in STAGES:
+        value = timings.get(stage)
+        if isinstance(value, (int, float)):
+            STAGE_SECONDS.observe(value, stage=stage, source=source)
+    if "cache" in timings:
+        CACHE_RESULTS.inc(result=timings["cache"])
+
+
+MODEL_READY = REGISTRY.register(Gauge(
+    "neurovision_model_ready", "1 once the model is loaded and warmed up"))
+MODEL_LOAD_SECONDS = REGISTRY.register(Gauge(
+    "neurovision_model_load_seconds", "Duration of the last model load and warmup", ("phase",)))
+MODEL_RELOADS = REGISTRY.register(Gauge(
+    "neurovision_model_reloads", "Hot reloads of the checkpoint since startup"))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "neurovision_queue_depth", "Requests waiting for the batcher and unfinished background jobs", ("queue",)))
+BATCHER_QUEUE_WAIT_MS = REGISTRY.register(Gauge(
+    "neurovision_batcher_queue_wait_ms", "Batcher queue wait over the last 1000 requests", ("quantile",)))
+BATCHER_BATCHES = REGISTRY.register(Gauge(
+    "neurovision_batcher_batches", "Forward passes run by the batcher and their mean size", ("stat",)))
+VOLUME_CACHE = REGISTRY.register(Gauge(
+    "neurovision_volume_cache", "Input/mask cache counters and memory use", ("stat",)))
+GPU_PEAK_BYTES = REGISTRY.register(Gauge(
+    "neurovision_gpu_peak_allocated_bytes", "High-water mark of CUDA memory allocated by torch"))
+
+
+def _gpu_peak_bytes():
+    import torch
+
+    return torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+
+
+def bind_engine(engine, jobs=None):
+    """
+    Compute the engine, batcher, cache and job gauges at scrape time
+    """
+    MODEL_READY.set_function(lambda: 1 if engine.ready else 0)
+    MODEL_LOAD_SECONDS.set_function(lambda: {
+        ("load",): engine.load_seconds,
+        ("warmup",): engine.warmup_seconds,
+    })
+    MODEL_RELOADS.set_function(lambda: engine.reloads)
+    GPU_PEAK_BYTES.set_function(_gpu_peak_bytes)
+
+    def queue_depth():
+        depth = {}
+        if engine.batcher is not None:
+            depth[("batcher",)] = engine.batcher.stats()["queue_depth"]
+        if jobs is not None:
+            depth[("jobs",)] = jobs.queue_depth()
+        return depth
+    QUEUE_DEPTH.set_function(queue_depth)
+
+    def batcher_queue_wait():
+        if engine.batcher is None:
+            return {}
+        waits = engine.batcher.stats()["queue_wait_ms"]
+        return {("0.5",): waits["p50"], ("0.95",): waits["p95"], ("1",): waits["max"]}
+    BATCHER_QUEUE_WAIT_MS.set_function(batcher_queue_wait)
+
+    def batcher_batches():
+        if engine.batcher is None:
+            return {}
+        stats = engine.batcher.stats()
+        return {("batches",): stats["batches"], ("mean_size",): stats["mean_batch_size"],
+                ("rejected",): stats["rejected"]}
+    BATCHER_BATCHES.set_function(batcher_batches)
+
+    def volume_cache():
+        if engine.cache is None:
+            return {}
+        return {(name,): value for name, value in engine.cache.stats().items()}
+    VOLUME_CACHE.set_function(volume_cache)
@@ -0,0 +1,67 @@
+import cProfile
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+PROFILERS = ("torch", "cprofile")
+# cProfile (3.12+) and the torch profiler each allow one active profiler
+# per process, so one profiled request runs at a time
+_active = threading.Lock()
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+@contextmanager
+def profile_request(kind, directory="profiles", name="predict"):
+    """
+    Profile the enclosed block and write a trace to `directory`. Yields a
+    dict whose "path" is set once the trace has been written.
+
+    torch:    Chrome trace of torch operators (open in chrome://tracing or
+              Perfetto), with input shapes and memory
+    cprofile: pstats file of the Python call graph of the calling thread
+              (python -m pstats, or snakeviz). Decoding and the intensity
+              transform run on the segmenter's modality threads and are
+              not in it; they show up only as the wait for those threads
+
+    Raises ProfilerBusy if another request in this process is being profiled.
+    """
+    if kind not in PROFILERS:
+        raise ValueError(f"Unknown profiler: {kind}, expected one of {list(PROFILERS)}")
+    if not _active.acquire(blocking=False):
+        raise ProfilerBusy("Another request is being profiled; retry when it has finished")
+    try:
+        yield from _profile(kind, directory, name)
+    finally:
+        _active.release()
+
+
+def _profile(kind, directory, name):
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}")
+    result = {"kind": kind, "path": None}
+
+    if kind == "torch":
+        import torch
+        from torch.profiler import ProfilerActivity, profile
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with profile(activities=activities, record_shapes=True, profile_memory=True) as profiler:
+            yield result
+        result["path"] = stem + ".trace.json"
+        profiler.export_chrome_trace(result["path"])
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield result
+        finally:
+            profiler.disable()
+            result["path"] = stem + ".prof"
+            profiler.dump_stats(result["path"])
@@ -0,0 +1,174 @@
+import gzip
+import io
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyvista as pv
+from PIL import Image
+
+from cache import VolumeCache, file_fingerprint, make_key
+from lod import lod_levels
+from meshing import image_grid, label_meshes, load_nifti
+
+VIEWS = {
+    "3d": None,
+    "axial": (0, 0, 1),
+    "sagittal": (1, 0, 0),
+    "coronal": (0, 1, 0),
+}
+FORMATS = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "gltf": "model/gltf+json",
+}
+LABEL_COLORS = {1: "#FF0000", 2: "#00FF00", 3: "#0000FF"}
+# Brain surface level used for server-side 3D views
+SURFACE_TRIANGLES = 100_000
+
+
+class RenderThread:
+    """
+    The one thread that touches a render window. VTK render windows are not
+    thread-safe, so every /render request hands its scene to this thread
+    instead of drawing on the Flask thread that received it. The offscreen
+    plotter is created on the thread on first use and reused after that,
+    since creating a render window is the most expensive part of a small
+    render.
+    """
+    def __init__(self, window_size=(800, 600)):
+        self.window_size = tuple(window_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+        self._plotter = None
+
+    def run(self, function, *args):
+        """
+        function(plotter, *args) on the render thread; blocks until it returns
+        """
+        return self._executor.submit(self._call, function, args).result()
+
+    def _call(self, function, args):
+        if self._plotter is None:
+            self._plotter = pv.Plotter(off_screen=True, window_size=list(self.window_size))
+            self._plotter.set_background("black")
+        self._plotter.clear()
+        return function(self._plotter, *args)
+
+
+class Renderer:
+    """
+    Server-side version of the visual_2.py views: the 3D brain with tumor
+    sub-regions, or an axial/sagittal/coronal slice of T1 with the tumor
+    outlines. Meshes and slices are built on the calling thread; only the
+    drawing runs on the render thread. Results are cached on the input
+    files and every view parameter, so a repeated view is a cache lookup.
+    """
+    def __init__(self, window_size=(800, 600), cache_dir="cache/renders", cache_memory_mb=256):
+        self.window_size = tuple(window_size)
+        self.thread = RenderThread(window_size)
+        self.cache = VolumeCache(cache_dir, memory_budget_mb=cache_memory_mb)
+
+    def render(self, segmentation_path, t1_path, view="3d", azimuth=0.0, elevation=0.0, zoom=1.0,
+               position=None, width=None, height=None, fmt="png"):
+        """
+        Return (bytes, mimetype). `position` is the slice index along the view
+        normal (middle of the volume by default); glTF is only available for 3d.
+        """
+        if view not in VIEWS:
+            raise ValueError(f"Unknown view: {view}, expected one of {list(VIEWS)}")
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown format: {fmt}, expected one of {list(FORMATS)}")
+        if fmt == "gltf" and view != "3d":
+            raise ValueError("glTF export is only available for the 3d view")
+        window_size = (int(width or self.window_size[0]), int(height or self.window_size[1]))
+
+        key = make_key(file_fingerprint(segmentation_path), file_fingerprint(t1_path), view,
+                       float(azimuth), float(elevation), float(zoom), position, window_size, fmt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached[0].tobytes(), cached[1]["mimetype"]
+
+        if view == "3d":
+            scene = self._scene_3d(segmentation_path, t1_path)
+        else:
+            scene = self._scene_slice(segmentation_path, t1_path, VIEWS[view], position)
+        data = self.thread.run(self._draw, scene, window_size, float(azimuth), float(elevation), float(zoom), fmt)
+
+        self.cache.put(key, np.frombuffer(data, dtype=np.uint8), {"mimetype": FORMATS[fmt]})
+        return data, FORMATS[fmt]
+
+    def _scene_3d(self, segmentation_path, t1_path):
+        """
+        ([(mesh, add_mesh keyword arguments)], name of the camera reset)
+        """
+        meshes = []
+        for label, mesh in label_meshes(segmentation_path).items():
+            if mesh.n_points:
+                meshes.append((mesh, {"color": LABEL_COLORS[label], "opacity": 0.8, "smooth_shading": True}))
+        mesh = next(mesh for target, mesh in lod_levels(t1_path) if target >= SURFACE_TRIANGLES)
+        if mesh.n_points:
+            meshes.append((mesh, {"color": "#8B4513", "opacity": 0.3, "smooth_shading": True}))
+        return meshes, "view_isometric"
+
+    def _scene_slice(self, segmentation_path, t1_path, normal, position):
+        t1_data, _ = load_nifti(t1_path)
+        axis = int(np.argmax(normal))
+        index = t1_data.shape[axis] // 2 if position is None else int(position)
+        if not 0 <= index < t1_data.shape[axis]:
+            raise ValueError(f"Slice position {index} is outside 0..{t1_data.shape[axis] - 1}")
+
+        # Only the slab around the slice is turned into a grid
+        box = [slice(0, n) for n in t1_data.shape]
+        box[axis] = slice(index, index + 1)
+        grid = image_grid(t1_data, tuple(box))
+        meshes = [(grid, {"scalars": "values", "cmap": "gray", "show_scalar_bar": False})]
+
+        origin = [0.0, 0.0, 0.0]
+        origin[axis] = float(index)
+        for label, mesh in label_meshes(segmentation_path).items():
+            if mesh.n_points:
+                outline = mesh.slice(normal=normal, origin=origin)
+                if outline.n_points:
+                    meshes.append((outline, {"color": LABEL_COLORS[label], "line_width": 2}))
+
+        return meshes, {0: "view_yz", 1: "view_xz", 2: "view_xy"}[axis]
+
+    def _draw(self, plotter, scene, window_size, azimuth, elevation, zoom, fmt):
+        """
+        Runs on the render thread
+        """
+        meshes, reset_view = scene
+        plotter.window_size = list(window_size)
+        for mesh, options in meshes:
+            plotter.add_mesh(mesh, **options)
+        getattr(plotter, reset_view)()
+        # Relative to the view's reset position; the plotter is reused,
+        # so pyvista's stored absolute angles would be stale
+        plotter.camera.Azimuth(azimuth)
+        plotter.camera.Elevation(elevation)
+        plotter.camera.zoom(zoom)
+
+        if fmt == "gltf":
+            return self._export_gltf(plotter)
+        plotter.render()
+        image = plotter.screenshot(return_img=True)
+        buffer = io.BytesIO()
+        Image.fromarray(image).save(buffer, format=fmt.upper())
+        return buffer.getvalue()
+
+    def _export_gltf(self, plotter):
+        """
+        glTF with inlined buffers, gzip-compressed for transfer
+        """
+        fd, path = tempfile.mkstemp(suffix=".gltf")
+        os.close(fd)
+        try:
+            plotter.export_gltf(path, inline_data=True)
+            with open(path, "rb") as f:
+                return gzip.compress(f.read(), compresslevel=6)
+        finally:
+            os.remove(path)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,274 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn.functional as F
+import numpy as np
+from backends import DEFAULT_RUNTIME, load_backend
+from cache import file_digest
+from encoding import save_mask
+from monai.inferers import sliding_window_inference
+from monai.transforms import (
+    Compose,
+    LoadImage,
+    EnsureChannelFirst,
+    ScaleIntensityRange,
+    SpatialCrop,
+    Resize
+)
+from monai.transforms.utils import generate_spatial_bounding_box
+from monai.utils import convert_to_tensor
+
+ROI_SIZE = (128, 128, 128)
+MODALITIES = ('t1', 't1ce', 't2', 'flair')
+
+
+DEFAULT_INFERENCE = {
+    # "resize": the foreground crop is resized to 128^3 for one forward pass
+    # "sliding_window": overlapping 128^3 patches at native resolution
+    "mode": "resize",
+    "overlap": 0.25,
+    "blend": "gaussian",
+    # Patches per forward pass = memory_budget_mb // patch_memory_mb
+    "memory_budget_mb": 2048,
+    "patch_memory_mb": 512,
+}
+
+
+def get_brats_scan_paths(patient_folder):
+    """
+    [t1, t1ce, t2, flair] paths in a BraTS patient folder; ValueError if any
+    modality is missing
+    """
+    modality_paths = {
+        't1': None,
+        't1ce': None,
+        't2': None,
+        'flair': None
+    }
+
+    for file in os.listdir(patient_folder):
+        if file.endswith('.nii.gz'):
+            if 't1.' in file.lower():
+                modality_paths['t1'] = os.path.join(patient_folder, file)
+            elif 't1ce.' in file.lower():
+                modality_paths['t1ce'] = os.path.join(patient_folder, file)
+            elif 't2.' in file.lower():
+                modality_paths['t2'] = os.path.join(patient_folder, file)
+            elif 'flair.' in file.lower():
+                modality_paths['flair'] = os.path.join(patient_folder, file)
+
+    missing = [k for k, v in modality_paths.items() if v is None]
+    if missing:
+        raise ValueError(f"Missing modalities: {missing}")
+
+    return [modality_paths['t1'], modality_paths['t1ce'],
+            modality_paths['t2'], modality_paths['flair']]
+
+
+class BrainTumorSegmentation:
+    def __init__(self, model_path, inference=None, runtime=None):
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        print(f"Using device: {self.device}")
+
+        # Initialize model: eager PyTorch, or a TorchScript/ONNX export of the
+        # same checkpoint (see export.py and backends.py)
+        self.weights_digest = file_digest(model_path)
+        self.runtime = dict(DEFAULT_RUNTIME, **(runtime or {}))
+        self.model = load_backend(model_path, self.runtime, self.device, self.weights_digest)
+        print(f"Using backend: {self.model.name}")
+
+        self.inference = dict(DEFAULT_INFERENCE, **(inference or {}))
+        if self.inference["mode"] not in ("resize", "sliding_window"):
+            raise ValueError(f"Unknown inference mode: {self.inference['mode']}")
+        self.sw_batch_size = max(1, self.inference["memory_budget_mb"] // self.inference["patch_memory_mb"])
+
+        # Decoding (gzip + NIfTI parsing) and the intensity transform are kept
+        # separate so they can be timed on their own. Cropping and resizing
+        # happen once on the stacked modalities so that all four share the
+        # same box, which is needed to put the mask back in the original grid.
+        self.loader = Compose([
+            LoadImage(image_only=True),
+            EnsureChannelFirst()
+        ])
+        self.transforms = ScaleIntensityRange(
+            a_min=-200,
+            a_max=200,
+            b_min=0.0,
+            b_max=1.0,
+            clip=True
+        )
+        self.resize = Resize(spatial_size=ROI_SIZE)
+
+        # Everything that changes the preprocessed input; part of the cache key
+        self.preprocess_params = {
+            "scale": {"a_min": -200, "a_max": 200, "b_min": 0.0, "b_max": 1.0, "clip": True},
+            "mode": self.inference["mode"],
+            "roi_size": ROI_SIZE,
+        }
+
+        # One thread per modality; zlib and the numpy transforms release the GIL
+        self.io_pool = ThreadPoolExecutor(max_workers=len(MODALITIES), thread_name_prefix="modality")
+
+    @torch.no_grad()
+    def warmup(self):
+        """
+        Run one dummy forward pass so the first real request does not pay
+        for lazy allocations and kernel selection
+        """
+        batch_size = self.sw_batch_size if self.inference["mode"] == "sliding_window" else 1
+        dummy = torch.zeros((batch_size, 4) + ROI_SIZE, device=self.device)
+        self.model(dummy)
+
+    def get_brats_scan_paths(self, patient_folder):
+        """
+        Get paths for all modalities from BraTS patient folder
+        """
+        return get_brats_scan_paths(patient_folder)
+
+    def _preprocess_one(self, path):
+        start = time.perf_counter()
+        scan = self.loader(path)
+        decoded = time.perf_counter()
+        scan = self.transforms(scan)
+        return scan, decoded - start, time.perf_counter() - decoded
+
+    def preprocess_scan(self, file_paths, timings=None):
+        """
+        Preprocess the 4 modality scans (T1, T1ce, T2, FLAIR) in parallel.
+
+        Returns the (1, 4, H, W, D) model input and a geometry dict with the
+        original spatial shape and the foreground box, which restore() uses
+        to map the prediction back. If a timings dict is given, it is filled
+        with the decode and transform seconds of the slowest modality and the
+        wall-clock preprocess seconds. The modalities run concurrently, so the
+        slowest one is what each stage adds to the request, not the sum.
+        """
+        start = time.perf_counter()
+        results = list(self.io_pool.map(self._preprocess_one, file_paths))
+        input_data, geometry = self.assemble([scan for scan, _, _ in results])
+        if timings is not None:
+            timings["decode"] = max(decode for _, decode, _ in results)
+            timings["transform"] = max(transform for _, _, transform in results)
+            timings["preprocess"] = time.perf_counter() - start
+        return input_data, geometry
+
+    def assemble(self, processed_scans):
+        """
+        Stack the transformed (1, H, W, D) modalities, crop them to their
+        shared foreground box and resize if needed; see preprocess_scan
+        """
+        # Concatenate all modalities
+        input_data = torch.cat(processed_scans, dim=0)
+        spatial_shape = tuple(input_data.shape[1:])
+
+        box_start, box_end = generate_spatial_bounding_box(input_data)
+        if any(e <= s for s, e in zip(box_start, box_end)):
+            box_start, box_end = [0, 0, 0], list(spatial_shape)
+        input_data = SpatialCrop(roi_start=box_start, roi_end=box_end)(input_data)
+        if self.inference["mode"] == "resize":
+            input_data = self.resize(input_data)
+
+        geometry = {
+            "spatial_shape": spatial_shape,
+            "box_start": [int(i) for i in box_start],
+            "box_end": [int(i) for i in box_end],
+        }
+        return convert_to_tensor(input_data, track_meta=False).unsqueeze(0), geometry
+
+    def prefetch(self, patient_folders, depth=1):
+        """
+        Yield (patient_folder, future) pairs, where the future resolves to
+        (file_paths, input_data, geometry, timings). Up to `depth` patients
+        ahead are loaded and preprocessed in the background while the caller
+        runs inference on the current one.
+        """
+        def load(patient_folder):
+            timings = {}
+            file_paths = self.get_brats_scan_paths(patient_folder)
+            input_data, geometry = self.preprocess_scan(file_paths, timings)
+            return file_paths, input_data, geometry, timings
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch") as pool:
+            pending = deque()
+            for patient_folder in patient_folders:
+                pending.append((patient_folder, pool.submit(load, patient_folder)))
+                if len(pending) > depth:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+
+    @torch.no_grad()
+    def predict(self, patient_folder, timings=None):
+        """
+        Make prediction on new scans
+        patient_folder: Path to patient folder containing all modalities
+        """
+        # Get paths for all modalities
+        file_paths = self.get_brats_scan_paths(patient_folder)
+        print("Found all modalities:", file_paths)
+
+
+        input_data, geometry = self.preprocess_scan(file_paths, timings)
+        start = time.perf_counter()
+        mask = self.infer_batch([input_data], [geometry])[0]
+        if timings is not None:
+            timings["inference"] = time.perf_counter() - start
+        return mask
+
+    @torch.no_grad()
+    def infer_batch(self, inputs, geometries):
+        """
+        Run the model on a list of preprocessed inputs and return one uint8
+        mask per input in the original scan grid. Resized inputs share one
+        forward pass; native-resolution inputs differ in shape, so each is
+        tiled on its own with patches batched up to the memory budget.
+        """
+        if self.inference["mode"] == "sliding_window":
+            outputs = [self.sliding_window(input_data.to(self.device)) for input_data in inputs]
+        else:
+            batch = torch.cat(inputs, dim=0).to(self.device)
+
+            # Make prediction
+            outputs = self.model(batch).split(1)
+
+        return [self.restore(output, geometry) for output, geometry in zip(outputs, geometries)]
+
+    def sliding_window(self, input_data):
+        """
+        Overlapping 128^3 patches over the native-resolution crop, blended
+        with a Gaussian (or constant) weight map
+        """
+        return sliding_window_inference(
+            input_data,
+            roi_size=ROI_SIZE,
+            sw_batch_size=self.sw_batch_size,
+            predictor=self.model,
+            overlap=self.inference["overlap"],
+            mode=self.inference["blend"]
+        )
+
+    def restore(self, output, geometry):
+        """
+        Turn (1, 4, ...) logits into a mask in the original scan grid: undo
+        the resize (if any) and paste the crop back into the full volume
+        """
+        box_start, box_end = geometry["box_start"], geometry["box_end"]
+        crop_shape = tuple(e - s for s, e in zip(box_start, box_end))
+        if tuple(output.shape[2:]) != crop_shape:
+            output = F.interpolate(output, size=crop_shape, mode="trilinear", align_corners=False)
+
+        # Get segmentation mask
+        mask = torch.argmax(output, dim=1)[0].to(torch.uint8).cpu().numpy()
+        full_mask = np.zeros(geometry["spatial_shape"], dtype=np.uint8)
+        full_mask[tuple(slice(s, e) for s, e in zip(box_start, box_end))] = mask
+        return full_mask
+
+    def save_prediction(self, mask, output_path, reference_scan, compression_level=1, compression_threads=1):
+        """
+        Save the prediction mask as a uint8 NIfTI file with the reference
+        scan's affine and header (a path or a NIfTI header); see encoding.save_mask
+        """
+        size = save_mask(mask, output_path, reference_scan, compression_level, compression_threads)
+        print(f"Saved prediction to: {output_path} ({size / 1024:.0f} KB)")
@@ -0,0 +1,115 @@
+"""
+Production server: gunicorn with several worker processes, each with its
+own warm model, batcher and job pool.
+
+The app is imported once in the master (preload_app). The master loads the
+checkpoint before forking, so the workers share the weight pages
+copy-on-write instead of each holding a copy. Warmup, torch's thread pool
+and the engine threads only start in the workers, because thread pools do
+not survive a fork. ONNX Runtime sessions own threads, so the ONNX
+backends are loaded in each worker instead. A hot reload also happens per
+worker, so after one each worker holds its own copy until it is restarted.
+
+Each worker gets torch_threads intra-op threads (cores // workers by
+default) so that the workers do not oversubscribe the cores. On SIGTERM
+gunicorn stops accepting connections and waits up to graceful_timeout for
+in-flight requests. Each worker then gives its background jobs and the
+requests already queued for its batcher the same graceful_timeout to
+finish; jobs still unfinished after it are marked failed in job.json.
+
+Usage: python serve.py [--workers 4] [--bind 0.0.0.0:5000]
+Settings default to the serving section of config.yaml.
+"""
+import os
+os.environ["NEUROVISION_DEFER_START"] = "1"
+
+import argparse
+import time
+
+from gunicorn.app.base import BaseApplication
+
+from backends import DEFAULT_RUNTIME, configure_threads
+
+# Backends whose loaded model holds no threads and can be inherited by a fork
+FORK_SAFE_BACKENDS = ("eager", "torchscript")
+
+
+def torch_threads(serving):
+    return serving.get("torch_threads") or max(1, (os.cpu_count() or 1) // serving["workers"])
+
+
+def post_fork(server, worker):
+    import app as service
+
+    serving = service.config["serving"]
+    runtime = dict(DEFAULT_RUNTIME, **(service.config.get("runtime") or {}))
+    configure_threads(dict(runtime, intra_op_threads=torch_threads(serving)))
+    if service.engine.ready and service.engine.warmup:
+        service.engine.get().warmup()
+    # Loads the model here if the master did not, then watches for reloads
+    service.engine.start()
+    worker.log.info(f"Worker {worker.pid} ready with {torch_threads(serving)} torch threads")
+
+
+def worker_exit(server, worker):
+    import app as service
+
+    timeout = service.config["serving"].get("graceful_timeout")
+    deadline = time.monotonic() + timeout if timeout else None
+    # Jobs go through the batcher, so they are drained first; both share the
+    # graceful timeout, so the worker exits before the arbiter kills it
+    service.jobs.shutdown(wait=True, timeout=timeout)
+    remaining = max(0.0, deadline - time.monotonic()) if deadline else None
+    service.engine.stop(drain=True, timeout=remaining)
+    worker.log.info(f"Worker {worker.pid} drained")
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import app as service
+
+        runtime = dict(DEFAULT_RUNTIME, **(service.config.get("runtime") or {}))
+        if runtime["backend"] in FORK_SAFE_BACKENDS:
+            service.engine.load(warmup=False)
+        return service.app
+
+
+def main():
+    import app as service
+
+    serving = service.config["serving"]
+    if service.config["jobs"]["executor"] != "thread":
+        # A process pool created in the master cannot be used from the forked workers
+        raise SystemExit("serve.py needs jobs.executor: thread; each worker is already a process")
+
+    parser = argparse.ArgumentParser(description="Serve the API with gunicorn")
+    parser.add_argument("--bind", default=serving["bind"])
+    parser.add_argument("--workers", type=int, default=serving["workers"])
+    parser.add_argument("--threads", type=int, default=serving["threads"])
+    args = parser.parse_args()
+    # post_fork reads the worker count from here
+    serving.update(workers=args.workers, threads=args.threads)
+
+    Server({
+        "bind": args.bind,
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+        "preload_app": True,
+        "timeout": serving["timeout"],
+        "graceful_timeout": serving["graceful_timeout"],
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import nibabel as nib
+import numpy as np
+from nibabel.affines import apply_affine
+from scipy import ndimage
+
+LABEL_NAMES = {1: "necrotic", 2: "edema", 3: "enhancing"}
+# Same as meshing.TUMOR_LABELS, without pulling VTK into the stats workers
+TUMOR_LABELS = tuple(LABEL_NAMES)
+# 26-connectivity: voxels touching at a corner belong to the same component
+CONNECTIVITY = np.ones((3, 3, 3), dtype=bool)
+
+
+# Voxels label_marginals widens to intp at a time (32 MB per key array)
+MARGINAL_SLAB_VOXELS = 1 << 22
+
+
+def label_marginals(seg_data, n_labels, slab_voxels=MARGINAL_SLAB_VOXELS):
+    """
+    Per-label voxel counts along each axis, shape (n_labels, axis length),
+    from one pass over the mask in its stored dtype. The mask is read in
+    slabs of whole sagittal planes, and only the slab is widened to intp
+    for its keys, so memory stays bounded whatever the volume size. Each
+    slab is bincounted once on (label, x, y), which gives the counts along
+    x and y, and once on (label, z).
+    """
+    nx, ny, nz = seg_data.shape
+    per_xy = np.zeros((n_labels, nx, ny), dtype=np.int64)
+    per_z = np.zeros((n_labels, nz), dtype=np.int64)
+    step = max(1, slab_voxels // max(ny * nz, 1))
+    for x in range(0, nx, step):
+        slab = seg_data[x:x + step].astype(np.intp)
+        planes = slab.shape[0]
+        xy_index = np.arange(planes * ny).reshape(planes, ny, 1)
+        counts = np.bincount((slab * (planes * ny) + xy_index).ravel(), minlength=n_labels * planes * ny)
+        per_xy[:, x:x + planes] = counts.reshape(n_labels, planes, ny)
+        slab *= nz
+        slab += np.arange(nz)
+        per_z += np.bincount(slab.ravel(), minlength=n_labels * nz).reshape(n_labels, nz)
+    return per_xy.sum(axis=2), per_xy.sum(axis=1), per_z
+
+
+def segmentation_statistics(seg_data, spacing=(1, 1, 1), affine=None, labels=TUMOR_LABELS, components=True):
+    """
+    Statistics for every label of an integer label map: voxel count, volume
+    in mm^3, percentage of the field of view and of the tumor, bounding box,
+    centroid (voxel and, given the affine, world coordinates) and the number
+    of connected components. Counts, boxes and centroids all come from the
+    per-axis marginals, so the full volume is only read once; components
+    are labelled inside each label's bounding box only.
+    """
+    seg_data = np.asanyarray(seg_data)
+    if not np.issubdtype(seg_data.dtype, np.integer):
+        seg_data = np.rint(seg_data).astype(np.uint8)
+    if np.issubdtype(seg_data.dtype, np.signedinteger) and seg_data.size and seg_data.min() < 0:
+        raise ValueError("Label maps must not contain negative labels")
+
+    n_labels = max(int(seg_data.max()) if seg_data.size else 0, max(labels)) + 1
+    marginals = label_marginals(seg_data, n_labels)
+    counts = marginals[0].sum(axis=1)
+    voxel_volume = float(np.prod(spacing))
+    total_voxels = int(seg_data.size)
+    tumor_voxels = int(sum(counts[label] for label in labels))
+
+    result = {
+        "shape": [int(n) for n in seg_data.shape],
+        "spacing": [float(s) for s in spacing],
+        "total_voxels": total_voxels,
+        "tumor_voxels": tumor_voxels,
+        "tumor_volume_mm3": tumor_voxels * voxel_volume,
+        "labels": {},
+    }
+    for label in labels:
+        count = int(counts[label])
+        entry = {
+            "name": LABEL_NAMES.get(label, str(label)),
+            "voxels": count,
+            "volume_mm3": count * voxel_volume,
+            "percent": count / total_voxels * 100 if total_voxels else 0.0,
+            "percent_of_tumor": count / tumor_voxels * 100 if tumor_voxels else 0.0,
+            "bbox": None,
+            "centroid_voxel": None,
+            "centroid_mm": None,
+            "components": 0,
+        }
+        if count:
+            box = []
+            centroid = []
+            for marginal in marginals:
+                nonzero = np.flatnonzero(marginal[label])
+                box.append([int(nonzero[0]), int(nonzero[-1]) + 1])
+                centroid.append(float(marginal[label] @ np.arange(marginal.shape[1])) / count)
+            entry["bbox"] = box
+            entry["centroid_voxel"] = centroid
+            if affine is not None:
+                entry["centroid_mm"] = apply_affine(affine, centroid).tolist()
+            if components:
+                crop = seg_data[tuple(slice(start, stop) for start, stop in box)]
+                _, entry["components"] = ndimage.label(crop == label, structure=CONNECTIVITY)
+        result["labels"][str(label)] = entry
+    return result
+
+
+def file_statistics(segmentation_path, labels=TUMOR_LABELS, components=True):
+    """
+    segmentation_statistics() for a NIfTI label map, read in its stored
+    dtype with the spacing and affine from its header
+    """
+    nifti = nib.load(segmentation_path)
+    seg_data = np.asanyarray(nifti.dataobj)
+    stats = segmentation_statistics(seg_data, nifti.header.get_zooms()[:3], nifti.affine, labels, components)
+    stats["path"] = segmentation_path
+    return stats
+
+
+def calculate_segmentation_statistics(segmentation_path):
+    """
+    The flat summary the visual.py and visual_2.py viewers print: voxels,
+    percent and volume per named label, without connected components
+    """
+    stats = file_statistics(segmentation_path, components=False)
+    result = {"total_voxels": stats["total_voxels"]}
+    for label, name in LABEL_NAMES.items():
+        entry = stats["labels"][str(label)]
+        result[f"{name}_voxels"] = entry["voxels"]
+        result[f"{name}_percent"] = entry["percent"]
+        result[f"{name}_volume_mm3"] = entry["volume_mm3"]
+    return result
+
+
+def _file_statistics_or_error(segmentation_path):
+    try:
+        return file_statistics(segmentation_path)
+    except Exception as e:
+        return {"path": segmentation_path, "error": str(e)}
+
+
+def batch_statistics(segmentation_paths, executor, chunksize=4):
+    """
+    file_statistics() over many files on an executor, in input order. A file
+    that cannot be read gets {"path", "error"} instead of failing the batch.
+    """
+    return list(executor.map(_file_statistics_or_error, segmentation_paths, chunksize=chunksize))
@@ -0,0 +1,144 @@
+import itertools
+import time
+
+import torch
+from monai.inferers import sliding_window_inference
+
+from backends import load_backend
+from cache import file_digest
+from segmentation import ROI_SIZE
+
+SPATIAL_DIMS = (2, 3, 4)
+# Identity first, then single-axis flips, then pairs, then all three
+FLIPS = [dims for n in range(len(SPATIAL_DIMS) + 1) for dims in itertools.combinations(SPATIAL_DIMS, n)]
+
+DEFAULT_TTA = {
+    # Total views (model x flip); 1 is the plain single forward pass
+    "max_views": 8,
+    # Use the extra checkpoints as well as the served one
+    "ensemble": False,
+    # Stop once adding views changes fewer than (1 - agreement) of the tumor voxels
+    "agreement": 0.995,
+    "min_views": 2,
+}
+
+
+class TTAEnsemble:
+    """
+    Flip test-time augmentation over one or more checkpoints.
+
+    All views of an input are stacked into batches of up to the segmenter's
+    patch budget, so 8 flips of a resized input take two forward passes
+    rather than eight. In sliding-window mode the views are applied per patch
+    batch, so patch extraction and blending are shared by every view.
+    Softmax probabilities are summed into one buffer in place, and views are
+    added in rounds; once a round barely changes the consensus, the rest are
+    skipped.
+    """
+    def __init__(self, segmenter, checkpoints=()):
+        self.segmenter = segmenter
+        self.models = [segmenter.model]
+        self.digests = [segmenter.weights_digest]
+        for path in checkpoints:
+            digest = file_digest(path)
+            self.models.append(load_backend(path, segmenter.runtime, segmenter.device, digest))
+            self.digests.append(digest)
+        self.max_batch = segmenter.sw_batch_size
+
+    def views(self, max_views, ensemble):
+        """
+        (model index, flip dims) pairs: every model's unflipped view first,
+        so the early rounds already combine the whole ensemble
+        """
+        model_count = len(self.models) if ensemble else 1
+        views = [(model_index, dims) for dims in FLIPS for model_index in range(model_count)]
+        return views[:max(1, max_views)]
+
+    def _forward_views(self, input_data, views):
+        """
+        Summed softmax over `views` of a (B, 4, ...) batch, flipped back to
+        the input orientation
+        """
+        total = None
+        batch_size = input_data.shape[0]
+        per_pass = max(1, self.max_batch // batch_size)
+        for model_index, group in itertools.groupby(views, key=lambda view: view[0]):
+            model = self.models[model_index]
+            flips = [dims for _, dims in group]
+            for i in range(0, len(flips), per_pass):
+                chunk = flips[i:i + per_pass]
+                batch = torch.cat([input_data.flip(dims) if dims else input_data for dims in chunk])
+                output = model(batch)
+                for j, dims in enumerate(chunk):
+                    probs = torch.softmax(output[j * batch_size:(j + 1) * batch_size].float(), dim=1)
+                    if dims:
+                        probs = probs.flip(dims)
+                    if total is None:
+                        total = probs
+                    else:
+                        total.add_(probs)
+        return total
+
+    def _run_round(self, input_data, views):
+        if self.segmenter.inference["mode"] != "sliding_window":
+            return self._forward_views(input_data, views)
+        return sliding_window_inference(
+            input_data,
+            roi_size=ROI_SIZE,
+            sw_batch_size=max(1, self.max_batch // len(views)),
+            predictor=lambda patches: self._forward_views(patches, views),
+            overlap=self.segmenter.inference["overlap"],
+            mode=self.segmenter.inference["blend"]
+        )
+
+    @torch.no_grad()
+    def infer(self, input_data, geometry, options=None, timings=None):
+        """
+        Mask in the original scan grid. `timings`, if given, gets the number
+        of views used and the agreement of the last round.
+        """
+        options = dict(DEFAULT_TTA, **(options or {}))
+        views = self.views(options["max_views"], options["ensemble"])
+        input_data = input_data.to(self.segmenter.device)
+
+        start = time.perf_counter()
+        # A small first round gives the consensus early, then full batches
+        rounds = [views[:options["min_views"]]]
+        rounds += [views[i:i + self.max_batch] for i in range(options["min_views"], len(views), self.max_batch)]
+
+        total = None
+        previous = None
+        used = 0
+        agreement = None
+        for round_views in rounds:
+            if not round_views:
+                continue
+            probs = self._run_round(input_data, round_views)
+            total = probs if total is None else total.add_(probs)
+            used += len(round_views)
+            if used == len(views) or not options["agreement"]:
+                continue
+
+            current = total.argmax(dim=1)
+            if previous is not None:
+                tumor = (current > 0) | (previous > 0)
+                voxels = int(tumor.sum())
+                agreement = 1.0 if voxels == 0 else float((current[tumor] == previous[tumor]).float().mean())
+                if agreement >= options["agreement"]:
+                    break
+            previous = current
+
+        if timings is not None:
+            timings["tta_views"] = used
+            timings["tta_max_views"] = len(views)
+            timings["tta_agreement"] = agreement
+            timings["tta_seconds"] = time.perf_counter() - start
+        return self.segmenter.restore(total, geometry)
+
+    def cache_params(self, options):
+        """
+        Everything about a TTA request that changes its mask
+        """
+        options = dict(DEFAULT_TTA, **(options or {}))
+        digests = self.digests if options["ensemble"] else self.digests[:1]
+        return {"digests": digests, **options}
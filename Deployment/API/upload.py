@@ -0,0 +1,373 @@
+"""
+Receiving a study in the request body instead of from a folder on the host.
+
+The body is either multipart/form-data with one file part per modality or
+a tar archive (optionally gzip-compressed) of the modality files. It is read
+from the request stream in chunk_kb pieces and never written to disk:
+
+    - a .nii.gz part is inflated chunk by chunk (concatenated gzip members
+      included) and a raw .nii part is copied as it comes
+    - once the 348-byte NIfTI header is in, the voxel buffer is allocated
+      at its final size and the rest of the part is written straight into
+      it; a part that holds more data than its header declares is rejected
+    - as soon as a part is complete, its intensity transform is submitted to
+      the segmenter's modality pool, so it overlaps with receiving the next
+
+Memory is bounded by one chunk plus the voxel buffers of the modalities
+received so far. Limits (compressed part size, decoded part size, total
+body size) come from the upload section of config.yaml. Parts are named by
+their field name or file name (t1, t1ce, t2, flair, BraTS naming included);
+other files, such as a label map, are skipped.
+"""
+import hashlib
+import tarfile
+import time
+import zlib
+
+import nibabel as nib
+import numpy as np
+import torch
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from segmentation import MODALITIES
+
+DEFAULT_UPLOAD = {
+    "chunk_kb": 1024,
+    # Per modality, as sent (compressed) and once decoded
+    "max_part_mb": 256,
+    "max_decoded_mb": 512,
+    # Whole request body
+    "max_total_mb": 1024,
+}
+TAR_TYPES = ("application/x-tar", "application/tar", "application/gzip", "application/x-gzip",
+             "application/x-gtar", "application/x-compressed-tar")
+NIFTI1_HEADER_SIZE = 348
+# Extensions between the header and the voxels; more than this is refused
+MAX_EXTENSIONS_BYTES = 1 << 20
+# Multipart fields other than files (e.g. "quality") are short strings
+MAX_FIELD_BYTES = 4096
+
+
+class UploadError(ValueError):
+    pass
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+def upload_options(upload=None):
+    return dict(DEFAULT_UPLOAD, **(upload or {}))
+
+
+def modality_of(name):
+    """
+    "t1ce", "t1ce.nii.gz", "BraTS2021_00000_t1ce.nii.gz" -> "t1ce"; None otherwise
+    """
+    if not name:
+        return None
+    name = name.replace("\\", "/").rsplit("/", 1)[-1].lower()
+    if name.startswith("."):
+        # Hidden files, e.g. the ._ resource forks macOS adds to archives
+        return None
+    for suffix in (".nii.gz", ".nii"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    modality = name.rsplit("_", 1)[-1]
+    return modality if modality in MODALITIES else None
+
+
+class LimitedStream:
+    """
+    File-like view of the request stream that fails once more than
+    max_bytes have been read
+    """
+    def __init__(self, stream, max_bytes):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        if self.bytes_read > self.max_bytes:
+            raise UploadTooLarge(f"Request body is larger than {self.max_bytes >> 20} MB")
+        return data
+
+
+class NiftiStream:
+    """
+    One modality, decoded as its bytes arrive. feed() takes the part's bytes
+    as sent; finish() returns the NIfTI header and the voxels as float32,
+    scaled like nibabel's dataobj.
+    """
+    def __init__(self, name, max_part_bytes, max_decoded_bytes, chunk_size):
+        self.name = name
+        self.max_part_bytes = max_part_bytes
+        self.max_decoded_bytes = max_decoded_bytes
+        self.chunk_size = chunk_size
+        # Same digest as cache.file_digest of the file on disk, so an uploaded
+        # study shares cache entries with the same files sent by path
+        self.digest = hashlib.blake2b(digest_size=20)
+        self.part_bytes = 0
+        self.decode_seconds = 0.0
+        self._inflater = None
+        self._compressed = None
+        self._head = bytearray()
+        self.header = None
+        self._data_offset = None
+        self._buffer = None
+        self._filled = 0
+
+    def feed(self, data):
+        if not data:
+            return
+        start = time.perf_counter()
+        self.part_bytes += len(data)
+        if self.part_bytes > self.max_part_bytes:
+            raise UploadTooLarge(f"{self.name} is larger than {self.max_part_bytes >> 20} MB")
+        self.digest.update(data)
+        if self._compressed is None:
+            self._compressed = bytes(data[:2]) == b"\x1f\x8b"
+        if self._compressed:
+            try:
+                self._inflate(data)
+            except zlib.error as e:
+                raise UploadError(f"{self.name} is not a valid gzip stream: {e}")
+        else:
+            self._write(data)
+        self.decode_seconds += time.perf_counter() - start
+
+    def _inflate(self, data):
+        while True:
+            if self._inflater is None:
+                self._inflater = zlib.decompressobj(wbits=31)
+            # Bounded output per call, so a small, highly compressed part
+            # cannot expand past the buffer before the size check
+            output = self._inflater.decompress(data, self.chunk_size)
+            self._write(output)
+            data = self._inflater.unconsumed_tail
+            if self._inflater.eof:
+                # Concatenated gzip members form one stream
+                data = self._inflater.unused_data
+                self._inflater = None
+                if not data:
+                    return
+            elif not data and len(output) < self.chunk_size:
+                # Input used up and no output held back by the size bound
+                return
+
+    def _write(self, data):
+        view = memoryview(data)
+        while len(view):
+            if self._buffer is None:
+                target = NIFTI1_HEADER_SIZE if self.header is None else self._data_offset
+                take = view[:target - len(self._head)]
+                self._head += take
+                view = view[len(take):]
+                if self.header is None and len(self._head) == NIFTI1_HEADER_SIZE:
+                    self._parse_header()
+                if self.header is not None and len(self._head) == self._data_offset:
+                    self._buffer = np.empty(self._nbytes, dtype=np.uint8)
+                continue
+            if self._filled + len(view) > self._nbytes:
+                raise UploadError(f"{self.name} holds more data than its header declares")
+            self._buffer[self._filled:self._filled + len(view)] = np.frombuffer(view, dtype=np.uint8)
+            self._filled += len(view)
+            view = view[len(view):]
+
+    def _parse_header(self):
+        try:
+            header = nib.Nifti1Header(binaryblock=bytes(self._head))
+        except Exception as e:
+            raise UploadError(f"{self.name} is not a NIfTI-1 file: {e}")
+        if header["magic"].item() != b"n+1":
+            raise UploadError(f"{self.name} is not a single-file NIfTI-1 volume")
+        shape = header.get_data_shape()
+        if len(shape) == 4 and shape[3] == 1:
+            shape = shape[:3]
+        if len(shape) != 3:
+            raise UploadError(f"{self.name} has shape {shape}, expected a 3D volume")
+        self._shape = shape
+        self._dtype = header.get_data_dtype()
+        self._nbytes = int(np.prod(shape)) * self._dtype.itemsize
+        if self._nbytes > self.max_decoded_bytes:
+            raise UploadTooLarge(f"{self.name} decodes to {self._nbytes >> 20} MB, "
+                                 f"more than {self.max_decoded_bytes >> 20} MB")
+        self._data_offset = int(header["vox_offset"])
+        if not NIFTI1_HEADER_SIZE <= self._data_offset <= NIFTI1_HEADER_SIZE + MAX_EXTENSIONS_BYTES:
+            raise UploadError(f"{self.name} has an invalid vox_offset {self._data_offset}")
+        self.header = header
+
+    def finish(self):
+        if self._compressed and self._inflater is not None:
+            raise UploadError(f"{self.name} is a truncated gzip stream")
+        if self._buffer is None or self._filled != self._nbytes:
+            raise UploadError(f"{self.name} is truncated")
+        volume = self._buffer.view(self._dtype).reshape(self._shape, order="F").astype(np.float32)
+        slope, inter = self.header.get_slope_inter()
+        if slope is not None:
+            volume *= slope
+            volume += inter or 0.0
+        self._buffer = None
+        return self.header, volume
+
+
+class StudyUpload:
+    """
+    Collects the parts of one upload and preprocesses each modality on the
+    segmenter's modality pool as soon as it is complete
+    """
+    def __init__(self, segmenter, options):
+        self.segmenter = segmenter
+        self.options = options
+        self.chunk_size = options["chunk_kb"] * 1024
+        self.fields = {}
+        self.digests = {}
+        self.headers = {}
+        self.futures = {}
+        self.decode_seconds = 0.0
+        self._part = None
+        self._field = None
+
+    def start_file(self, name, filename):
+        modality = modality_of(name) or modality_of(filename)
+        if modality is None:
+            # Not a modality (e.g. the label map): read past it
+            self._part = None
+            return
+        if modality in self.futures:
+            raise UploadError(f"{modality} was sent twice")
+        self._part = NiftiStream(modality, self.options["max_part_mb"] << 20,
+                                 self.options["max_decoded_mb"] << 20, self.chunk_size)
+
+    def start_field(self, name):
+        self._field = (name, bytearray())
+
+    def data(self, data):
+        if self._field is not None:
+            self._field[1].extend(data)
+            if len(self._field[1]) > MAX_FIELD_BYTES:
+                raise UploadTooLarge(f"Field {self._field[0]} is longer than {MAX_FIELD_BYTES} bytes")
+        elif self._part is not None:
+            self._part.feed(data)
+
+    def end(self):
+        if self._field is not None:
+            name, value = self._field
+            self.fields[name] = value.decode("utf-8", errors="replace")
+            self._field = None
+            return
+        part, self._part = self._part, None
+        if part is None:
+            return
+        header, volume = part.finish()
+        self.decode_seconds += part.decode_seconds
+        self.digests[part.name] = part.digest.hexdigest()
+        self.headers[part.name] = header
+        self.futures[part.name] = self.segmenter.io_pool.submit(self._transform, volume)
+
+    def _transform(self, volume):
+        start = time.perf_counter()
+        scan = self.segmenter.transforms(torch.from_numpy(volume)[None])
+        return scan, time.perf_counter() - start
+
+    def result(self):
+        """
+        Content digests in MODALITIES order, a prepare(segmenter, timings)
+        callable for InferenceEngine.predict_input and the T1 header, which
+        the mask is saved with
+        """
+        missing = [m for m in MODALITIES if m not in self.futures]
+        if missing:
+            raise UploadError(f"Missing modalities: {missing}")
+        shapes = {m: self.headers[m].get_data_shape()[:3] for m in MODALITIES}
+        if len(set(shapes.values())) != 1:
+            raise UploadError(f"Modalities differ in shape: {shapes}")
+
+        def prepare(segmenter, timings=None):
+            start = time.perf_counter()
+            results = [self.futures[m].result() for m in MODALITIES]
+            input_data, geometry = segmenter.assemble([scan for scan, _ in results])
+            if timings is not None:
+                # Parts are decoded one after another on the request thread,
+                # while the transforms run concurrently on the modality pool
+                timings["decode"] = self.decode_seconds
+                timings["transform"] = max(seconds for _, seconds in results)
+                timings["preprocess"] = time.perf_counter() - start
+            return input_data, geometry
+        return [self.digests[m] for m in MODALITIES], prepare, self.headers[MODALITIES[0]]
+
+
+def read_multipart(stream, boundary, study):
+    decoder = MultipartDecoder(boundary.encode("latin-1"), max_form_memory_size=4 * study.chunk_size)
+    try:
+        while True:
+            chunk = stream.read(study.chunk_size)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File):
+                    study.start_file(event.name, event.filename)
+                elif isinstance(event, Field):
+                    study.start_field(event.name)
+                elif isinstance(event, Data):
+                    study.data(event.data)
+                    if not event.more_data:
+                        study.end()
+                event = decoder.next_event()
+            if isinstance(event, Epilogue):
+                return
+    except RequestEntityTooLarge:
+        raise UploadTooLarge("Multipart headers are too large")
+    except UploadError:
+        raise
+    except ValueError as e:
+        raise UploadError(f"Malformed multipart body: {e}")
+
+
+def read_tar(stream, study):
+    try:
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                if member.size > study.options["max_part_mb"] << 20:
+                    raise UploadTooLarge(f"{member.name} is larger than {study.options['max_part_mb']} MB")
+                study.start_file(None, member.name)
+                file = archive.extractfile(member)
+                for chunk in iter(lambda: file.read(study.chunk_size), b""):
+                    study.data(chunk)
+                study.end()
+    except tarfile.TarError as e:
+        raise UploadError(f"Malformed tar body: {e}")
+
+
+def receive_study(stream, mimetype, mimetype_params, content_length, segmenter, options=None, timings=None):
+    """
+    Read a study from a request body (see the module docstring). Returns
+    (digests, prepare, reference header, form fields).
+    """
+    options = upload_options(options)
+    max_total = options["max_total_mb"] << 20
+    if content_length is not None and content_length > max_total:
+        raise UploadTooLarge(f"Request body is larger than {options['max_total_mb']} MB")
+
+    start = time.perf_counter()
+    stream = LimitedStream(stream, max_total)
+    study = StudyUpload(segmenter, options)
+    if mimetype == "multipart/form-data":
+        if "boundary" not in mimetype_params:
+            raise UploadError("multipart/form-data without a boundary")
+        read_multipart(stream, mimetype_params["boundary"], study)
+    elif mimetype in TAR_TYPES:
+        read_tar(stream, study)
+    else:
+        raise UploadError(f"Unsupported content type {mimetype}, expected multipart/form-data or a tar archive")
+    digests, prepare, reference = study.result()
+    if timings is not None:
+        timings["upload"] = time.perf_counter() - start
+        timings["upload_bytes"] = stream.bytes_read
+    return digests, prepare, reference, study.fields
@@ -0,0 +1,75 @@
+"""
+Check exported backends against eager float32 PyTorch on real cases.
+
+Each case is preprocessed once, then segmented by the eager reference and
+by every backend under test. Per-label Dice (necrotic, edema, enhancing)
+between each backend's mask and the reference must stay above --min_dice
+(--min_dice_int8 for the quantized backends); the exit code is 1 otherwise,
+so this can gate a deployment.
+
+Usage: python validate_backends.py --patient_folders "BraTS2021_00000/Paitent 1" \
+           --backends torchscript onnx onnx_int8_static
+Run export.py for the same checkpoint first.
+"""
+import argparse
+import sys
+
+import numpy as np
+import yaml
+
+from backends import ARTIFACTS
+from segmentation import BrainTumorSegmentation
+from stats import LABEL_NAMES
+
+
+def dice(reference, mask, label):
+    a = reference == label
+    b = mask == label
+    total = int(a.sum()) + int(b.sum())
+    # Both empty is perfect agreement
+    return 1.0 if total == 0 else 2.0 * int(np.logical_and(a, b).sum()) / total
+
+
+def main():
+    config = yaml.safe_load(open("config.yaml"))
+    runtime = config.get("runtime") or {}
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=config["model"]["path"])
+    parser.add_argument("--patient_folders", nargs="+", default=["BraTS2021_00000/Paitent 1"])
+    parser.add_argument("--backends", nargs="+", default=list(ARTIFACTS), choices=list(ARTIFACTS))
+    parser.add_argument("--channels_last", action="store_true")
+    parser.add_argument("--min_dice", type=float, default=0.99)
+    parser.add_argument("--min_dice_int8", type=float, default=0.95)
+    args = parser.parse_args()
+
+    inference = config.get("inference")
+    reference = BrainTumorSegmentation(args.model, inference, dict(runtime, backend="eager", channels_last=False))
+    segmenters = {
+        backend: BrainTumorSegmentation(args.model, inference,
+                                        dict(runtime, backend=backend, channels_last=args.channels_last))
+        for backend in args.backends
+    }
+
+    worst = {backend: 1.0 for backend in args.backends}
+    for patient_folder in args.patient_folders:
+        input_data, geometry = reference.preprocess_scan(reference.get_brats_scan_paths(patient_folder))
+        expected = reference.infer_batch([input_data], [geometry])[0]
+        for backend, segmenter in segmenters.items():
+            mask = segmenter.infer_batch([input_data], [geometry])[0]
+            scores = {name: dice(expected, mask, label) for label, name in LABEL_NAMES.items()}
+            worst[backend] = min(worst[backend], *scores.values())
+            print(f"{patient_folder} {backend:>17}: " + "  ".join(f"{name} {score:.4f}" for name, score in scores.items()))
+
+    failed = []
+    for backend, score in worst.items():
+        threshold = args.min_dice_int8 if "int8" in backend else args.min_dice
+        ok = score >= threshold
+        print(f"{backend:>17}: worst Dice {score:.4f} (min {threshold}) {'ok' if ok else 'FAILED'}")
+        if not ok:
+            failed.append(backend)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
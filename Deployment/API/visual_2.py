@@ -1,74 +1,21 @@
-import os
-import nibabel as nib
-import numpy as np
 import pyvista as pv
-
-def load_nifti(file_path):
-    """Load a NIfTI file and return its data and affine matrix."""
-    nifti = nib.load(file_path)
-    data = nifti.get_fdata()
-    affine = nifti.affine
-    return data, affine
-
-def create_3d_mesh(data, threshold=0.5):
-    """Create a 3D mesh from the segmentation data using a threshold."""
-    grid = pv.ImageData()
-    grid.dimensions = data.shape
-    grid.spacing = (1, 1, 1)  # Adjust spacing if needed
-    grid.point_data["values"] = data.flatten(order="F")
-    mesh = grid.contour([threshold])
-    return mesh
-
-def calculate_segmentation_statistics(seg_data):
-    """Calculate segmentation statistics."""
-    total_voxels = seg_data.size
-    necrotic_voxels = np.sum(seg_data == 1)
-    edema_voxels = np.sum(seg_data == 2)
-    enhancing_voxels = np.sum(seg_data == 3)
-
-    necrotic_percent = (necrotic_voxels / total_voxels) * 100
-    edema_percent = (edema_voxels / total_voxels) * 100
-    enhancing_percent = (enhancing_voxels / total_voxels) * 100
-
-    return {
-        "total_voxels": total_voxels,
-        "necrotic_voxels": necrotic_voxels,
-        "edema_voxels": edema_voxels,
-        "enhancing_voxels": enhancing_voxels,
-        "necrotic_percent": necrotic_percent,
-        "edema_percent": edema_percent,
-        "enhancing_percent": enhancing_percent,
-    }
+from meshing import modality_mesh, label_meshes
+from stats import calculate_segmentation_statistics
 
 def visualize_3d_brain(segmentation_path, t1_path, t1ce_path, t2_path, flair_path):
     """Visualize the 3D brain with segmentation and other modalities."""
-    # Load the segmentation mask
-    seg_data, seg_affine = load_nifti(segmentation_path)
-    
-    # Load other modalities
-    t1_data, _ = load_nifti(t1_path)
-    t1ce_data, _ = load_nifti(t1ce_path)
-    t2_data, _ = load_nifti(t2_path)
-    flair_data, _ = load_nifti(flair_path)
-
-    
-    stats = calculate_segmentation_statistics(seg_data)
-
-   
-    necrotic_core = (seg_data == 1).astype(np.float32)  
-    peritumoral_edema = (seg_data == 2).astype(np.float32)  # Peritumoral edema
-    enhancing_tumor = (seg_data == 3).astype(np.float32)  # Enhancing tumor
+    stats = calculate_segmentation_statistics(segmentation_path)
 
  
-    necrotic_mesh = create_3d_mesh(necrotic_core, threshold=0.5)
-    edema_mesh = create_3d_mesh(peritumoral_edema, threshold=0.5)
-    enhancing_mesh = create_3d_mesh(enhancing_tumor, threshold=0.5)
+    # Meshes for the three tumor sub-regions, built in one pass and cached on disk
+    segmentation_meshes = label_meshes(segmentation_path)
+    necrotic_mesh = segmentation_meshes[1]
+    edema_mesh = segmentation_meshes[2]  # Peritumoral edema
+    enhancing_mesh = segmentation_meshes[3]  # Enhancing tumor
 
 
-    t1_mesh = create_3d_mesh(t1_data, threshold=0.2)    # T1
-    t1ce_mesh = create_3d_mesh(t1ce_data, threshold=0.2) # T1ce
-    t2_mesh = create_3d_mesh(t2_data, threshold=0.2)    # T2
-    flair_mesh = create_3d_mesh(flair_data, threshold=0.2) # FLAIR
+    # Only T1 is shown in this view, so the other modalities are not meshed
+    t1_mesh = modality_mesh(t1_path, threshold=0.2)    # T1
 
   
     plotter = pv.Plotter(shape=(2, 2))  # 2x2 grid for multi-planar views
@@ -102,9 +49,9 @@ def visualize_3d_brain(segmentation_path, t1_path, t1ce_path, t2_path, flair_pat
     stats_text = (
         f"Segmentation Statistics:\n"
         f"Total volume: {stats['total_voxels']} voxels\n"
-        f"Necrotic core: {stats['necrotic_voxels']} voxels ({stats['necrotic_percent']:.2f}%)\n"
-        f"Peritumoral edema: {stats['edema_voxels']} voxels ({stats['edema_percent']:.2f}%)\n"
-        f"Enhancing tumor: {stats['enhancing_voxels']} voxels ({stats['enhancing_percent']:.2f}%)"
+        f"Necrotic core: {stats['necrotic_voxels']} voxels ({stats['necrotic_percent']:.2f}%, {stats['necrotic_volume_mm3'] / 1000:.1f} ml)\n"
+        f"Peritumoral edema: {stats['edema_voxels']} voxels ({stats['edema_percent']:.2f}%, {stats['edema_volume_mm3'] / 1000:.1f} ml)\n"
+        f"Enhancing tumor: {stats['enhancing_voxels']} voxels ({stats['enhancing_percent']:.2f}%, {stats['enhancing_volume_mm3'] / 1000:.1f} ml)"
     )
     plotter.add_text(
         stats_text,
@@ -0,0 +1,169 @@
+"""
+Benchmark suite for the whole pipeline on synthetic data, offline on CPU.
+
+Generates --cases BraTS-like cases of --shape voxels (see synthetic.py) in a
+workspace with its own config.yaml and params.yaml, then times each stage in
+a separate process (stage.py):
+
+    validate    utils.validate_case on each label map
+    collate     pre_process.collate_func over all cases, from an empty manifest
+    loader      batches from train.py's data loader (params.loader: nifti)
+    preprocess  BrainTumorSegmentation.preprocess_scan per case
+    predict     BrainTumorSegmentation.predict per case (random weights)
+    mesh        meshing.create_3d_mesh of the T1 volume
+    stats       stats.calculate_segmentation_statistics per label map
+
+and reports latency percentiles per call, throughput (cases or samples per
+second) and the stage process's peak RSS.
+
+--save writes the results as a JSON baseline. --baseline compares against
+one and exits with status 1 if a stage is slower (p50 or p95), has lower
+throughput or a higher peak RSS by more than --threshold (relative).
+Baselines are only compared with runs of the same settings (cases, shape,
+repeats, loader workers).
+
+Usage (from the repository root):
+    python benchmarks/run.py --cases 4 --shape 240 240 155 --save benchmarks/baseline.json
+    python benchmarks/run.py --cases 4 --shape 240 240 155 --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from synthetic import write_cases
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+STAGES = ("validate", "collate", "loader", "preprocess", "predict", "mesh", "stats")
+# (metric, True if higher is better)
+COMPARED = (("p50_ms", False), ("p95_ms", False), ("throughput", True), ("peak_rss_mb", False))
+
+
+def prepare_workspace(workspace, cases, shape, num_workers):
+    """
+    Synthetic cases under workspace/data/raw plus config.yaml and params.yaml
+    copies whose relative paths all resolve inside the workspace
+    """
+    write_cases(os.path.join(workspace, "data", "raw"), cases, shape)
+    with open(os.path.join(REPO, "config.yaml")) as f:
+        config = yaml.safe_load(f)
+    with open(os.path.join(REPO, "params.yaml")) as f:
+        params = yaml.safe_load(f)
+    params["params"].update(
+        loader="nifti", cache="none", batch_size=2, num_workers=num_workers, pin_memory=False
+    )
+    with open(os.path.join(workspace, "config.yaml"), "w") as f:
+        yaml.safe_dump(config, f)
+    with open(os.path.join(workspace, "params.yaml"), "w") as f:
+        yaml.safe_dump(params, f)
+
+
+def run_stage(stage, workspace, repeats):
+    output = os.path.join(workspace, f"{stage}.json")
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES="")
+    process = subprocess.run([sys.executable, os.path.join(HERE, "stage.py"), stage, workspace, str(repeats), output],
+                             env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        return {"stage": stage, "error": process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "failed"}
+    with open(output) as f:
+        return json.load(f)
+
+
+def regressions(results, baseline, threshold):
+    """
+    [(stage, metric, baseline value, new value)] for every metric worse than
+    the baseline by more than threshold
+    """
+    found = []
+    for stage, result in results.items():
+        previous = baseline["stages"].get(stage)
+        if previous is None or "error" in previous or "error" in result:
+            continue
+        for metric, higher_is_better in COMPARED:
+            old, new = previous[metric], result[metric]
+            if not old:
+                continue
+            change = (old - new) / old if higher_is_better else (new - old) / old
+            if change > threshold:
+                found.append((stage, metric, old, new))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on synthetic data")
+    parser.add_argument("--cases", type=int, default=4)
+    parser.add_argument("--shape", type=int, nargs=3, default=[240, 240, 155])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--num_workers", type=int, default=2, help="DataLoader workers for the loader stage")
+    parser.add_argument("--workspace", default=None, help="Reuse generated data across runs (default: temporary)")
+    parser.add_argument("--save", default=None, help="Write the results as a baseline JSON")
+    parser.add_argument("--baseline", default=None, help="Compare against this baseline JSON")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    temporary = None
+    workspace = args.workspace
+    if workspace is None:
+        temporary = tempfile.TemporaryDirectory(prefix="neurovision-bench-")
+        workspace = temporary.name
+    workspace = os.path.abspath(workspace)
+
+    try:
+        start = time.perf_counter()
+        prepare_workspace(workspace, args.cases, args.shape, args.num_workers)
+        print(f"{args.cases} synthetic cases of {tuple(args.shape)} in {workspace} "
+              f"({time.perf_counter() - start:.1f}s)")
+
+        results = {}
+        print(f"{'stage':12s} {'p50 ms':>10s} {'p95 ms':>10s} {'throughput':>16s} {'peak RSS MB':>12s}")
+        for stage in args.stages:
+            result = run_stage(stage, workspace, args.repeats)
+            results[stage] = result
+            if "error" in result:
+                print(f"{stage:12s} failed: {result['error']}")
+                continue
+            print(f"{stage:12s} {result['p50_ms']:10.1f} {result['p95_ms']:10.1f} "
+                  f"{result['throughput']:9.2f} {result['unit'] + '/s':>6s} {result['peak_rss_mb']:12.0f}")
+    finally:
+        if temporary is not None:
+            temporary.cleanup()
+
+    run = {
+        "settings": {"cases": args.cases, "shape": list(args.shape), "repeats": args.repeats,
+                     "num_workers": args.num_workers},
+        "machine": {"python": platform.python_version(), "processor": platform.machine(),
+                    "cpus": os.cpu_count()},
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "stages": results,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"Baseline written to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != run["settings"]:
+            print(f"Baseline settings {baseline['settings']} differ from this run's, not comparing")
+            return
+        found = regressions(results, baseline, args.threshold)
+        for stage, metric, old, new in found:
+            print(f"REGRESSION {stage} {metric}: {old:.2f} -> {new:.2f}")
+        failed = [stage for stage, result in results.items() if "error" in result]
+        if found or failed:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
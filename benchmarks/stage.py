@@ -0,0 +1,186 @@
+"""
+Runs one benchmark stage in this process and writes its measurements as
+JSON. Started by run.py, one process per stage, so peak RSS is the stage's
+own. The stage's code is imported from src/ or Deployment/API/ with the
+working directory set the way those modules expect; in the workspace
+created by run.py, src/'s "../config.yaml" and "../params.yaml" resolve to
+the workspace's copies, so nothing outside it is written.
+
+Usage: python stage.py <stage> <workspace> <repeats> <output.json>
+"""
+import json
+import os
+import resource
+import shutil
+import sys
+import time
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(REPO, "src")
+API = os.path.join(REPO, "Deployment", "API")
+
+
+def enter(workspace, code_dir, cwd):
+    sys.path.insert(0, code_dir)
+    os.makedirs(os.path.join(workspace, cwd), exist_ok=True)
+    os.chdir(os.path.join(workspace, cwd))
+
+
+def case_folders(workspace):
+    raw = os.path.join(workspace, "data", "raw")
+    return [os.path.join(raw, case) for case in sorted(os.listdir(raw))]
+
+
+def bench_validate(workspace, repeats):
+    enter(workspace, SRC, "src")
+    from utils import validate_case
+
+    latencies = []
+    for _ in range(repeats):
+        for folder in case_folders(workspace):
+            # validate_case remaps label 4 in place, so it gets a fresh copy of the label map
+            case = os.path.basename(folder)
+            copy = os.path.join(workspace, "validate", case)
+            shutil.rmtree(copy, ignore_errors=True)
+            os.makedirs(copy)
+            shutil.copy(os.path.join(folder, f"{case}_seg.nii.gz"), copy)
+            start = time.perf_counter()
+            validate_case(copy)
+            latencies.append(time.perf_counter() - start)
+    return latencies, 1, "case"
+
+
+def bench_collate(workspace, repeats):
+    enter(workspace, SRC, "src")
+    import pre_process
+
+    latencies = []
+    for _ in range(repeats):
+        # Cold run: the manifest has to hash and read every file
+        manifest = pre_process.config["manifest"]
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        start = time.perf_counter()
+        pre_process.collate_func(os.path.join(workspace, "data", "raw"))
+        latencies.append(time.perf_counter() - start)
+    return latencies, len(case_folders(workspace)), "case"
+
+
+def bench_loader(workspace, repeats):
+    enter(workspace, SRC, "src")
+    import pre_process
+    import train
+
+    split = os.path.join(pre_process.config["split_data"], "train_dataset.pkl")
+    if not os.path.exists(split):
+        pre_process.train_test_split_data(pre_process.collate_func(os.path.join(workspace, "data", "raw")))
+    data_loader = train.build_dataloader(train.build_dataset(train.load_split("train")))
+
+    latencies = []
+    for _ in range(repeats):
+        wait = time.perf_counter()
+        for batch in data_loader:
+            latencies.append(time.perf_counter() - wait)
+            wait = time.perf_counter()
+    return latencies, train.params["batch_size"], "sample"
+
+
+def segmenter(workspace):
+    enter(workspace, API, "api")
+    import torch
+    from backends import build_model
+    from segmentation import BrainTumorSegmentation
+
+    model_path = os.path.join(workspace, "model.pt")
+    if not os.path.exists(model_path):
+        torch.manual_seed(0)
+        torch.save(build_model().state_dict(), model_path)
+    segmenter = BrainTumorSegmentation(model_path)
+    segmenter.warmup()
+    return segmenter
+
+
+def bench_preprocess(workspace, repeats):
+    model = segmenter(workspace)
+    latencies = []
+    for _ in range(repeats):
+        for folder in case_folders(workspace):
+            start = time.perf_counter()
+            model.preprocess_scan(model.get_brats_scan_paths(folder))
+            latencies.append(time.perf_counter() - start)
+    return latencies, 1, "case"
+
+
+def bench_predict(workspace, repeats):
+    model = segmenter(workspace)
+    latencies = []
+    for _ in range(repeats):
+        for folder in case_folders(workspace):
+            start = time.perf_counter()
+            model.predict(folder)
+            latencies.append(time.perf_counter() - start)
+    return latencies, 1, "case"
+
+
+def bench_mesh(workspace, repeats):
+    enter(workspace, API, "api")
+    from meshing import create_3d_mesh, load_nifti
+
+    volumes = [load_nifti(os.path.join(folder, f"{os.path.basename(folder)}_t1.nii.gz"))[0]
+               for folder in case_folders(workspace)]
+    latencies = []
+    for _ in range(repeats):
+        for data in volumes:
+            start = time.perf_counter()
+            create_3d_mesh(data, threshold=0.2)
+            latencies.append(time.perf_counter() - start)
+    return latencies, 1, "case"
+
+
+def bench_stats(workspace, repeats):
+    enter(workspace, API, "api")
+    from stats import calculate_segmentation_statistics
+
+    latencies = []
+    for _ in range(repeats):
+        for folder in case_folders(workspace):
+            start = time.perf_counter()
+            calculate_segmentation_statistics(os.path.join(folder, f"{os.path.basename(folder)}_seg.nii.gz"))
+            latencies.append(time.perf_counter() - start)
+    return latencies, 1, "case"
+
+
+STAGES = {
+    "validate": bench_validate,
+    "collate": bench_collate,
+    "loader": bench_loader,
+    "preprocess": bench_preprocess,
+    "predict": bench_predict,
+    "mesh": bench_mesh,
+    "stats": bench_stats,
+}
+
+
+def main():
+    stage, workspace, repeats, output = sys.argv[1], os.path.abspath(sys.argv[2]), int(sys.argv[3]), os.path.abspath(sys.argv[4])
+    latencies, items_per_call, unit = STAGES[stage](workspace, repeats)
+    latencies = np.array(latencies)
+    result = {
+        "stage": stage,
+        "calls": len(latencies),
+        "unit": unit,
+        "p50_ms": float(np.percentile(latencies, 50)) * 1000.0,
+        "p95_ms": float(np.percentile(latencies, 95)) * 1000.0,
+        "mean_ms": float(latencies.mean()) * 1000.0,
+        "throughput": len(latencies) * items_per_call / float(latencies.sum()),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+    with open(output, "w") as f:
+        json.dump(result, f)
+
+
+if __name__ == "__main__":
+    main()
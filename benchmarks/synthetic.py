@@ -0,0 +1,82 @@
+"""
+BraTS-like synthetic cases for the benchmarks.
+
+Each case is a folder <root>/BraTS2021_<nnnnn>/ with the four modalities and
+a label map named the BraTS way (BraTS2021_<nnnnn>_<modality>.nii.gz). The
+brain is an ellipsoid with smooth int16 intensity noise, the same in every
+case so foreground crops have equal shapes. The tumor is a randomly placed
+ellipsoid of edema (2) around a necrotic core (1) with an enhancing rim
+stored as 4, as in the raw dataset.
+"""
+import os
+
+import nibabel as nib
+import numpy as np
+
+MODALITIES = ("t1", "t1ce", "t2", "flair")
+# Mean intensity of brain tissue and tumor per modality
+TISSUE = {"t1": (600, 450), "t1ce": (650, 900), "t2": (500, 800), "flair": (450, 850)}
+
+
+def ellipsoid(shape, centre, radii):
+    axes = np.ogrid[tuple(slice(0, n) for n in shape)]
+    return sum(((axis - c) / r) ** 2 for axis, c, r in zip(axes, centre, radii))
+
+
+def smooth_noise(rng, shape, scale=8):
+    """
+    Low-frequency noise: a coarse random grid upsampled by repetition
+    """
+    coarse = rng.standard_normal(tuple(max(1, n // scale) + 1 for n in shape)).astype(np.float32)
+    for axis in range(len(shape)):
+        coarse = np.repeat(coarse, scale, axis=axis)
+    return coarse[tuple(slice(0, n) for n in shape)]
+
+
+def make_case(rng, shape):
+    """
+    ({modality: int16 volume}, uint8 label map with labels 0, 1, 2 and 4)
+    """
+    shape = tuple(shape)
+    centre = [n / 2 for n in shape]
+    brain = ellipsoid(shape, centre, [0.42 * n for n in shape]) < 1.0
+
+    tumor_centre = [c + rng.uniform(-0.12, 0.12) * n for c, n in zip(centre, shape)]
+    tumor_radii = [rng.uniform(0.08, 0.14) * n for n in shape]
+    distance = ellipsoid(shape, tumor_centre, tumor_radii)
+    label = np.zeros(shape, dtype=np.uint8)
+    label[(distance < 1.0) & brain] = 2
+    label[(distance < 0.45) & brain] = 4
+    label[(distance < 0.3) & brain] = 1
+
+    volumes = {}
+    for modality in MODALITIES:
+        tissue, tumor = TISSUE[modality]
+        volume = tissue + 60 * smooth_noise(rng, shape)
+        volume[label > 0] = tumor + 40 * smooth_noise(rng, shape)[label > 0]
+        volume[~brain] = 0
+        volumes[modality] = np.clip(volume, 0, np.iinfo(np.int16).max).astype(np.int16)
+    return volumes, label
+
+
+def write_cases(root, count, shape=(240, 240, 155), seed=0):
+    """
+    Write `count` cases under root, skipping cases that already exist.
+    Returns the case folders.
+    """
+    os.makedirs(root, exist_ok=True)
+    affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    folders = []
+    for index in range(count):
+        case = f"BraTS2021_{index:05d}"
+        folder = os.path.join(root, case)
+        folders.append(folder)
+        if os.path.exists(os.path.join(folder, f"{case}_seg.nii.gz")):
+            continue
+        os.makedirs(folder, exist_ok=True)
+        volumes, label = make_case(np.random.default_rng(seed + index), shape)
+        for modality, volume in volumes.items():
+            nib.save(nib.Nifti1Image(volume, affine), os.path.join(folder, f"{case}_{modality}.nii.gz"))
+        # Written last: a case with a label map is complete
+        nib.save(nib.Nifti1Image(label, affine), os.path.join(folder, f"{case}_seg.nii.gz"))
+    return folders
@@ -0,0 +1,84 @@
+"""
+Cost and content of the crops drawn by NpyCropDataset, uniform against the
+location index.
+
+For each mode it draws --samples crops from the converted training cases
+(no augmentation) and reports the time per crop and the share of crops
+that contain tumor, with the mean tumor fraction per crop. It also times
+building the location index for a few cases, the one-off cost that
+convert.py pays per case.
+
+Usage (from src): python bench_sampler.py --samples 200 --pos_ratio 0.67
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import yaml
+
+from convert import location_index
+from dataset import NpyCropDataset
+
+config = yaml.safe_load(open("../config.yaml"))["data"]
+
+
+def crop_stats(dataset, samples):
+    times = []
+    tumor_fraction = []
+    for i in range(samples):
+        start = time.perf_counter()
+        sample = dataset[i % len(dataset)]
+        times.append(time.perf_counter() - start)
+        tumor_fraction.append(float((sample["label"] > 0).float().mean()))
+    times = np.array(times) * 1000.0
+    tumor_fraction = np.array(tumor_fraction)
+    return {
+        "p50_ms": float(np.percentile(times, 50)),
+        "p95_ms": float(np.percentile(times, 95)),
+        "with_tumor": float((tumor_fraction > 0).mean()),
+        "tumor_fraction": float(tumor_fraction.mean()),
+    }
+
+
+def index_seconds(root, cases, max_samples):
+    times = []
+    for case in cases:
+        image = np.load(os.path.join(root, case, "image.npy"), mmap_mode="r")
+        label = np.load(os.path.join(root, case, "label.npy"))
+        start = time.perf_counter()
+        location_index(image, label, max_samples)
+        times.append(time.perf_counter() - start)
+    return float(np.mean(times))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default=config["converted_data"])
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--pos_ratio", type=float, default=0.67)
+    parser.add_argument("--label_ratios", type=float, nargs=3, default=[1.0, 1.0, 1.0])
+    parser.add_argument("--index_cases", type=int, default=5)
+    parser.add_argument("--max_samples", type=int, default=20000)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    cases = sorted(case for case in os.listdir(args.root)
+                   if os.path.exists(os.path.join(args.root, case, "locations.json")))
+    if not cases:
+        raise SystemExit(f"No converted cases with a location index under {args.root}, run convert.py first")
+
+    print(f"Index build: {index_seconds(args.root, cases[:args.index_cases], args.max_samples):.2f}s per case")
+    modes = {
+        "uniform": NpyCropDataset(args.root, cases),
+        "indexed": NpyCropDataset(args.root, cases, pos_ratio=args.pos_ratio, label_ratios=args.label_ratios),
+    }
+    for name, dataset in modes.items():
+        stats = crop_stats(dataset, args.samples)
+        print(f"{name:8s} p50 {stats['p50_ms']:.1f} ms  p95 {stats['p95_ms']:.1f} ms  "
+              f"crops with tumor {stats['with_tumor']:.0%}  mean tumor fraction {stats['tumor_fraction']:.2%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import json
+import shutil
+import zlib
+import yaml
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+config = yaml.safe_load(open("../config.yaml"))["data"]
+params = yaml.safe_load(open("../params.yaml"))["convert"]
+
+MODALITIES = ["t1", "t1ce", "t2", "flair"]
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+def case_files(case_dir: str):
+    """
+    Map each modality (and "seg") to its file, using the BraTS
+    <case>_<modality>.nii.gz naming rather than substring matching
+    """
+    files = {}
+    for file in os.listdir(case_dir):
+        if file.endswith(".nii.gz"):
+            modality = file[:-len(".nii.gz")].rsplit("_", 1)[-1].lower()
+            files[modality] = os.path.join(case_dir, file)
+    missing = [m for m in MODALITIES + ["seg"] if m not in files]
+    if missing:
+        raise ValueError(f"{case_dir} is missing {missing}")
+    return files
+
+
+def foreground_bbox(image: np.ndarray):
+    """
+    Bounding box of voxels that are non-zero in any channel, as (start, end) per axis
+    """
+    foreground = np.any(image != 0, axis=0)
+    box = []
+    for axis in range(foreground.ndim):
+        other_axes = tuple(a for a in range(foreground.ndim) if a != axis)
+        nonzero = np.flatnonzero(foreground.any(axis=other_axes))
+        if len(nonzero) == 0:
+            return [(0, n) for n in foreground.shape]
+        box.append((int(nonzero[0]), int(nonzero[-1]) + 1))
+    return box
+
+
+def location_index(image: np.ndarray, label: np.ndarray, max_samples: int = 20000, seed: int = 0):
+    """
+    Subsampled voxel coordinates per class of a cropped case: class 0 is
+    brain without tumor (non-zero in any modality), 1-3 are the tumor labels.
+    Returns a (N, 3) uint16 array with the classes stored one after another
+    and {class: [start, end]} rows of each class in it.
+    """
+    rng = np.random.default_rng(seed)
+    brain = np.any(image != 0, axis=0)
+    masks = {0: brain & (label == 0), 1: label == 1, 2: label == 2, 3: label == 3}
+    chunks = []
+    offsets = {}
+    start = 0
+    for cls, mask in masks.items():
+        flat = np.flatnonzero(mask)
+        if len(flat) > max_samples:
+            flat = np.sort(rng.choice(flat, max_samples, replace=False))
+        chunks.append(np.stack(np.unravel_index(flat, mask.shape), axis=1).astype(np.uint16))
+        offsets[str(cls)] = [start, start + len(flat)]
+        start += len(flat)
+    return np.concatenate(chunks), offsets
+
+
+def write_location_index(case_output: str, max_samples: int = 20000):
+    """
+    locations.npy + locations.json next to a converted case, so crops can be
+    centred on a class by reading one row instead of scanning the label
+    """
+    image = np.load(os.path.join(case_output, "image.npy"), mmap_mode="r")
+    label = np.load(os.path.join(case_output, "label.npy"))
+    case = os.path.basename(os.path.normpath(case_output))
+    # Same subsample on every run for a given case
+    locations, offsets = location_index(image, label, max_samples, seed=zlib.crc32(case.encode()))
+    np.save(os.path.join(case_output, "locations.npy"), locations)
+    with open(os.path.join(case_output, "locations.json"), "w") as f:
+        json.dump({"classes": offsets, "max_samples": max_samples}, f)
+
+
+def convert_case(case_dir: str, output_dir: str, dtype: str = "float16", max_samples: int = 20000):
+    """
+    Decode one case once and write it as
+        image.npy  (4, H, W, D) modalities in MODALITIES order, `dtype`
+        label.npy  (H, W, D) uint8 with label 4 remapped to 3
+        meta.json  crop box, original shape, spacing and affine
+        locations.npy/.json  sampled voxel coordinates per class, see location_index()
+    cropped to the foreground bounding box. The arrays are uncompressed so
+    they can be opened with np.load(mmap_mode="r").
+    """
+    case = os.path.basename(os.path.normpath(case_dir))
+    case_output = os.path.join(output_dir, case)
+    if os.path.exists(os.path.join(case_output, "meta.json")):
+        # Cases converted before the location index existed get one now
+        if not os.path.exists(os.path.join(case_output, "locations.json")):
+            write_location_index(case_output, max_samples)
+        return case, None
+
+    files = case_files(case_dir)
+    reference = nib.load(files[MODALITIES[0]])
+    image = np.stack([np.asanyarray(nib.load(files[m]).dataobj) for m in MODALITIES])
+    label = np.asanyarray(nib.load(files["seg"]).dataobj).astype(np.uint8)
+    label[label == 4] = 3
+
+    box = foreground_bbox(image)
+    crop = tuple(slice(start, end) for start, end in box)
+    image = image[(slice(None),) + crop]
+    label = np.ascontiguousarray(label[crop])
+    if dtype == "float16":
+        image = np.clip(image, -FLOAT16_MAX, FLOAT16_MAX)
+    elif dtype == "uint16":
+        image = np.clip(np.rint(image), 0, np.iinfo(np.uint16).max)
+    image = np.ascontiguousarray(image.astype(dtype))
+
+    meta = {
+        "case": case,
+        "shape": list(image.shape),
+        "original_shape": list(reference.shape),
+        "bbox": box,
+        "spacing": [float(z) for z in reference.header.get_zooms()[:3]],
+        "affine": reference.affine.tolist(),
+        "modalities": MODALITIES,
+    }
+
+    # Write into a temporary folder and rename it, so an interrupted run never
+    # leaves a half-written case behind
+    tmp_output = case_output + ".tmp"
+    shutil.rmtree(tmp_output, ignore_errors=True)
+    os.makedirs(tmp_output)
+    np.save(os.path.join(tmp_output, "image.npy"), image)
+    np.save(os.path.join(tmp_output, "label.npy"), label)
+    with open(os.path.join(tmp_output, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(case_output, ignore_errors=True)
+    os.replace(tmp_output, case_output)
+    # Written last: a case without locations.json is completed on the next run
+    write_location_index(case_output, max_samples)
+    return case, meta
+
+
+def convert_dataset(raw_data_path: str, output_dir: str, workers: int = 4, dtype: str = "float16",
+                    max_samples: int = 20000):
+    print("Converting dataset to memory-mapped arrays.............")
+    os.makedirs(output_dir, exist_ok=True)
+    case_dirs = [os.path.join(raw_data_path, case) for case in sorted(os.listdir(raw_data_path))
+                 if os.path.isdir(os.path.join(raw_data_path, case))]
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(convert_case, case_dir, output_dir, dtype, max_samples): case_dir for case_dir in case_dirs}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"Error converting {futures[future]}: {e}")
+
+    index = []
+    for case in sorted(os.listdir(output_dir)):
+        meta_path = os.path.join(output_dir, case, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            index.append({"case": case, "shape": meta["shape"]})
+    with open(os.path.join(output_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=1)
+    print(f"Done converting {len(index)} cases, {len(failed)} failed")
+    return index
+
+
+if __name__ == "__main__":
+    convert_dataset(config["raw_data_path"], config["converted_data"],
+                    workers=params["workers"], dtype=params["dtype"], max_samples=params["location_samples"])
@@ -0,0 +1,110 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+class NpyCropDataset(Dataset):
+    """
+    Random fixed-size crops from cases written by convert.py.
+
+    image.npy and label.npy are opened memory-mapped, so a crop only reads
+    the pages it covers instead of decompressing the whole case. Cases
+    smaller than roi_size are zero-padded. `transform` gets a dict with
+    float32 "image" (4, *roi_size) and uint8 "label" (1, *roi_size) tensors.
+
+    With pos_ratio set, crops are drawn from each case's location index
+    (locations.npy, see convert.location_index): a fraction pos_ratio is
+    centred on a tumor voxel, with the label picked by label_ratios
+    (necrotic, edema, enhancing), and the rest on brain without tumor.
+    Drawing a centre reads one row of the memory-mapped index. Without
+    pos_ratio, crops are uniform over the case.
+    """
+    def __init__(self, root: str, cases: list = None, roi_size=(128, 128, 128), transform=None,
+                 pos_ratio: float = None, label_ratios=(1.0, 1.0, 1.0)):
+        self.root = root
+        if cases is None:
+            with open(os.path.join(root, "index.json")) as f:
+                cases = [entry["case"] for entry in json.load(f)]
+        self.cases = list(cases)
+        self.roi_size = tuple(roi_size)
+        self.transform = transform
+        self.pos_ratio = pos_ratio
+        self.label_ratios = np.asarray(label_ratios, dtype=np.float64)
+        self._offsets = {}
+
+    def __len__(self):
+        return len(self.cases)
+
+    def load(self, index: int):
+        case_dir = os.path.join(self.root, self.cases[index])
+        image = np.load(os.path.join(case_dir, "image.npy"), mmap_mode="r")
+        label = np.load(os.path.join(case_dir, "label.npy"), mmap_mode="r")
+        return image, label
+
+    def random_start(self, shape):
+        # torch's RNG is seeded per DataLoader worker, numpy's is not
+        return [int(torch.randint(0, max(1, n - r + 1), (1,))) for n, r in zip(shape, self.roi_size)]
+
+    def class_offsets(self, index: int):
+        """
+        {class: (start, end)} rows of the case's location index; read once per worker
+        """
+        case = self.cases[index]
+        if case not in self._offsets:
+            with open(os.path.join(self.root, case, "locations.json")) as f:
+                classes = json.load(f)["classes"]
+            self._offsets[case] = {int(cls): tuple(rows) for cls, rows in classes.items()}
+        return self._offsets[case]
+
+    def sample_class(self, offsets: dict):
+        """
+        0 for a negative crop, 1-3 for a crop centred on that label; classes
+        with no voxels in this case are skipped
+        """
+        available = np.array([offsets[cls][1] > offsets[cls][0] for cls in (1, 2, 3)])
+        weights = self.label_ratios * available
+        if weights.sum() > 0 and float(torch.rand(1)) < self.pos_ratio:
+            weights = weights / weights.sum()
+            return 1 + int(torch.multinomial(torch.from_numpy(weights), 1))
+        return 0 if offsets[0][1] > offsets[0][0] else None
+
+    def sampled_start(self, index: int, shape):
+        """
+        Window start centred on a voxel drawn from the location index, kept
+        inside the volume where it fits
+        """
+        offsets = self.class_offsets(index)
+        cls = self.sample_class(offsets)
+        if cls is None:
+            return self.random_start(shape)
+        start, end = offsets[cls]
+        locations = np.load(os.path.join(self.root, self.cases[index], "locations.npy"), mmap_mode="r")
+        centre = locations[start + int(torch.randint(0, end - start, (1,)))]
+        return [min(max(0, int(c) - r // 2), max(0, n - r)) for c, r, n in zip(centre, self.roi_size, shape)]
+
+    def crop(self, image, label, start):
+        """
+        Read the roi_size window at `start` (zero-padded past the edges)
+        """
+        src = tuple(slice(s, min(s + r, n)) for s, r, n in zip(start, self.roi_size, label.shape))
+        dst = tuple(slice(0, sl.stop - sl.start) for sl in src)
+
+        image_crop = np.zeros((image.shape[0],) + self.roi_size, dtype=np.float32)
+        label_crop = np.zeros((1,) + self.roi_size, dtype=np.uint8)
+        image_crop[(slice(None),) + dst] = image[(slice(None),) + src]
+        label_crop[(0,) + dst] = label[src]
+        return image_crop, label_crop
+
+    def __getitem__(self, index: int):
+        image, label = self.load(index)
+        if self.pos_ratio is None:
+            start = self.random_start(label.shape)
+        else:
+            start = self.sampled_start(index, label.shape)
+        image_crop, label_crop = self.crop(image, label, start)
+        sample = {"image": torch.from_numpy(image_crop), "label": torch.from_numpy(label_crop)}
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample
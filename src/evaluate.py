@@ -0,0 +1,195 @@
+import os
+import csv
+import json
+import time
+import pickle
+import hashlib
+import numpy as np
+import nibabel as nib
+import yaml
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from scipy import ndimage
+from monai.inferers import sliding_window_inference
+from monai.transforms import Compose, LoadImage, EnsureChannelFirst, ScaleIntensityRange
+from monai.transforms.utils import generate_spatial_bounding_box
+from model import build_model
+
+config = yaml.safe_load(open("../config.yaml"))
+params = yaml.safe_load(open("../params.yaml"))["evaluate"]
+
+ROI_SIZE = (128, 128, 128)
+# BraTS regions as sets of labels (4 is stored as 3 after validate_and_remap)
+REGIONS = {"WT": (1, 2, 3), "TC": (1, 3), "ET": (3,)}
+# HD95 when exactly one of prediction and reference is empty: the BraTS
+# convention of the diagonal of the 240x240x155 grid in mm
+HD95_EMPTY = 373.1287
+
+
+def load_test_split():
+    with open(os.path.join(config["data"]["split_data"], "test_dataset.pkl"), "rb") as f:
+        split = pickle.load(f)
+    return [
+        {"case": os.path.basename(os.path.dirname(label)), "image": image, "label": label}
+        for image, label in zip(split["X"], split["y"])
+    ]
+
+
+def prediction_dir(checkpoint: str):
+    """
+    Cache folder for one set of weights and inference settings; masks in it
+    are reused until either changes
+    """
+    h = hashlib.blake2b(digest_size=8)
+    with open(checkpoint, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    h.update(json.dumps({"roi_size": ROI_SIZE, "overlap": params["overlap"]}).encode())
+    return os.path.join(params["prediction_cache"], h.hexdigest())
+
+
+@torch.no_grad()
+def predict_case(model, loader, image_paths: list, device):
+    """
+    uint8 mask in the original grid: the four modalities are scaled as in
+    training, cropped to their shared foreground box and segmented at native
+    resolution with overlapping 128^3 windows
+    """
+    image = torch.cat([loader(path) for path in image_paths], dim=0)
+    shape = tuple(image.shape[1:])
+    box_start, box_end = generate_spatial_bounding_box(image)
+    if any(e <= s for s, e in zip(box_start, box_end)):
+        box_start, box_end = [0, 0, 0], list(shape)
+    crop = tuple(slice(s, e) for s, e in zip(box_start, box_end))
+    inputs = torch.as_tensor(np.asarray(image[(slice(None),) + crop]), dtype=torch.float32)[None].to(device)
+
+    logits = sliding_window_inference(inputs, ROI_SIZE, params["sw_batch_size"], model,
+                                      overlap=params["overlap"], mode="gaussian")
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[crop] = logits.argmax(dim=1)[0].to(torch.uint8).cpu().numpy()
+    return mask
+
+
+def surface(mask: np.ndarray):
+    return mask & ~ndimage.binary_erosion(mask)
+
+
+def hd95(prediction: np.ndarray, reference: np.ndarray, spacing):
+    """
+    95th percentile symmetric surface distance in mm. Both masks are cropped
+    to their joint bounding box (plus one voxel), which holds every surface
+    voxel, so the distance transforms only run over that box.
+    """
+    if not prediction.any() and not reference.any():
+        return 0.0
+    if not prediction.any() or not reference.any():
+        return HD95_EMPTY
+
+    union = prediction | reference
+    box = []
+    for axis in range(union.ndim):
+        other_axes = tuple(a for a in range(union.ndim) if a != axis)
+        nonzero = np.flatnonzero(union.any(axis=other_axes))
+        box.append(slice(max(int(nonzero[0]) - 1, 0), min(int(nonzero[-1]) + 2, union.shape[axis])))
+    box = tuple(box)
+    prediction_surface = surface(np.pad(prediction[box], 1))
+    reference_surface = surface(np.pad(reference[box], 1))
+
+    to_reference = ndimage.distance_transform_edt(~reference_surface, sampling=spacing)[prediction_surface]
+    to_prediction = ndimage.distance_transform_edt(~prediction_surface, sampling=spacing)[reference_surface]
+    return float(max(np.percentile(to_reference, 95), np.percentile(to_prediction, 95)))
+
+
+def dice(prediction: np.ndarray, reference: np.ndarray):
+    total = int(prediction.sum()) + int(reference.sum())
+    # Both empty counts as a perfect score, as in the BraTS evaluation
+    return 1.0 if total == 0 else 2.0 * int(np.logical_and(prediction, reference).sum()) / total
+
+
+def score_case(case: str, prediction_path: str, label_path: str):
+    """
+    Dice and HD95 per region for one case; runs in a worker process
+    """
+    prediction = np.load(prediction_path)
+    label_nifti = nib.load(label_path)
+    label = np.asanyarray(label_nifti.dataobj).astype(np.uint8)
+    label[label == 4] = 3
+    spacing = [float(z) for z in label_nifti.header.get_zooms()[:3]]
+
+    scores = {"case": case}
+    for region, labels in REGIONS.items():
+        predicted = np.isin(prediction, labels)
+        expected = np.isin(label, labels)
+        scores[f"dice_{region}"] = dice(predicted, expected)
+        scores[f"hd95_{region}"] = hd95(predicted, expected, spacing)
+    return scores
+
+
+def summarize(rows: list):
+    summary = {"cases": len(rows)}
+    for metric in ("dice", "hd95"):
+        summary[metric] = {}
+        for region in REGIONS:
+            values = np.array([row[f"{metric}_{region}"] for row in rows], dtype=np.float64)
+            summary[metric][region] = {
+                "mean": float(values.mean()) if len(values) else None,
+                "median": float(np.median(values)) if len(values) else None,
+            }
+    return summary
+
+
+def evaluate():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    cases = load_test_split()
+    cache_dir = prediction_dir(params["checkpoint"])
+    os.makedirs(cache_dir, exist_ok=True)
+    print(f"Evaluating {params['checkpoint']} on {len(cases)} cases, predictions in {cache_dir}")
+
+    model = None
+    loader = Compose([
+        LoadImage(image_only=True),
+        EnsureChannelFirst(),
+        ScaleIntensityRange(a_min=-200, a_max=200, b_min=0.0, b_max=1.0, clip=True),
+    ])
+
+    start = time.perf_counter()
+    inferred = 0
+    # Scoring runs in the pool while the next case is being inferred
+    with ProcessPoolExecutor(max_workers=params["workers"]) as pool:
+        futures = []
+        for data in cases:
+            prediction_path = os.path.join(cache_dir, f"{data['case']}.npy")
+            if not os.path.exists(prediction_path):
+                if model is None:
+                    model = build_model().to(device)
+                    model.load_state_dict(torch.load(params["checkpoint"], map_location=device, weights_only=True))
+                    model.eval()
+                mask = predict_case(model, loader, data["image"], device)
+                tmp_path = prediction_path + ".tmp.npy"
+                np.save(tmp_path, mask)
+                os.replace(tmp_path, prediction_path)
+                inferred += 1
+            futures.append(pool.submit(score_case, data["case"], prediction_path, data["label"]))
+        rows = [future.result() for future in futures]
+
+    summary = summarize(rows)
+    summary["checkpoint"] = params["checkpoint"]
+    summary["inferred"] = inferred
+    summary["cached"] = len(cases) - inferred
+    summary["seconds"] = time.perf_counter() - start
+
+    os.makedirs(os.path.dirname(params["metrics"]), exist_ok=True)
+    with open(params["metrics"], "w") as f:
+        json.dump(summary, f, indent=2)
+    with open(params["per_case"], "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ["case"])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Done in {summary['seconds']:.1f}s ({inferred} inferred, {summary['cached']} from cache)")
+    for region in REGIONS:
+        print(f"{region}: Dice {summary['dice'][region]['mean']}, HD95 {summary['hd95'][region]['mean']}")
+    return summary
+
+
+if __name__ == "__main__":
+    evaluate()
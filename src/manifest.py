@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor
+
+MODALITIES = ["t1", "t1ce", "t2", "flair"]
+FILE_TYPES = MODALITIES + ["seg"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    case_id TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    shape TEXT,
+    spacing TEXT,
+    dtype TEXT,
+    label_hist TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_case ON files(case_id);
+CREATE TABLE IF NOT EXISTS splits (
+    case_id TEXT PRIMARY KEY,
+    split TEXT NOT NULL,
+    assigned_at REAL NOT NULL
+);
+"""
+
+
+def connect(db_path: str):
+    db = sqlite3.connect(db_path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def parse_modality(file_name: str):
+    """
+    "BraTS2021_00000_t1ce.nii.gz" -> "t1ce"; None for anything that is not a BraTS volume
+    """
+    if not file_name.endswith(".nii.gz"):
+        return None
+    modality = file_name[:-len(".nii.gz")].rsplit("_", 1)[-1].lower()
+    return modality if modality in FILE_TYPES else None
+
+
+def describe_file(path: str, modality: str):
+    """
+    Hash a file and read its header; label maps also get a label histogram
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    vol = nib.load(path)
+    label_hist = None
+    if modality == "seg":
+        labels = np.asanyarray(vol.dataobj)
+        if not np.issubdtype(labels.dtype, np.integer):
+            labels = np.rint(labels).astype(np.int16)
+        label_hist = np.bincount(labels.ravel(), minlength=4).tolist()
+    return {
+        "hash": h.hexdigest(),
+        "shape": json.dumps([int(n) for n in vol.shape]),
+        "spacing": json.dumps([float(z) for z in vol.header.get_zooms()[:3]]),
+        "dtype": str(vol.get_data_dtype()),
+        "label_hist": json.dumps(label_hist) if label_hist is not None else None,
+    }
+
+
+def _describe(args):
+    return describe_file(*args)
+
+
+def update_manifest(raw_data_path: str, db_path: str, workers: int = None):
+    """
+    Bring the manifest in line with raw_data_path. Files are compared by size
+    and mtime, so only new or modified files are hashed and read; rows for
+    files that disappeared are removed. Returns counts of what changed.
+    """
+    db = connect(db_path)
+    known = {path: (size, mtime_ns) for path, size, mtime_ns in
+             db.execute("SELECT path, size, mtime_ns FROM files")}
+
+    seen = set()
+    todo = []
+    for case_entry in os.scandir(raw_data_path):
+        if not case_entry.is_dir():
+            continue
+        for file_entry in os.scandir(case_entry.path):
+            modality = parse_modality(file_entry.name)
+            if modality is None:
+                continue
+            stat = file_entry.stat()
+            seen.add(file_entry.path)
+            if known.get(file_entry.path) != (stat.st_size, stat.st_mtime_ns):
+                todo.append((file_entry.path, case_entry.name, modality, stat.st_size, stat.st_mtime_ns))
+
+    print(f"Manifest: {len(todo)} new or changed files out of {len(seen)}")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        descriptions = pool.map(_describe, [(path, modality) for path, _, modality, _, _ in todo], chunksize=4)
+        now = time.time()
+        for (path, case_id, modality, size, mtime_ns), description in zip(todo, descriptions):
+            db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, case_id, modality, size, mtime_ns, description["hash"], description["shape"],
+                 description["spacing"], description["dtype"], description["label_hist"], now)
+            )
+
+    removed = [path for path in known if path not in seen]
+    db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+    db.commit()
+    db.close()
+    return {
+        "added": sum(1 for entry in todo if entry[0] not in known),
+        "changed": sum(1 for entry in todo if entry[0] in known),
+        "removed": len(removed),
+        "unchanged": len(seen) - len(todo),
+    }
+
+
+def complete_cases(db):
+    """
+    Case ids that have all four modalities and a label map
+    """
+    rows = db.execute(
+        "SELECT case_id FROM files GROUP BY case_id HAVING COUNT(DISTINCT modality) = ?",
+        (len(FILE_TYPES),)
+    )
+    return sorted(case_id for case_id, in rows)
+
+
+def assign_splits(db_path: str, test_size: float = 0.2, seed: int = 42, previous: dict = None):
+    """
+    Give every complete case without a split a "train" or "test" assignment.
+    The split is a function of the case id alone, and existing assignments
+    are never changed, so new data does not move old cases between splits.
+    `previous` ({case_id: split}, e.g. from the pickles of an earlier
+    train_test_split run) takes precedence for the cases it names, so a
+    held-out set that was already evaluated keeps its cases.
+    """
+    previous = previous or {}
+    db = connect(db_path)
+    assigned = {case_id for case_id, in db.execute("SELECT case_id FROM splits")}
+    now = time.time()
+    new = []
+    for case_id in complete_cases(db):
+        if case_id in assigned:
+            continue
+        if case_id in previous:
+            new.append((case_id, previous[case_id], now))
+            continue
+        digest = hashlib.blake2b(f"{seed}:{case_id}".encode(), digest_size=8).digest()
+        fraction = int.from_bytes(digest, "big") / 2 ** 64
+        new.append((case_id, "test" if fraction < test_size else "train", now))
+    db.executemany("INSERT INTO splits VALUES (?, ?, ?)", new)
+    db.commit()
+    db.close()
+    return len(new)
+
+
+def get_split(db_path: str, split: str):
+    """
+    [{"case", "image": [t1, t1ce, t2, flair], "label": seg}] for a split, sorted by case id
+    """
+    db = connect(db_path)
+    rows = db.execute(
+        "SELECT f.case_id, f.modality, f.path FROM files f JOIN splits s ON f.case_id = s.case_id "
+        "WHERE s.split = ?",
+        (split,)
+    )
+    cases = {}
+    for case_id, modality, path in rows:
+        cases.setdefault(case_id, {})[modality] = path
+    db.close()
+    return [
+        {"case": case_id, "image": [files[m] for m in MODALITIES], "label": files["seg"]}
+        for case_id, files in sorted(cases.items())
+        if all(m in files for m in FILE_TYPES)
+    ]
+
+
+def changed_cases(db_path: str, since: float):
+    """
+    Case ids with a file added or modified after `since` (a time.time() value)
+    """
+    db = connect(db_path)
+    rows = db.execute("SELECT DISTINCT case_id FROM files WHERE updated_at > ?", (since,))
+    changed = sorted(case_id for case_id, in rows)
+    db.close()
+    return changed
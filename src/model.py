@@ -0,0 +1,16 @@
+from monai.networks.nets import UNet
+
+
+def build_model():
+    """
+    3D UNet over the four stacked modalities (T1, T1ce, T2, FLAIR),
+    same architecture as the one served by Deployment/API
+    """
+    return UNet(
+        spatial_dims=3,
+        in_channels=4,
+        out_channels=4,
+        channels=(32, 64, 128, 256, 512),
+        strides=(2, 2, 2, 2),
+        num_res_units=2
+    )
@@ -1,14 +1,12 @@
 import os
 import yaml
 import pickle
-from monai.data import CacheDataset, DataLoader
 from monai.transforms import (
     Compose, LoadImaged, EnsureChannelFirstd, ScaleIntensityRanged,
     CropForegroundd, RandSpatialCropd, RandFlipd, RandRotate90d,
     ConcatItemsd, EnsureTyped, RandShiftIntensityd
 )
-from sklearn.model_selection import train_test_split 
-from monai.data import Dataset
+from manifest import update_manifest, assign_splits, get_split
 
 config = yaml.safe_load(open("../config.yaml"))["data"]
 transforms = Compose([
@@ -27,45 +25,53 @@ transforms = Compose([
 ])
 
 
+def previous_splits():
+    """
+    {case_id: "train" | "test"} from the split pickles already on disk, so
+    cases that were split before the manifest existed keep their split
+    """
+    splits = {}
+    for split in ("train", "test"):
+        path = os.path.join(config["split_data"], f"{split}_dataset.pkl")
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for image in pickle.load(f)["X"]:
+                # Case id is the case folder, as in the manifest
+                splits[os.path.basename(os.path.dirname(image[0]))] = split
+    return splits
+
+
 def collate_func(train_nifty_file:str):
+    """
+    Refresh the manifest (only new or modified files are read) and return
+    every complete case with its modalities in t1, t1ce, t2, flair order
+    """
     print("collating Dataset...........")
-    dataset = []
-    count = 0
-    file_list = os.listdir(train_nifty_file)
-    for file in file_list:
-        count +=1
-        try:
-            PATH = os.path.join(train_nifty_file,file)
-            image = []
-            label = ""
-            for nifty_file in os.listdir(PATH):
-                if "seg" in nifty_file:
-                    label = os.path.join(PATH,nifty_file)
-                else:
-                    image.append(os.path.join(PATH,nifty_file))         
-            dataset.append({
-                        "image":image,
-                        "label" : label
-                    })
-        except Exception as e:
-            print(e)
-    print(f"Done with collating {count}")
-    return dataset 
+    changes = update_manifest(train_nifty_file, config["manifest"])
+    print(f"Manifest updated: {changes}")
+    assign_splits(config["manifest"], test_size=0.2, seed=42, previous=previous_splits())
+    dataset = get_split(config["manifest"], "train") + get_split(config["manifest"], "test")
+    print(f"Done with collating {len(dataset)}")
+    return dataset
 
 def train_test_split_data(collated_dataset):
-    X = [data["image"] for data in collated_dataset]
-    y = [data["label"] for data in collated_dataset]  
+    """
+    Write the train/test pickles from the manifest's split assignment. A case
+    keeps its split when new cases are added, so earlier results stay comparable.
+    """
     print("Splitting the dataset into train and test.............................................")
-
-    
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2 ,random_state=42)
+    cases = {data["case"] for data in collated_dataset}
+    train = [data for data in get_split(config["manifest"], "train") if data["case"] in cases]
+    test = [data for data in get_split(config["manifest"], "test") if data["case"] in cases]
+    X_train, y_train = [data["image"] for data in train], [data["label"] for data in train]
+    X_test, y_test = [data["image"] for data in test], [data["label"] for data in test]
  
     os.makedirs(config["split_data"], exist_ok=True)
     save_dir = config["split_data"]
      
     train_dataset = {"X": X_train, "y": y_train}
     test_dataset = {"X": X_test, "y": y_test}
-    print(train_dataset)
     with open(os.path.join(save_dir, "train_dataset.pkl"), "wb") as f:
         pickle.dump(train_dataset, f)
     with open(os.path.join(save_dir, "test_dataset.pkl"), "wb") as f:
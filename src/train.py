@@ -1,12 +1,327 @@
+"""
+Train the 3D UNet, in one process or data-parallel over several.
+
+    python train.py                  one process
+    python train.py --nproc 4        4 processes on this machine (gloo)
+    torchrun --nnodes 2 --nproc_per_node 8 --rdzv_backend c10d \
+        --rdzv_endpoint <host>:29500 train.py
+                                     8 processes on each of 2 nodes
+
+Every process trains on its own shard of the train split with
+micro_batch_size samples per step. Gradients are accumulated over
+batch_size / (micro_batch_size * processes) steps, so one optimizer step
+always covers batch_size samples whatever the number of processes. After
+every epoch, rank 0 writes Brain_<epoch>.pt (weights only, as served by
+the API) and last.pt (weights, optimizer and epoch). With resume: true, a
+new run continues from last.pt. On multi-homed nodes, set
+GLOO_SOCKET_IFNAME to the interface the nodes share.
+"""
 import os
-import pickle 
-import numpy as np
-import yaml 
-from monai.data import Dataset, DataLoader
+import time
+import pickle
+import argparse
+import socket
+from contextlib import nullcontext
+import yaml
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from monai.data import CacheDataset, PersistentDataset, Dataset, DataLoader, partition_dataset
+from monai.losses import DiceLoss
+from monai.transforms import (
+    Compose, LoadImaged, EnsureChannelFirstd, ScaleIntensityRanged,
+    CropForegroundd, RandSpatialCropd, RandFlipd, RandRotate90d,
+    EnsureTyped, RandShiftIntensityd
+)
+from model import build_model
+from dataset import NpyCropDataset
+
+config = yaml.safe_load(open("../config.yaml"))
+params = yaml.safe_load(open("../params.yaml"))["params"]
+
+# Deterministic part of the pipeline: computed once per case and cached
+deterministic_transforms = [
+    LoadImaged(keys=["image", "label"]),
+    EnsureChannelFirstd(keys=["image", "label"]),
+    ScaleIntensityRanged(
+        keys=["image"], a_min=-200, a_max=200, b_min=0.0, b_max=1.0, clip=True
+    ),
+    CropForegroundd(keys=["image", "label"], source_key="image"),
+    EnsureTyped(keys=["image", "label"], track_meta=False),
+]
+# Random part: runs on every step, on top of the cached result
+random_transforms = [
+    RandSpatialCropd(keys=["image", "label"], roi_size=(128, 128, 128), random_size=False),
+    RandFlipd(keys=["image", "label"], spatial_axis=[0], prob=0.5),
+    RandRotate90d(keys=["image", "label"], prob=0.5, max_k=3),
+    RandShiftIntensityd(keys=["image"], offsets=0.1, prob=0.5),
+    EnsureTyped(keys=["image", "label"], track_meta=False),
+]
+transforms = Compose(deterministic_transforms + random_transforms)
+# For crops read from the converted arrays: same scaling and augmentation,
+# the crop itself is drawn by NpyCropDataset
+npy_transforms = Compose([
+    ScaleIntensityRanged(
+        keys=["image"], a_min=-200, a_max=200, b_min=0.0, b_max=1.0, clip=True
+    ),
+] + random_transforms[1:])
+
+
+def load_split(name: str = "train"):
+    with open(os.path.join(config["data"]["split_data"], f"{name}_dataset.pkl"), "rb") as f:
+        split = pickle.load(f)
+    return [{"image": image, "label": label} for image, label in zip(split["X"], split["y"])]
+
+
+def build_dataset(data: list):
+    """
+    Wrap the case list so the deterministic transforms are only run once:
+    "memory" keeps up to cache_ram_gb of preprocessed cases in RAM,
+    "disk" stores them under cache_dir, "none" recomputes every epoch.
+    """
+    if params["cache"] == "memory":
+        # Size one preprocessed case to turn the RAM cap into a cache rate
+        sample = Compose(deterministic_transforms)(data[0])
+        case_bytes = sample["image"].nbytes + sample["label"].nbytes
+        cache_rate = min(1.0, params["cache_ram_gb"] * 1024 ** 3 / (case_bytes * len(data)))
+        print(f"Caching {cache_rate:.0%} of {len(data)} cases ({case_bytes / 1024 ** 2:.0f} MB each)")
+        return CacheDataset(data=data, transform=transforms, cache_rate=cache_rate,
+                            num_workers=params["num_workers"])
+    if params["cache"] == "disk":
+        return PersistentDataset(data=data, transform=transforms, cache_dir=params["cache_dir"])
+    return Dataset(data=data, transform=transforms)
+
+
+def build_npy_dataset(data: list):
+    """
+    Crops straight from the arrays written by convert.py, centred on tumor
+    or brain voxels from each case's location index (see NpyCropDataset)
+    """
+    root = config["data"]["converted_data"]
+    cases = [os.path.basename(os.path.dirname(entry["label"])) for entry in data]
+    missing = [case for case in cases if not os.path.exists(os.path.join(root, case, "locations.json"))]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} training cases are not converted, run convert.py first: {missing[:5]}")
+    print(f"Sampling crops from {root}: pos_ratio {params['pos_ratio']}, label_ratios {params['label_ratios']}")
+    return NpyCropDataset(root, cases, roi_size=(128, 128, 128), transform=npy_transforms,
+                          pos_ratio=params["pos_ratio"], label_ratios=params["label_ratios"])
+
+
+def build_dataloader(dataset, sampler=None, batch_size=None):
+    num_workers = params["num_workers"]
+    return DataLoader(
+        dataset,
+        batch_size=batch_size or params["batch_size"],
+        shuffle=sampler is None,
+        sampler=sampler,
+        num_workers=num_workers,
+        prefetch_factor=params["prefetch_factor"] if num_workers > 0 else None,
+        persistent_workers=num_workers > 0,
+        pin_memory=params["pin_memory"] and torch.cuda.is_available(),
+    )
+
+
+def train_one_epoch(model, data_loader, loss_function, optimizer, device, accumulation: int = 1):
+    """
+    One pass over the data, stepping the optimizer every `accumulation`
+    batches (and after the last one). Under DistributedDataParallel the
+    gradients are only all-reduced on those batches. Returns the mean loss
+    and a throughput report: samples/s and the time spent waiting on the
+    loader ("stall").
+    """
+    model.train()
+    epoch_loss = 0.0
+    samples = 0
+    stall = 0.0
+    steps = 0
+    optimizer_steps = 0
+    batches = len(data_loader)
+    start = time.perf_counter()
+    iterator = iter(data_loader)
+    optimizer.zero_grad()
+    while True:
+        wait = time.perf_counter()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            break
+        stall += time.perf_counter() - wait
+
+        images = batch["image"].to(device, non_blocking=True)
+        labels = batch["label"].to(device, non_blocking=True)
+        # Every rank has the same number of batches (see shard_loader), so
+        # all of them reach the synchronising backward pass together
+        sync = (steps + 1) % accumulation == 0 or steps + 1 == batches
+        context = model.no_sync() if not sync and isinstance(model, DistributedDataParallel) else nullcontext()
+        with context:
+            outputs = model(images)
+            loss = loss_function(outputs, labels)
+            # The last group of the epoch may hold fewer than `accumulation`
+            # batches; it is averaged over the batches it actually has
+            group_size = min(accumulation, batches - steps // accumulation * accumulation)
+            (loss / group_size).backward()
+        if sync:
+            optimizer.step()
+            optimizer.zero_grad()
+            optimizer_steps += 1
+
+        epoch_loss += loss.item()
+        samples += images.shape[0]
+        steps += 1
+
+    elapsed = time.perf_counter() - start
+    return epoch_loss / max(steps, 1), {
+        "samples": samples,
+        "optimizer_steps": optimizer_steps,
+        "seconds": elapsed,
+        "samples_per_second": samples / elapsed if elapsed else 0.0,
+        "loader_stall_seconds": stall,
+        "loader_stall_fraction": stall / elapsed if elapsed else 0.0,
+    }
+
+
+def shard_loader(data: list, rank: int, world_size: int, seed: int):
+    """
+    Data loader over this rank's share of the split. With the in-memory
+    cache each rank takes a fixed shard, so it only caches the cases it
+    trains on; otherwise a DistributedSampler reshuffles the shards every
+    epoch. Both give every rank the same number of batches.
+    Returns (loader, sampler or None).
+    """
+    batch_size = params["micro_batch_size"]
+    if params["loader"] == "npy":
+        dataset = build_npy_dataset(data)
+    elif params["cache"] == "memory" and world_size > 1:
+        shard = partition_dataset(data, num_partitions=world_size, shuffle=True, seed=seed,
+                                  even_divisible=True)[rank]
+        return build_dataloader(build_dataset(shard), batch_size=batch_size), None
+    else:
+        dataset = build_dataset(data)
+    if world_size == 1:
+        return build_dataloader(dataset, batch_size=batch_size), None
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=seed)
+    return build_dataloader(dataset, sampler=sampler, batch_size=batch_size), sampler
+
+
+def accumulation_steps(world_size: int):
+    per_step = params["micro_batch_size"] * world_size
+    if params["batch_size"] % per_step:
+        raise ValueError(f"batch_size {params['batch_size']} is not a multiple of micro_batch_size "
+                         f"{params['micro_batch_size']} x {world_size} processes")
+    return params["batch_size"] // per_step
+
+
+def save_training_state(path: str, model, optimizer, epoch: int, world_size: int):
+    # Written under a temporary name so a crash never leaves a torn last.pt
+    tmp_path = path + ".tmp"
+    torch.save({
+        "epoch": epoch,
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "world_size": world_size,
+        "batch_size": params["batch_size"],
+    }, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def train(rank: int = 0, world_size: int = 1, local_rank: int = 0, local_world_size: int = 1):
+    distributed = world_size > 1
+    if distributed:
+        dist.init_process_group(params["dist_backend"], rank=rank, world_size=world_size)
+    if distributed and params["dist_backend"] == "nccl":
+        device = torch.device("cuda", local_rank)
+    elif distributed:
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # Split the node's cores between the processes running on it
+    if params["torch_threads"] or local_world_size > 1:
+        torch.set_num_threads(params["torch_threads"] or max(1, (os.cpu_count() or 1) // local_world_size))
+    threads = torch.get_num_threads()
+    # Different augmentations per rank; DDP copies rank 0's initial weights to all
+    torch.manual_seed(params["seed"] + rank)
+
+    accumulation = accumulation_steps(world_size)
+    data = load_split("train")
+    if rank == 0:
+        print(f"Training on {len(data)} cases with {world_size} processes x {threads} threads, "
+              f"micro batch {params['micro_batch_size']}, {accumulation} accumulation steps, "
+              f"effective batch {params['batch_size']}")
+    data_loader, sampler = shard_loader(data, rank, world_size, params["seed"])
+
+    model = build_model().to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=params["lr"])
+    checkpoint_dir = config["model"]["checkpoint_dir"]
+    state_path = os.path.join(checkpoint_dir, "last.pt")
+    start_epoch = 0
+    if params["resume"] and os.path.exists(state_path):
+        state = torch.load(state_path, map_location=device, weights_only=True)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        start_epoch = state["epoch"]
+        if rank == 0:
+            print(f"Resuming from {state_path} at epoch {start_epoch + 1}")
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[local_rank] if device.type == "cuda" else None)
+    loss_function = DiceLoss(to_onehot_y=True, softmax=True)
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    for epoch in range(start_epoch, params["epochs"]):
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+        loss, report = train_one_epoch(model, data_loader, loss_function, optimizer, device, accumulation)
+        print(f"[rank {rank}] Epoch {epoch+1}, Loss: {loss:.4f}, "
+              f"{report['samples_per_second']:.2f} samples/s, "
+              f"loader stall {report['loader_stall_seconds']:.1f}s ({report['loader_stall_fraction']:.0%})")
+
+        if distributed:
+            totals = torch.tensor([loss * report["samples"], report["samples"]], dtype=torch.float64)
+            dist.all_reduce(totals)
+            # The slowest rank sets the pace: the others wait for it at every sync
+            wall = torch.tensor([report["seconds"]], dtype=torch.float64)
+            dist.all_reduce(wall, op=dist.ReduceOp.MAX)
+            loss = totals[0].item() / max(totals[1].item(), 1)
+            if rank == 0:
+                print(f"Epoch {epoch+1}, Loss: {loss:.4f}, {totals[1].item() / wall.item():.2f} samples/s over "
+                      f"{world_size} processes")
+
+        if rank == 0:
+            weights = model.module if distributed else model
+            torch.save(weights.state_dict(), os.path.join(checkpoint_dir, f"Brain_{epoch}.pt"))
+            save_training_state(state_path, weights, optimizer, epoch + 1, world_size)
+        if distributed:
+            # Nobody starts the next epoch (or exits) before the checkpoint is written
+            dist.barrier()
+
+    if distributed:
+        dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawned(local_rank: int, nproc: int):
+    train(rank=local_rank, world_size=nproc, local_rank=local_rank, local_world_size=nproc)
+
 
-config = yaml.safe_load(open('config.yaml'))["data"]
-with open(os.path.join(f'{config["split_data"]}/train_dataset.pkl'),"rb") as f:
-    train_data = pickle.load(f)
-    print(train_data["X"] , train_data["y"] )
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the 3D UNet")
+    parser.add_argument("--nproc", type=int, default=1,
+                        help="Processes to start on this machine (ignored under torchrun)")
+    args = parser.parse_args()
 
-# def dataloader()
\ No newline at end of file
+    if "WORLD_SIZE" in os.environ:
+        # Started by torchrun, which sets the rank and rendezvous variables
+        train(rank=int(os.environ["RANK"]), world_size=int(os.environ["WORLD_SIZE"]),
+              local_rank=int(os.environ["LOCAL_RANK"]), local_world_size=int(os.environ["LOCAL_WORLD_SIZE"]))
+    elif args.nproc > 1:
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", str(free_port()))
+        mp.spawn(spawned, args=(args.nproc,), nprocs=args.nproc)
+    else:
+        train()
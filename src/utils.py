@@ -1,4 +1,6 @@
 import os
+import gzip
+import json
 import tarfile
 import yaml
 import shutil
@@ -7,6 +9,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import kagglehub
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 
@@ -53,19 +56,6 @@ def check_file_name(list_of_train_nifty_file: list, train_nifty_file: str):
 
 
 
-def identify_unwanted_files(nifty_file: str, list_of_unwanted_file: list):
-    try:
-        for file in os.listdir(nifty_file):
-            name = file.split("_")
-            if "seg" in name[2]:
-                brain_vol = nib.load(os.path.join(nifty_file, file))
-                brain_data = brain_vol.get_fdata()
-                if len(np.unique(brain_data)) != 4:
-                    list_of_unwanted_file.append(nifty_file)
-    except Exception as e:
-        print(f"Error processing file {file}: {e}")
-    return list_of_unwanted_file
-
 def delete_unwanted_file(list_of_unwanted_file:list):
     print("Removing Unwanted File ")
     try:
@@ -101,21 +91,95 @@ def visualize_one_nifty_file(nifty_file: str, save_location: str):
             print(f"Error with file {file}: {e}")
 
 
-def check_label(file_path:str):
-    try:
-        for file in os.listdir(file_path):
-            name= file.split("_")
-            if "seg" in name[2]:
-                brain_vol = nib.load(os.path.join(file_path,file))
-                brain_data = brain_vol.get_fdata()
-            if  np.any(brain_data == 4):
-                brain_data[brain_data == 4] = 3
-                relabeled_vol = nib.Nifti1Image(brain_data, brain_vol.affine, brain_vol.header)
-                nib.save(relabeled_vol, os.path.join(file_path,f"{file}"))
-            else:
-                pass
-    except Exception as e:
-      pass
+def read_label_volume(seg_path: str):
+    """
+    Load a segmentation in its stored integer dtype instead of get_fdata()'s float64
+    """
+    seg_vol = nib.load(seg_path)
+    seg_data = np.asanyarray(seg_vol.dataobj)
+    if not np.issubdtype(seg_data.dtype, np.integer):
+        rounded = np.rint(seg_data)
+        if not np.array_equal(rounded, seg_data):
+            raise ValueError(f"{seg_path} has non-integer labels")
+        seg_data = rounded.astype(np.int16)
+    return seg_vol, seg_data
+
+
+def validate_case(case_dir: str):
+    """
+    Check and fix one case in a single read of its label map:
+    label statistics come from one bincount, the case is "wanted" if it has
+    exactly 4 labels (background and three tumor classes), and label 4 is
+    remapped to 3 only when present. The rewrite goes to a temporary file
+    that is renamed over the original, so an interrupted run never leaves
+    a truncated .nii.gz. The temporary name ends in .tmp so it never looks
+    like a label map; one left behind by an interrupted run is removed here.
+    """
+    for file in os.listdir(case_dir):
+        # ".tmp_<name>_seg.nii.gz" is the name older runs used
+        if file.endswith(".nii.gz.tmp") or file.startswith(".tmp_"):
+            os.remove(os.path.join(case_dir, file))
+    seg_files = [f for f in os.listdir(case_dir) if f.endswith("_seg.nii.gz")]
+    if len(seg_files) != 1:
+        raise ValueError(f"Expected one segmentation in {case_dir}, found {seg_files}")
+    seg_path = os.path.join(case_dir, seg_files[0])
+
+    seg_vol, seg_data = read_label_volume(seg_path)
+    if seg_data.min() < 0:
+        raise ValueError(f"{seg_path} has negative labels")
+    counts = np.bincount(seg_data.ravel(), minlength=5)
+    wanted = int(np.count_nonzero(counts)) == 4
+
+    remapped = False
+    if wanted and counts[4] > 0:
+        seg_data = np.array(seg_data)
+        seg_data[seg_data == 4] = 3
+        relabeled_vol = nib.Nifti1Image(seg_data, seg_vol.affine, seg_vol.header)
+        tmp_path = seg_path + ".tmp"
+        # nib.save picks the format from the extension, which .tmp hides
+        with gzip.open(tmp_path, "wb", compresslevel=1) as f:
+            f.write(relabeled_vol.to_bytes())
+        os.replace(tmp_path, seg_path)
+        counts[3] += counts[4]
+        counts[4] = 0
+        remapped = True
+
+    return {
+        "case": os.path.basename(os.path.normpath(case_dir)),
+        "label_counts": counts.tolist(),
+        "wanted": wanted,
+        "remapped": remapped,
+    }
+
+
+def validate_and_remap(train_nifty_file: str, list_of_train_nifty_file: list, manifest_path: str, workers: int = None):
+    """
+    Run validate_case over all cases on a process pool. Every finished case is
+    appended to a JSON-lines manifest, and cases already in the manifest are
+    skipped, so an interrupted run picks up where it stopped.
+    """
+    done = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    done[result["case"]] = result
+    pending = [case for case in list_of_train_nifty_file if case not in done]
+    print(f"Validating {len(pending)} cases ({len(done)} already done)")
+
+    with open(manifest_path, "a") as manifest, ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(validate_case, os.path.join(train_nifty_file, case)): case for case in pending}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error processing {futures[future]}: {e}")
+                continue
+            done[result["case"]] = result
+            manifest.write(json.dumps(result) + "\n")
+            manifest.flush()
+    return [done[case] for case in list_of_train_nifty_file if case in done]
 
 
 if __name__ == "__main__":
@@ -125,19 +189,13 @@ if __name__ == "__main__":
                      train_nifty_file=config["raw_data_path"])
     visualize_one_nifty_file(nifty_file=os.path.join(config["raw_data_path"], list_of_train_nifty_file[1]), 
                              save_location=config_img["loc"])
-    unwanted_files = []
-    for file in list_of_train_nifty_file:
-        try:
-            unwanted_files = identify_unwanted_files(os.path.join(config["raw_data_path"], file), unwanted_files)
-        except Exception as e:
-            print(e)
+    print("Checking Labels ........ ")
+    print("Making label 4->3")
+    results = validate_and_remap(config["raw_data_path"], list_of_train_nifty_file,
+                                 manifest_path=config["validation_manifest"])
+    unwanted_files = [os.path.join(config["raw_data_path"], result["case"])
+                      for result in results if not result["wanted"]]
     print(f"No. of unwanted file {len(unwanted_files)} Unwanted files: {unwanted_files}")
 
     delete_unwanted_file(list_of_unwanted_file=unwanted_files)
-
-    print("Checking Labels ........ ")
-    print("Making label 4->3")
-    for file in list_of_train_nifty_file:
-        check_label(os.path.join(config["raw_data_path"],file))
     print("Done with label checking ")
-